@@ -0,0 +1,50 @@
+"""Run the benchmark suite and compare the result with stored baseline.
+
+    python -m benchmarks                          # compare with benchmarks/baseline.json
+    python -m benchmarks --output result.json     # also save the result
+    python -m benchmarks --save-baseline          # overwrite the baseline by the result
+"""
+import sys
+import json
+import argparse
+
+from benchmarks.suite import WORKLOADS, DEFAULT_BASELINE_PATH, run_suite,\
+        compare_with_baseline, load_report, save_report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark suite of kyoka")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scale", type=float, default=1.0,
+            help="multiply the number of episodes (playouts) of each benchmark")
+    parser.add_argument("--repeat", type=int, default=3,
+            help="run each benchmark this times and report the fastest one")
+    parser.add_argument("--target", action="append", choices=WORKLOADS.keys(),
+            help="run only this benchmark (can be specified multiple times)")
+    parser.add_argument("--output", help="save the result as JSON to this path")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true",
+            help="save the result as new baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+            help="allowed ratio of slowdown (or memory growth) from baseline")
+    args = parser.parse_args(argv)
+
+    report = run_suite(seed=args.seed, scale=args.scale, repeat=args.repeat, targets=args.target)
+    print json.dumps(report, indent=2)
+    if args.output:
+        save_report(args.output, report)
+    if args.save_baseline:
+        save_report(args.baseline, report)
+        print "Saved baseline to [ %s ]" % args.baseline
+        return 0
+
+    regressions = compare_with_baseline(report, load_report(args.baseline), args.tolerance)
+    if len(regressions) == 0:
+        print "No regression found against baseline [ %s ]" % args.baseline
+        return 0
+    print "Regression found against baseline [ %s ]" % args.baseline
+    for message in regressions: print "  %s" % message
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
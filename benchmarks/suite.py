@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import pickle
+import traceback
+import random
+import timeit
+import platform
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import examples.maze.helper as MazeHelper
+from examples.maze.task import MazeTask
+from examples.ticktacktoe.task import TickTackToeTask
+
+from kyoka.task import BaseTask
+from kyoka.policy import EpsilonGreedyPolicy
+from kyoka.callback import WatchIterationCount
+from kyoka.algorithm.montecarlo import MonteCarlo, MonteCarloTabularActionValueFunction
+from kyoka.algorithm.sarsa import Sarsa, SarsaTabularActionValueFunction
+from kyoka.algorithm.q_learning import QLearning, QLearningTabularActionValueFunction
+from kyoka.algorithm.deep_q_learning import DeepQLearning, DeepQLearningApproxActionValueFunction
+from kyoka.algorithm.montecarlo_tree_search import BaseMCTS, UCTNode
+
+
+MAZE_FILE_PATH = os.path.join(os.path.dirname(__file__), "..",
+        "examples", "maze", "script", "dyna_maze", "dyna.txt")
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# number of episodes (or playouts for MCTS) of each benchmark when scale=1
+WORKLOADS = OrderedDict([
+    ("montecarlo.maze", 50),
+    ("montecarlo.ticktacktoe", 1000),
+    ("sarsa.maze", 500),
+    ("sarsa.ticktacktoe", 1000),
+    ("q_learning.maze", 500),
+    ("q_learning.ticktacktoe", 1000),
+    ("deep_q_learning.maze", 5),
+    ("deep_q_learning.ticktacktoe", 100),
+    ("mcts.ticktacktoe", 2000)
+    ])
+
+
+def run_suite(seed=0, scale=1.0, repeat=3, targets=None):
+    """Run benchmarks and return the report which can be dumped as JSON.
+
+    Every benchmark is started after resetting random seed. So same
+    workload (ex. number of steps) is measured on each run.
+    Each benchmark is repeated and the fastest run is reported to reduce
+    the noise from other processes.
+    Each run is done in a forked child process. So "peak_memory_kb" is the
+    peak of the process which ran the benchmark (max over the repeats) and
+    is not affected by the benchmarks run before it.
+
+    Args:
+        seed: random seed set before each benchmark
+        scale: multiply the number of episodes(playouts) of each benchmark
+        repeat: number of times to run each benchmark
+        targets: names of benchmarks to run (ex. ["sarsa.maze"]). Run all if None.
+    Returns:
+        report: dict of {"meta": environment info, "results": name to metrics}
+    """
+    results = OrderedDict()
+    for name, workload in WORKLOADS.items():
+        if targets is not None and name not in targets: continue
+        algorithm_name, task_name = name.split(".")
+        if algorithm_name == "deep_q_learning" and np is None:
+            results[name] = {"skipped": "numpy is not installed"}
+            continue
+        nb_iteration = max(1, int(workload * scale))
+        runs, peak_memories = [], []
+        for _ in range(repeat):
+            run, peak_memory = run_in_forked_process(
+                    _run_benchmark, seed, algorithm_name, task_name, nb_iteration)
+            runs.append(run)
+            peak_memories.append(peak_memory)
+        results[name] = min(runs, key=lambda result: result["elapsed_sec"])
+        results[name]["peak_memory_kb"] = max(peak_memories)
+    meta = OrderedDict([
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("seed", seed),
+        ("scale", scale),
+        ("repeat", repeat)
+        ])
+    return OrderedDict([("meta", meta), ("results", results)])
+
+def run_algorithm_benchmark(algorithm_name, task_name, nb_episode):
+    """Measure episodes/sec and steps/sec of GPI on the task"""
+    task = _build_task(task_name)
+    algorithm, value_function = _build_algorithm(algorithm_name, task)
+    counting_task = StepCountingTask(task)
+    algorithm.setup(counting_task, EpsilonGreedyPolicy(eps=0.1), value_function)
+    counting_task.step_count = 0  # ignore the steps taken in setup (ex. replay memory of DQN)
+    with _silence_stdout():
+        start = timeit.default_timer()
+        algorithm.run_gpi(nb_episode, verbose=0)
+        elapsed = timeit.default_timer() - start
+    return OrderedDict([
+        ("episodes_per_sec", nb_episode / elapsed),
+        ("steps_per_sec", counting_task.step_count / elapsed),
+        ("elapsed_sec", elapsed),
+        ("nb_episode", nb_episode),
+        ("nb_step", counting_task.step_count)
+        ])
+
+def run_mcts_benchmark(task, nb_playout):
+    """Measure playouts/sec of UCT search from the initial state of the task"""
+    mcts = UCTSearch(task)
+    finish_rule = WatchIterationCount(nb_playout, verbose=0)
+    with _silence_stdout():
+        start = timeit.default_timer()
+        mcts.planning(task.generate_initial_state(), finish_rule)
+        elapsed = timeit.default_timer() - start
+    return OrderedDict([
+        ("playouts_per_sec", nb_playout / elapsed),
+        ("elapsed_sec", elapsed),
+        ("nb_playout", nb_playout)
+        ])
+
+def run_in_forked_process(func, *args):
+    """Run func(*args) in forked child process.
+
+    Returns:
+        result: returned value of func (must be picklable)
+        peak_memory_kb: peak resident memory of the child process in kilobytes
+    Raises:
+        RuntimeError: if func raised or child process died
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            payload = (True, func(*args))
+        except BaseException:
+            payload = (False, traceback.format_exc())
+        with os.fdopen(write_fd, "wb") as f:
+            pickle.dump(payload, f, pickle.HIGHEST_PROTOCOL)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as f:
+        data = f.read()
+    _pid, status, rusage = os.wait4(pid, 0)
+    if len(data) == 0:
+        raise RuntimeError("Benchmark process died (status=%d)" % status)
+    success, result = pickle.loads(data)
+    if not success:
+        raise RuntimeError("Benchmark failed in child process\n%s" % result)
+    return result, _maxrss_to_kb(rusage.ru_maxrss)
+
+def _maxrss_to_kb(maxrss):
+    return maxrss / 1024 if sys.platform == "darwin" else maxrss
+
+def compare_with_baseline(report, baseline, tolerance=0.3):
+    """Find the metrics which got worse than baseline beyond tolerance.
+
+    Throughput (key ends with "_per_sec") is regressed if it gets lower than
+    (1 - tolerance) * baseline. Peak memory is regressed if it gets higher than
+    (1 + tolerance) * baseline. Benchmarks which are not in both of reports are
+    ignored.
+
+    Returns:
+        messages: array of message for each regression. Empty if no regression.
+    Raises:
+        ValueError: if report is created with different seed or scale from baseline
+    """
+    for key in ["seed", "scale"]:
+        if report["meta"][key] != baseline["meta"][key]:
+            raise ValueError("Cannot compare with baseline created with different %s (%s != %s)"
+                    % (key, report["meta"][key], baseline["meta"][key]))
+    messages = []
+    for name, result in report["results"].items():
+        base_result = baseline["results"].get(name)
+        if base_result is None or "skipped" in result or "skipped" in base_result: continue
+        for key, value in result.items():
+            if key not in base_result: continue
+            base_value = base_result[key]
+            if key.endswith("_per_sec") and value < (1 - tolerance) * base_value:
+                messages.append("%s.%s : %.1f (baseline %.1f, %+.1f%%)" %
+                        (name, key, value, base_value, _percent_change(value, base_value)))
+            if key == "peak_memory_kb" and value > (1 + tolerance) * base_value:
+                messages.append("%s.%s : %d (baseline %d, %+.1f%%)" %
+                        (name, key, value, base_value, _percent_change(value, base_value)))
+            if key == "nb_step" and value != base_value:
+                messages.append("%s.%s : %d (baseline %d, workload is not reproduced)" %
+                        (name, key, value, base_value))
+    return messages
+
+def load_report(file_path):
+    with open(file_path, "rb") as f: return json.load(f, object_pairs_hook=OrderedDict)
+
+def save_report(file_path, report):
+    with open(file_path, "wb") as f: json.dump(report, f, indent=2)
+
+def _percent_change(value, base_value):
+    return 100.0 * (value - base_value) / base_value if base_value != 0 else 0
+
+def _run_benchmark(seed, algorithm_name, task_name, nb_iteration):
+    _reset_random_seed(seed)
+    if algorithm_name == "mcts":
+        return run_mcts_benchmark(_build_task(task_name), nb_iteration)
+    else:
+        return run_algorithm_benchmark(algorithm_name, task_name, nb_iteration)
+
+def _reset_random_seed(seed):
+    random.seed(seed)
+    if np is not None: np.random.seed(seed)
+
+@contextmanager
+def _silence_stdout():
+    original = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = original
+
+def _build_task(task_name):
+    if task_name == "maze":
+        task = MazeTask()
+        task.read_maze(MAZE_FILE_PATH)
+        return task
+    elif task_name == "ticktacktoe":
+        return TickTackToeTask(is_first_player=True)
+    else:
+        raise ValueError("Unknown task [ %s ]" % task_name)
+
+def _build_algorithm(algorithm_name, task):
+    if algorithm_name == "montecarlo":
+        return MonteCarlo(), MonteCarloDictTable()
+    elif algorithm_name == "sarsa":
+        return Sarsa(), SarsaDictTable()
+    elif algorithm_name == "q_learning":
+        return QLearning(), QLearningDictTable()
+    elif algorithm_name == "deep_q_learning":
+        algorithm = DeepQLearning(gamma=0.99, N=1000, C=100, minibatch_size=16, replay_start_size=100)
+        return algorithm, LinearNetworkValueFunction(task)
+    else:
+        raise ValueError("Unknown algorithm [ %s ]" % algorithm_name)
+
+
+class StepCountingTask(BaseTask):
+    """Delegate everything to wrapped task and count "transit_state" calls"""
+
+    def __init__(self, task):
+        self.task = task
+        self.step_count = 0
+
+    def generate_initial_state(self):
+        return self.task.generate_initial_state()
+
+    def is_terminal_state(self, state):
+        return self.task.is_terminal_state(state)
+
+    def transit_state(self, state, action):
+        self.step_count += 1
+        return self.task.transit_state(state, action)
+
+    def generate_possible_actions(self, state):
+        return self.task.generate_possible_actions(state)
+
+    def calculate_reward(self, state):
+        return self.task.calculate_reward(state)
+
+class DictTableMixin(object):
+    """Table of state-action pair to value which works on any hashable state"""
+
+    def generate_initial_table(self):
+        return {}
+
+    def fetch_value_from_table(self, table, state, action):
+        return table.get((state, action), 0)
+
+    def insert_value_into_table(self, table, state, action, new_value):
+        table[(state, action)] = new_value
+
+class MonteCarloDictTable(DictTableMixin, MonteCarloTabularActionValueFunction):
+    pass
+
+class SarsaDictTable(DictTableMixin, SarsaTabularActionValueFunction):
+    pass
+
+class QLearningDictTable(DictTableMixin, QLearningTabularActionValueFunction):
+    pass
+
+class LinearNetworkValueFunction(DeepQLearningApproxActionValueFunction):
+    """Stand-in of neuralnetwork for DQN. Network is a weight vector of numpy
+    which is trained by SGD on the minibatch.
+    """
+
+    def __init__(self, task, learning_rate=0.01):
+        self.task = task
+        self.learning_rate = learning_rate
+
+    def initialize_network(self):
+        return np.zeros(len(self.construct_features(*self._sample_state_action())))
+
+    def deepcopy_network(self, q_network):
+        return q_network.copy()
+
+    def predict_value_by_network(self, network, state, action):
+        return float(np.dot(network, self.construct_features(state, action)))
+
+    def predict_value_by_network_on_batch(self, network, state_action_pairs):
+        X = np.array([self.construct_features(state, action) for state, action in state_action_pairs])
+        return X.dot(network).tolist()
+
+    def backup_on_minibatch(self, q_network, backup_minibatch):
+        X = np.array([self.construct_features(state, action) for state, action, _ in backup_minibatch])
+        y = np.array([target for _, _, target in backup_minibatch])
+        gradient = X.T.dot(X.dot(q_network) - y) / len(backup_minibatch)
+        q_network -= self.learning_rate * gradient
+
+    def construct_features(self, state, action):
+        if isinstance(self.task, MazeTask):
+            return MazeHelper.construct_features(self.task, state, action)
+        else:
+            bits = lambda board: [(board >> pos) & 1 for pos in range(9)]
+            return bits(state[0]) + bits(state[1]) + bits(action)
+
+    def _sample_state_action(self):
+        state = self.task.generate_initial_state()
+        return state, self.task.generate_possible_actions(state)[0]
+
+class UCTSearch(BaseMCTS):
+
+    def generate_node_from_state(self, state):
+        return UCTNode(self.task, state)
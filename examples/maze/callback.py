@@ -1,5 +1,6 @@
 import logging
 
+from kyoka.task import CachedTask
 from kyoka.callback import BaseCallback, BasePerformanceWatcher
 from examples.maze.helper import measure_performance, visualize_policy
 
@@ -34,5 +35,6 @@ class MazeTransformer(BaseCallback):
         if iteration_count in self.transformation:
             maze_filepath = self.transformation[iteration_count]
             task.read_maze(maze_filepath)
+            if isinstance(task, CachedTask): task.clear_cache()
             logging.debug("Maze transformed into [ %s ]" % maze_filepath)
 
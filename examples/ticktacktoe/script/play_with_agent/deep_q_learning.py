@@ -47,6 +47,11 @@ class TickTackToeApproxActionValueFunction(DeepQLearningApproxActionValueFunctio
         features = self.construct_features(state, action)
         return network.predict_on_batch(np.array([features]))[0][0]
 
+    def predict_value_by_network_on_batch(self, network, state_action_pairs):
+        if len(state_action_pairs) == 0: return []
+        X = np.array([self.construct_features(state, action) for state, action in state_action_pairs])
+        return network.predict_on_batch(X)[:, 0].tolist()
+
     def backup_on_minibatch(self, q_network, backup_minibatch):
         minibatch = [(self.construct_features(state, action), target) for state, action, target in backup_minibatch]
         X = np.array([x for x, _ in minibatch])
@@ -73,6 +73,9 @@ class TickTackToeApproxActionValueFunction(MonteCarloApproxActionValueFunction):
     def approx_predict_value(self, features):
         return self.model.predict_on_batch(np.array([features]))[0][0]
 
+    def approx_predict_value_on_batch(self, features_list):
+        return self.model.predict_on_batch(np.array(features_list))[:, 0].tolist()
+
     def approx_backup(self, features, backup_target, alpha):
         loss = self.model.train_on_batch(np.array([features]), np.array([backup_target]))
 
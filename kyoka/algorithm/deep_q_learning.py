@@ -1,10 +1,21 @@
 import os
+import sys
+import mmap
+import pickle
 import random
+import shutil
+import struct
 
-from kyoka.utils import pickle_data, unpickle_data, value_function_check, build_not_implemented_msg
-from kyoka.policy import GreedyPolicy, EpsilonGreedyPolicy
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from kyoka.utils import pickle_data, unpickle_data, value_function_check, build_not_implemented_msg,\
+        map_on_forked_workers, seed_random_generators
+from kyoka.policy import RandomPolicy
 from kyoka.value_function import BaseApproxActionValueFunction
-from kyoka.algorithm.rl_algorithm import BaseRLAlgorithm, generate_episode
+from kyoka.algorithm.rl_algorithm import BaseRLAlgorithm, iterate_episode
 
 
 class DeepQLearning(BaseRLAlgorithm):
@@ -52,9 +63,10 @@ class DeepQLearning(BaseRLAlgorithm):
     """
 
     SAVE_FILE_NAME = "dq_replay_memory.pickle"
+    DELTA_FILE_NAME = "dq_replay_memory_delta.pickle"
 
     def __init__(self, gamma=0.99, N=1000000, C=10000,
-            minibatch_size=32, replay_start_size=50000):
+            minibatch_size=32, replay_start_size=50000, replay_memory=None, nb_warmup_worker=1):
         """
         Args:
             g <- discounting factor (gamma)
@@ -62,20 +74,27 @@ class DeepQLearning(BaseRLAlgorithm):
             C <- interval to sync Q' with Q
             minibatch_size <- size of minibatch used to train Q
             replay_start_size <- initial size of replay memory.
+            replay_memory <- replay memory to use instead of default
+                ExperienceReplay(max_size=N). (ex. ExperienceReplay with column_dtypes)
+            nb_warmup_worker <- number of processes to fill initial replay memory.
+                Experiences are generated on forked processes if more than 1.
+                (states and actions must be picklable)
         """
 
         self.gamma = gamma
-        self.replay_memory = ExperienceReplay(max_size=N)
+        self.replay_memory = replay_memory if replay_memory is not None else ExperienceReplay(max_size=N)
         self.C = C
         self.minibatch_size = minibatch_size
         self.replay_start_size = replay_start_size
+        self.nb_warmup_worker = nb_warmup_worker
         self.reset_step_counter = 0
+        self.delta_base_count = 0
 
     def setup(self, task, policy, value_function):
         validate_value_function(value_function)
         super(DeepQLearning, self).setup(task, policy, value_function)
-        initialize_replay_memory(task, value_function, self.replay_memory, self.replay_start_size)
-        self.greedy_policy = GreedyPolicy()
+        initialize_replay_memory(task, value_function, self.replay_memory, self.replay_start_size,
+                nb_worker=self.nb_warmup_worker)
 
     def run_gpi_for_an_episode(self, task, policy, value_function):
         value_function.use_target_network(False)
@@ -88,10 +107,12 @@ class DeepQLearning(BaseRLAlgorithm):
             self.replay_memory.store_transition(state, action, reward, next_state)
             state = next_state
 
-            experience_minibatch = self.replay_memory.sample_minibatch(self.minibatch_size)
-            backup_minibatch = self._gen_backup_minibatch(
-                    task, self.greedy_policy, value_function, experience_minibatch)
-            value_function.backup_on_minibatch(value_function.q_network, backup_minibatch)
+            if isinstance(self.replay_memory, PrioritizedExperienceReplay):
+                self._backup_on_prioritized_minibatch(task, value_function)
+            else:
+                experience_minibatch = self.replay_memory.sample_minibatch(self.minibatch_size)
+                backup_minibatch = self._gen_backup_minibatch(task, value_function, experience_minibatch)
+                value_function.backup_on_minibatch(value_function.q_network, backup_minibatch)
 
             if self.reset_step_counter >= self.C:
                 value_function.reset_target_network()
@@ -106,19 +127,65 @@ class DeepQLearning(BaseRLAlgorithm):
                 self.replay_start_size, self.reset_step_counter
                 )
         pickle_data(self._gen_replay_memory_save_path(save_dir_path), state)
+        self.replay_memory.save_files(save_dir_path)
 
     def load_algorithm_state(self, load_dir_path):
         """Load initial params, replay memory and counter for sync Q' with Q"""
         state = unpickle_data(self._gen_replay_memory_save_path(load_dir_path))
         (self.gamma, replay_memory_serial, self.C, self.minibatch_size,
                 self.replay_start_size, self.reset_step_counter) = state
-        self.greedy_policy = GreedyPolicy()
-        new_replay_memory = ExperienceReplay(max_size=1)
-        new_replay_memory.load(replay_memory_serial)
-        self.replay_memory = new_replay_memory
+        self.replay_memory.load_files(load_dir_path)
+        self.replay_memory.load(replay_memory_serial)
 
-    def _gen_backup_minibatch(self, task, greedy_policy, value_function, experience_minibatch):
-        """Create minibatch of backup targets from minibatch of experiences
+    def save_algorithm_state_delta(self, save_dir_path):
+        """Save params, counter and only the experiences stored into replay
+        memory since last "clear_algorithm_state_delta" call.
+        """
+        new_transitions = self.replay_memory.fetch_recent_transitions(
+                self.replay_memory.stored_count - self.delta_base_count)
+        state = (
+                self.gamma, self.C, self.minibatch_size, self.replay_start_size,
+                self.reset_step_counter, new_transitions
+                )
+        pickle_data(self._gen_replay_memory_save_path(save_dir_path, self.DELTA_FILE_NAME), state)
+
+    def load_algorithm_state_delta(self, load_dir_path):
+        """Append the experiences saved by "save_algorithm_state_delta" to replay memory"""
+        state = unpickle_data(self._gen_replay_memory_save_path(load_dir_path, self.DELTA_FILE_NAME))
+        (self.gamma, self.C, self.minibatch_size, self.replay_start_size,
+                self.reset_step_counter, new_transitions) = state
+        for transition in new_transitions:
+            self.replay_memory.store_transition(*transition)
+
+    def clear_algorithm_state_delta(self):
+        self.delta_base_count = self.replay_memory.stored_count
+
+    def _backup_on_prioritized_minibatch(self, task, value_function):
+        """Train Q on the minibatch sampled in proportion to priorities and
+        update the priorities of sampled experiences by their TD errors
+        """
+        experience_minibatch, positions, weights =\
+                self.replay_memory.sample_weighted_minibatch(self.minibatch_size)
+        backup_minibatch = self._gen_backup_minibatch(task, value_function, experience_minibatch)
+        td_errors = value_function.backup_on_weighted_minibatch(
+                value_function.q_network, backup_minibatch, weights)
+        if td_errors is None:
+            td_errors = self._gen_td_errors(value_function, backup_minibatch)
+        self.replay_memory.update_priorities(positions, td_errors)
+
+    def _gen_td_errors(self, value_function, backup_minibatch):
+        """Return array of TD error (backup_target - Q(state, action)) of
+        each learning data predicted by Q (not Q'). This extra prediction is
+        used only if "backup_on_weighted_minibatch" does not return TD errors.
+        """
+        predictions = value_function.predict_value_on_batch(
+                [(state, action) for state, action, _ in backup_minibatch])
+        return [target - prediction for (_, _, target), prediction in zip(backup_minibatch, predictions)]
+
+    def _gen_backup_minibatch(self, task, value_function, experience_minibatch):
+        """Create minibatch of backup targets from minibatch of experiences.
+        Values of all next_state-action pairs in the minibatch are predicted
+        by Q' in one "predict_value_on_batch" call.
         Returns
             backup_minibatch : minibatch of training data for value function.
                                It's array of learning data which is tuple of
@@ -127,28 +194,14 @@ class DeepQLearning(BaseRLAlgorithm):
                                using MSE between Q(state, action) and backup_target.
         """
         value_function.use_target_network(True)
-        backup_minibatch = [
-                self._gen_backup_data(task, greedy_policy, value_function, experience)
-                for experience in experience_minibatch]
+        greedy_Q_values = predict_greedy_values_on_batch(
+                task, value_function, [next_state for _, _, _, next_state in experience_minibatch])
         value_function.use_target_network(False)
-        return backup_minibatch
-
-    def _gen_backup_data(self, task, greedy_policy, value_function, experience):
-        """Transform experience into backup targets in training data format
-        Returns
-            learning data: tuple of (state, action, backup_target).
-                           value function receives minibatch of this tuples and
-                           train value function maybe like below.
-                           MSE <- ( Q(state, action) - backup_target )^2
-        """
-        state, action, reward, next_state = experience
-        greedy_action = choose_action(task, greedy_policy, value_function, next_state)
-        greedy_Q_value = predict_value(value_function, next_state, greedy_action)
-        backup_target = reward + self.gamma * greedy_Q_value
-        return (state, action, backup_target)
+        return [(state, action, reward + self.gamma * greedy_Q_value)
+                for (state, action, reward, _), greedy_Q_value in zip(experience_minibatch, greedy_Q_values)]
 
-    def _gen_replay_memory_save_path(self, dir_path):
-        return os.path.join(dir_path, self.SAVE_FILE_NAME)
+    def _gen_replay_memory_save_path(self, dir_path, file_name=None):
+        return os.path.join(dir_path, file_name if file_name else self.SAVE_FILE_NAME)
 
 class DeepQLearningApproxActionValueFunction(BaseApproxActionValueFunction):
     """Base class of Approximation value function for deep Q-learing.
@@ -196,6 +249,21 @@ class DeepQLearningApproxActionValueFunction(BaseApproxActionValueFunction):
         err_msg = build_not_implemented_msg(self, "predict_value_by_network")
         raise NotImplementedError(err_msg)
 
+    def predict_value_by_network_on_batch(self, network, state_action_pairs):
+        """Predict values of state-action pairs by passed network at once.
+        Default implementation calls "predict_value_by_network" on each pair.
+        Override this to pass the pairs to your network in one batch
+        (ex. model.predict on array of features), because targets of whole
+        minibatch are predicted through this method.
+        Args:
+            network: q_network or q_hat_network
+            state_action_pairs: array of tuple (state, action)
+        Returns:
+            predicted_values: array of prediction value of each pair
+        """
+        return [self.predict_value_by_network(network, state, action)
+                for state, action in state_action_pairs]
+
     def backup_on_minibatch(self, q_network, backup_minibatch):
         """Define how to train Q network which you defined
         Args:
@@ -209,6 +277,27 @@ class DeepQLearningApproxActionValueFunction(BaseApproxActionValueFunction):
         err_msg = build_not_implemented_msg(self, "backup_on_minibatch")
         raise NotImplementedError(err_msg)
 
+    def backup_on_weighted_minibatch(self, q_network, backup_minibatch, weights):
+        """Define how to train Q network with importance-sampling weights.
+        This method is used instead of "backup_on_minibatch" when DeepQLearning
+        uses PrioritizedExperienceReplay. Default implementation ignores
+        weights and calls "backup_on_minibatch".
+        Args:
+            q_network: Q value function initialized by "initialize_network"
+            backup_minibatch : same format as the one of "backup_on_minibatch"
+            weights: array of importance-sampling weight of each learning data
+                     in backup_minibatch. Most of the case loss of each data is
+                     multiplied by its weight (ex. weight * (Q(s,a) - target)^2).
+        Returns:
+            td_errors: array of (backup_target - Q(state, action)) of each
+                       learning data, where Q(state, action) is the prediction
+                       your training step computed before the update. These are
+                       used as new priorities of the experiences. If None is
+                       returned (as default implementation does), DeepQLearning
+                       predicts Q(state, action) again after the update.
+        """
+        self.backup_on_minibatch(q_network, backup_minibatch)
+
     def save_networks(self, q_network, q_hat_network, save_dir_path):
         """Save Q and Q' under passed directory
         Args:
@@ -259,6 +348,13 @@ class DeepQLearningApproxActionValueFunction(BaseApproxActionValueFunction):
         network = self.q_hat_network if self.use_target_network_flg else self.q_network
         return self.predict_value_by_network(network, state, action)
 
+    def predict_value_on_batch(self, state_action_pairs):
+        """Batch version of "predict_value". Main logic of prediction is
+        delegated to "predict_value_by_network_on_batch".
+        """
+        network = self.q_hat_network if self.use_target_network_flg else self.q_network
+        return self.predict_value_by_network_on_batch(network, state_action_pairs)
+
     def reset_target_network(self):
         """Sync Q' with Q by calling user-defined method "deepcopy_network" """
         self.q_hat_network = self.deepcopy_network(self.q_network)
@@ -277,61 +373,573 @@ class DeepQLearningApproxActionValueFunction(BaseApproxActionValueFunction):
 
 
 class ExperienceReplay(object):
-    """Implementation of ExperienceReplayMemory"""
+    """Implementation of ExperienceReplayMemory
+
+    Experiences are stored in preallocated circular buffer. So storing new
+    experience is O(1) even if memory is full, and sampling minibatch is
+    O(minibatch_size).
 
-    def __init__(self, max_size):
+    Each field of experience (state, action, reward, next_state) is stored
+    in its own column. If you pass "column_dtypes", the fields are stored in
+    typed numpy array instead of list of python objects. This saves lots of
+    memory when state is numeric (ex. features of the state).
+
+        # reward as float32, state and next_state as int8 array of shape (9,)
+        ExperienceReplay(max_size, column_dtypes={
+            "reward": "float32", "state": ("int8", (9,)), "next_state": ("int8", (9,))})
+
+    Property:
+        queue: array of stored experiences in stored order (oldest first).
+               This is created on each access. Use "len(memory)" to get the size.
+    """
+
+    FIELDS = ["state", "action", "reward", "next_state"]
+
+    def __init__(self, max_size, column_dtypes=None):
         """
         Args:
             max_size: capacity of replay memory. If size of memory exceeds
-                      after store_transition, old item will be poped from
-                      memory. (FIFO)
+                      after store_transition, oldest item is overwritten.
+                      (FIFO)
+            column_dtypes: dict of field name to numpy dtype or tuple of
+                           (dtype, shape) to store the field in typed column.
+                           Fields not in this dict are stored as python object.
         """
-        self.max_size = max_size
-        self.queue = []
+        if column_dtypes and np is None:
+            raise ImportError('"column_dtypes" of "ExperienceReplay" requires numpy.')
+        self.column_dtypes = column_dtypes if column_dtypes else {}
+        self._allocate(max_size)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def queue(self):
+        return self.fetch_recent_transitions(self.size)
 
     def store_transition(self, state, action, reward, next_state):
-        """Store new experience and pop old item if it reaches max size"""
-        if len(self.queue) >= self.max_size:
-            self.queue.pop(0)
-        self.queue.append((state, action, reward, next_state))
+        """Store new experience and overwrite oldest item if it reaches max size"""
+        for column, value in zip(self.columns, (state, action, reward, next_state)):
+            column[self.head] = value
+        self.head = (self.head + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+        self.stored_count += 1
+
+    def fetch_recent_transitions(self, size):
+        """Return the latest "size" experiences in stored order
+        (or all experiences if memory has less than "size" items).
+        """
+        size = max(0, min(size, self.size))
+        return self._fetch_transitions(range(self.size - size, self.size))
 
     def sample_minibatch(self, minibatch_size):
         """Return array of experiences with specified size by sampling
         from replay memory at random.
         """
-        return random.sample(self.queue, minibatch_size)
+        return self._fetch_transitions(random.sample(xrange(self.size), minibatch_size))
 
     def dump(self):
         return (self.max_size, self.queue)
 
     def load(self, serial):
-        self.max_size, self.queue = serial
+        max_size, queue = serial[:2]
+        self._allocate(max_size)
+        for transition in queue:
+            self.store_transition(*transition)
+        self.stored_count = len(queue)
+
+    def save_files(self, save_dir_path):
+        """Save the files which "dump" refers to under passed directory.
+        Default memory holds everything in "dump", so nothing is saved.
+        """
+        pass
+
+    def load_files(self, load_dir_path):
+        """Restore the files saved by "save_files" (called before "load")"""
+        pass
 
-def initialize_replay_memory(task, value_function, replay_memory, start_size):
+    def _allocate(self, max_size):
+        self.max_size = max_size
+        self.columns = [self._allocate_column(field, max_size) for field in self.FIELDS]
+        self.head = 0
+        self.size = 0
+        self.stored_count = 0
+
+    def _allocate_column(self, field, max_size):
+        if field not in self.column_dtypes:
+            return [None] * max_size
+        dtype = self.column_dtypes[field]
+        dtype, shape = dtype if isinstance(dtype, tuple) else (dtype, ())
+        return np.zeros((max_size,) + tuple(shape), dtype=dtype)
+
+    def _fetch_transitions(self, indices):
+        """Fetch experiences of passed indices (idx-th oldest) in passed order"""
+        return [self._fetch_transition(idx) for idx in indices]
+
+    def _fetch_transition(self, idx):
+        """Fetch idx-th oldest experience"""
+        return self._fetch_transition_at(self._idx_to_position(idx))
+
+    def _fetch_transition_at(self, position):
+        """Fetch experience stored at passed position of the buffer"""
+        return tuple([_fetch_from_column(column, position) for column in self.columns])
+
+    def _idx_to_position(self, idx):
+        return (self.head - self.size + idx) % self.max_size
+
+class PrioritizedExperienceReplay(ExperienceReplay):
+    """ExperienceReplay which samples experiences in proportion to their
+    priorities, proposed in the paper "Prioritized Experience Replay".
+    (reference: https://arxiv.org/abs/1511.05952)
+
+    Priority of experience i is p_i = (|TD error of i| + epsilon) ^ alpha.
+    New experience gets the max priority seen so far to be replayed at least once.
+    Priorities are held in a sum-tree. So sampling and updating priority are
+    O(log N).
+
+    The bias by prioritized sampling is corrected by importance-sampling weight
+    w_i = (N * P(i)) ^ -beta which is normalized by max weight in the minibatch.
+    beta is annealed linearly from initial value to 1 in "beta_anneal_duration"
+    times of sampling.
+
+    DeepQLearning uses this memory by passing it as "replay_memory".
+    The weights are passed to "backup_on_weighted_minibatch" of value function.
+
+    "dump" returns (max_size, experiences, priorities, max_priority, beta).
+    Its first two items are the dump of ExperienceReplay, so ExperienceReplay
+    can load it (priorities are dropped). This memory can also load the dump of
+    ExperienceReplay. Then all experiences get the max priority.
+    """
+
+    # lower bound of sampling probability to keep weight (N * P(i)) ^ -beta finite
+    MIN_PROBABILITY = 1e-12
+
+    def __init__(self, max_size, alpha=0.6, beta=0.4, beta_anneal_duration=None,
+            epsilon=1e-6, column_dtypes=None):
+        """
+        Args:
+            max_size: capacity of replay memory
+            alpha: how much prioritization is used (0 means uniform sampling)
+            beta: initial degree of importance-sampling correction
+            beta_anneal_duration: number of sampling to anneal beta to 1.
+                                  beta is fixed if None.
+            epsilon: small value to avoid zero priority
+            column_dtypes: see ExperienceReplay
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_step = (1.0 - beta) / beta_anneal_duration if beta_anneal_duration else 0
+        self.epsilon = epsilon
+        super(PrioritizedExperienceReplay, self).__init__(max_size, column_dtypes)
+
+    def store_transition(self, state, action, reward, next_state):
+        self.sum_tree.update(self.head, self.max_priority)
+        super(PrioritizedExperienceReplay, self).store_transition(state, action, reward, next_state)
+
+    def sample_minibatch(self, minibatch_size):
+        return self.sample_weighted_minibatch(minibatch_size)[0]
+
+    def sample_weighted_minibatch(self, minibatch_size):
+        """Sample experiences in proportion to their priorities.
+        Sampling is stratified. Total priority is split into "minibatch_size"
+        segments and one experience is sampled from each segment.
+
+        Returns:
+            experience_minibatch: array of sampled experiences
+            positions: array of position of each experience in the buffer.
+                       Pass this to "update_priorities" with TD errors.
+            weights: array of importance-sampling weight of each experience
+        """
+        total = self.sum_tree.total()
+        segment = total / minibatch_size
+        positions = [self._find_position(random.uniform(segment * i, segment * (i + 1)))
+                for i in range(minibatch_size)]
+        probs = [max(self.sum_tree.get(position) / total, self.MIN_PROBABILITY) for position in positions]
+        weights = [(self.size * prob) ** -self.beta for prob in probs]
+        max_weight = max(weights)
+        weights = [weight / max_weight for weight in weights]
+        self.beta = min(1.0, self.beta + self.beta_step)
+        experience_minibatch = [self._fetch_transition_at(position) for position in positions]
+        return experience_minibatch, positions, weights
+
+    def update_priorities(self, positions, td_errors):
+        """Update priorities of experiences returned by "sample_weighted_minibatch" """
+        for position, td_error in zip(positions, td_errors):
+            priority = (abs(td_error) + self.epsilon) ** self.alpha
+            self.sum_tree.update(position, priority)
+            self.max_priority = max(self.max_priority, priority)
+
+    def dump(self):
+        priorities = [self.sum_tree.get(self._idx_to_position(idx)) for idx in range(self.size)]
+        return (self.max_size, self.queue, priorities, self.max_priority, self.beta)
+
+    def load(self, serial):
+        super(PrioritizedExperienceReplay, self).load(serial[:2])
+        if len(serial) == 2: return
+        _, _, priorities, max_priority, self.beta = serial
+        for idx, priority in enumerate(priorities):
+            self.sum_tree.update(self._idx_to_position(idx), priority)
+        self.max_priority = max_priority
+
+    def _allocate(self, max_size):
+        super(PrioritizedExperienceReplay, self)._allocate(max_size)
+        self.sum_tree = SumTree(max_size)
+        self.max_priority = 1.0
+
+    def _find_position(self, value):
+        # rounding error may lead to the leaf which is not filled yet
+        return min(self.sum_tree.find(value), self.size - 1)
+
+class ChunkedExperienceReplay(ExperienceReplay):
+    """Replay memory which keeps experiences in append-only chunk files on disk.
+
+    New experiences are stored into in-memory chunk of "chunk_size". When the
+    chunk gets full, it is sealed. Sealed chunk is written under
+    "store_dir_path" only once and never rewritten. Columns in "column_dtypes"
+    are saved as .npy and memory-mapped when they are read again. Other
+    columns are saved as consecutive pickles with their offsets, and the file
+    is memory-mapped to unpickle only the requested items. The newest
+    "nb_hot_chunk" sealed chunks are pinned in memory as hot window. Older
+    chunks are read from disk, once per chunk in a minibatch. So capacity of
+    memory is limited by disk, not by host memory.
+
+    Memory is FIFO in unit of chunk. When memory is full, the file of oldest
+    chunk is deleted. So size of memory is kept between
+    "max_size - chunk_size" and "max_size".
+
+    "dump" returns only the list of sealed chunks and unsealed experiences.
+    "save_files" hard-links (or copies if link is not possible) the files of
+    sealed chunks into checkpoint directory of DeepQLearning. So the chunks
+    deleted from "store_dir_path" later are kept in the checkpoint, and
+    "load_files" restores them into "store_dir_path" before "load".
+    """
+
+    CHUNK_FILE_NAME = "replay_chunk_%d_%s"
+
+    def __init__(self, max_size, store_dir_path, chunk_size=10000, nb_hot_chunk=2, column_dtypes=None):
+        """
+        Args:
+            max_size: capacity of replay memory. Must be multiple of chunk_size.
+            store_dir_path: directory to write chunk files. Created if not exists.
+            chunk_size: number of experiences in a chunk file
+            nb_hot_chunk: number of newest sealed chunks to hold in memory
+            column_dtypes: see ExperienceReplay
+        """
+        if max_size % chunk_size != 0:
+            raise ValueError("max_size (%d) must be multiple of chunk_size (%d)" % (max_size, chunk_size))
+        self.store_dir_path = store_dir_path
+        self.chunk_size = chunk_size
+        self.nb_hot_chunk = nb_hot_chunk
+        if not os.path.exists(store_dir_path): os.makedirs(store_dir_path)
+        super(ChunkedExperienceReplay, self).__init__(max_size, column_dtypes)
+
+    def store_transition(self, state, action, reward, next_state):
+        """Store new experience and delete oldest chunk if memory is full"""
+        if self.head == self.chunk_size:
+            self._seal_chunk()
+        if self.size == self.max_size:
+            self._delete_chunk(self.sealed_chunk_ids.pop(0))
+            self.size -= self.chunk_size
+        for column, value in zip(self.columns, (state, action, reward, next_state)):
+            column[self.head] = value
+        self.head += 1
+        self.size += 1
+        self.stored_count += 1
+
+    def dump(self):
+        unsealed = [self._fetch_transition_at(position) for position in range(self.head)]
+        return (self.max_size, self.chunk_size, list(self.sealed_chunk_ids),
+                self.next_chunk_id, self.stored_count, unsealed)
+
+    def load(self, serial):
+        """Restore memory from "dump". Sealed chunks are not read until needed.
+        Raises:
+            IOError: if a chunk file in the dump does not exist in "store_dir_path"
+        """
+        max_size, self.chunk_size, sealed_chunk_ids, next_chunk_id, stored_count, unsealed = serial
+        self._allocate(max_size)
+        for chunk_id in sealed_chunk_ids:
+            for field in self.FIELDS:
+                file_path = self._gen_chunk_file_path(chunk_id, field)
+                if not os.path.exists(file_path):
+                    raise IOError("Chunk file of replay memory [ %s ] is not found" % file_path)
+        self.sealed_chunk_ids = sealed_chunk_ids
+        self.next_chunk_id = next_chunk_id
+        self.size = len(sealed_chunk_ids) * self.chunk_size
+        for transition in unsealed:
+            self.store_transition(*transition)
+        self.stored_count = stored_count
+
+    def save_files(self, save_dir_path):
+        """Hard-link (or copy) the files of sealed chunks into passed directory"""
+        for chunk_id in self.sealed_chunk_ids:
+            for field in self.FIELDS:
+                file_path = self._gen_chunk_file_path(chunk_id, field)
+                _link_or_copy(file_path, os.path.join(save_dir_path, os.path.basename(file_path)))
+
+    def load_files(self, load_dir_path):
+        """Hard-link (or copy) the chunk files saved by "save_files" back into "store_dir_path" """
+        prefix = self.CHUNK_FILE_NAME.split("%")[0]
+        for file_name in os.listdir(load_dir_path):
+            if file_name.startswith(prefix):
+                _link_or_copy(os.path.join(load_dir_path, file_name),
+                        os.path.join(self.store_dir_path, file_name))
+
+    def _allocate(self, max_size):
+        self.max_size = max_size
+        self.sealed_chunk_ids = []
+        self.next_chunk_id = 0
+        self.hot_chunks = {}
+        self.columns = self._allocate_chunk()
+        self.head = 0
+        self.size = 0
+        self.stored_count = 0
+
+    def _allocate_chunk(self):
+        return [self._allocate_column(field, self.chunk_size) for field in self.FIELDS]
+
+    def _fetch_transitions(self, indices):
+        """Fetch experiences of passed indices. Indices in sealed chunks are
+        grouped by chunk, so each chunk is read once in this call.
+        """
+        sealed_size = len(self.sealed_chunk_ids) * self.chunk_size
+        transitions = [None] * len(indices)
+        positions_of_chunk = {}
+        for order, idx in enumerate(indices):
+            if idx >= sealed_size:
+                transitions[order] = self._fetch_transition_at(idx - sealed_size)
+            else:
+                positions_of_chunk.setdefault(idx // self.chunk_size, []).append((order, idx % self.chunk_size))
+        for chunk_idx, positions in positions_of_chunk.items():
+            chunk = self._read_chunk(self.sealed_chunk_ids[chunk_idx])
+            for order, position in positions:
+                transitions[order] = tuple([_fetch_from_column(column, position) for column in chunk])
+        return transitions
+
+    def _fetch_transition(self, idx):
+        """Fetch idx-th oldest experience from sealed chunks or unsealed chunk"""
+        return self._fetch_transitions([idx])[0]
+
+    def _seal_chunk(self):
+        chunk_id = self.next_chunk_id
+        for field, column in zip(self.FIELDS, self.columns):
+            file_path = self._gen_chunk_file_path(chunk_id, field)
+            tmp_file_path = file_path + ".tmp"
+            if isinstance(column, list):
+                _write_pickled_column(tmp_file_path, column)
+            else:
+                with open(tmp_file_path, "wb") as f: np.save(f, column)
+            os.rename(tmp_file_path, file_path)
+        self.sealed_chunk_ids.append(chunk_id)
+        self.next_chunk_id += 1
+        self._pin_hot_chunk(chunk_id, self.columns)
+        self.columns = self._allocate_chunk()
+        self.head = 0
+
+    def _read_chunk(self, chunk_id):
+        """Return the chunk from hot window, or read it from files. The chunk
+        read from files is pinned only if it is one of the newest chunks.
+        """
+        if chunk_id in self.hot_chunks:
+            return self.hot_chunks[chunk_id]
+        chunk = [self._read_column(chunk_id, field) for field in self.FIELDS]
+        if chunk_id in self._newest_chunk_ids():
+            self._pin_hot_chunk(chunk_id, chunk)
+        return chunk
+
+    def _read_column(self, chunk_id, field):
+        file_path = self._gen_chunk_file_path(chunk_id, field)
+        if field in self.column_dtypes:
+            return np.load(file_path, mmap_mode="r")
+        else:
+            return PickledColumnReader(file_path)
+
+    def _pin_hot_chunk(self, chunk_id, chunk):
+        self.hot_chunks[chunk_id] = chunk
+        newest_chunk_ids = self._newest_chunk_ids()
+        for hot_chunk_id in list(self.hot_chunks.keys()):
+            if hot_chunk_id not in newest_chunk_ids:
+                del self.hot_chunks[hot_chunk_id]
+
+    def _newest_chunk_ids(self):
+        return self.sealed_chunk_ids[max(0, len(self.sealed_chunk_ids) - self.nb_hot_chunk):]
+
+    def _delete_chunk(self, chunk_id):
+        self.hot_chunks.pop(chunk_id, None)
+        for field in self.FIELDS:
+            file_path = self._gen_chunk_file_path(chunk_id, field)
+            if os.path.exists(file_path): os.remove(file_path)
+
+    def _gen_chunk_file_path(self, chunk_id, field):
+        ext = ".npy" if field in self.column_dtypes else ".pickle"
+        return os.path.join(self.store_dir_path, self.CHUNK_FILE_NAME % (chunk_id, field) + ext)
+
+class PickledColumnReader(object):
+    """Read-only column of the file written by "_write_pickled_column".
+    The file is memory-mapped and only the item of passed position is
+    unpickled on each access.
+    """
+
+    FOOTER = struct.Struct("<q")
+
+    def __init__(self, file_path):
+        with open(file_path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset = self.FOOTER.unpack(self.data[-self.FOOTER.size:])[0]
+        self.offsets = pickle.loads(self.data[index_offset:-self.FOOTER.size])
+        self.offsets.append(index_offset)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        return pickle.loads(self.data[self.offsets[position]:self.offsets[position + 1]])
+
+def _write_pickled_column(file_path, column):
+    """Write items as consecutive pickles followed by the list of their
+    offsets and the offset of the list. (read by "PickledColumnReader")
+    """
+    offsets = []
+    with open(file_path, "wb") as f:
+        for item in column:
+            offsets.append(f.tell())
+            pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+        index_offset = f.tell()
+        pickle.dump(offsets, f, pickle.HIGHEST_PROTOCOL)
+        f.write(PickledColumnReader.FOOTER.pack(index_offset))
+
+def _link_or_copy(src_path, dst_path):
+    """Hard-link src_path to dst_path (copy if hard link is not possible).
+    Existing dst_path is replaced unless it is the same file.
+    """
+    if os.path.exists(dst_path):
+        if os.path.samefile(src_path, dst_path): return
+        os.remove(dst_path)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+class SumTree(object):
+    """Binary tree whose parent holds the sum of its children.
+    Leaves hold priorities. Updating a leaf and finding the leaf where
+    cumulative sum of priorities exceeds some value are O(log capacity).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # tree[1] is root, children of tree[i] are tree[2i] and tree[2i+1]
+        # and leaf of position p is tree[nb_leaf + p]. Leaves are padded to
+        # power of 2 to keep them in order of position.
+        self.nb_leaf = 1
+        while self.nb_leaf < capacity: self.nb_leaf *= 2
+        self.tree = [0.0] * (2 * self.nb_leaf)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, position):
+        return self.tree[self.nb_leaf + position]
+
+    def update(self, position, priority):
+        idx = self.nb_leaf + position
+        diff = priority - self.tree[idx]
+        while idx >= 1:
+            self.tree[idx] += diff
+            idx //= 2
+
+    def find(self, value):
+        """Return position of the leaf where cumulative sum reaches value"""
+        idx = 1
+        while idx < self.nb_leaf:
+            left = 2 * idx
+            if value < self.tree[left] or self.tree[left + 1] == 0:
+                idx = left
+            else:
+                value -= self.tree[left]
+                idx = left + 1
+        return idx - self.nb_leaf
+
+def _fetch_from_column(column, position):
+    if np is None or not isinstance(column, np.ndarray):
+        return column[position]
+    elif column.ndim == 1:
+        return column[position].item()
+    else:
+        return column[position].copy()
+
+def initialize_replay_memory(task, value_function, replay_memory, start_size, policy=None, nb_worker=1):
     """Fill passed replay memory with specified size of experience. Experience
     is created by generating episode with random policy until expected size
     of experience is corrected.
-    """
-    random_policy = EpsilonGreedyPolicy(eps=1.0)
-    while len(replay_memory.queue) < start_size:
-        episode = generate_episode(task, random_policy, value_function)
-        for state, action, next_state, reward in episode:
-            replay_memory.store_transition(state, action, reward, next_state)
-            if len(replay_memory.queue) >= start_size: return
-
-ACTION_ON_TERMINAL_FLG = "action_on_terminal"
-
-def choose_action(task, policy, value_function, state):
-    if task.is_terminal_state(state):
-        return ACTION_ON_TERMINAL_FLG
-    else:
-        return policy.choose_action(task, value_function, state)
 
-def predict_value(value_function, next_state, next_action):
-    if ACTION_ON_TERMINAL_FLG == next_action:
-        return 0
+    Default RandomPolicy does not use value function. So no prediction is done
+    during this initialization.
+    If nb_worker > 1, experiences are generated on forked worker processes
+    and stored in the order of workers.
+    """
+    policy = policy if policy else RandomPolicy()
+    nb_required = start_size - len(replay_memory)
+    if nb_required <= 0: return
+    context = (task, policy, value_function)
+    if nb_worker == 1:
+        transitions_list = [_generate_transitions(context, (None, nb_required))]
     else:
-        return value_function.predict_value(next_state, next_action)
+        sizes = [nb_required // nb_worker + (1 if idx < nb_required % nb_worker else 0)
+                for idx in range(nb_worker)]
+        args_list = [(random.randint(0, sys.maxint), size) for size in sizes if size > 0]
+        transitions_list = map_on_forked_workers(_generate_transitions, context, args_list, nb_worker)
+    for transitions in transitions_list:
+        for transition in transitions:
+            replay_memory.store_transition(*transition)
+
+def _generate_transitions(context, arg):
+    """Generate "size" of experiences by following the policy
+    Returns:
+        transitions: array of tuple (state, action, reward, next_state)
+    """
+    task, policy, value_function = context
+    seed, size = arg
+    if seed is not None: seed_random_generators(seed)
+    transitions = []
+    while True:
+        for state, action, next_state, reward in iterate_episode(task, policy, value_function):
+            transitions.append((state, action, reward, next_state))
+            if len(transitions) >= size: return transitions
+
+def predict_greedy_value(task, value_function, state):
+    """Return the value of greedy action at passed state by one batch prediction"""
+    return predict_greedy_values_on_batch(task, value_function, [state])[0]
+
+def predict_greedy_values_on_batch(task, value_function, states):
+    """Return the value of greedy action at each passed state.
+    Values of all state-action pairs are predicted by one call of
+    "value_function.predict_value_on_batch". Value of terminal state is 0.
+    """
+    nb_actions = []
+    state_action_pairs = []
+    for state in states:
+        actions = [] if task.is_terminal_state(state) else task.generate_possible_actions(state)
+        nb_actions.append(len(actions))
+        state_action_pairs += [(state, action) for action in actions]
+    values = value_function.predict_value_on_batch(state_action_pairs) if state_action_pairs else []
+    return _max_on_segments(values, nb_actions)
+
+def _max_on_segments(values, segment_sizes):
+    """Max of each consecutive segment of values. Max of empty segment is 0."""
+    if np is not None:
+        sizes = np.asarray(segment_sizes, dtype=np.int64)
+        maxes = np.zeros(len(sizes))
+        non_empty = sizes > 0
+        if non_empty.any():
+            offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+            maxes[non_empty] = np.maximum.reduceat(np.asarray(values, dtype=np.float64), offsets[non_empty])
+        return maxes.tolist()
+    maxes, offset = [], 0
+    for size in segment_sizes:
+        maxes.append(max(values[offset:offset+size]) if size != 0 else 0)
+        offset += size
+    return maxes
 
 def validate_value_function(value_function):
     value_function_check("DeepQLearning",
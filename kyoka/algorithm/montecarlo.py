@@ -1,8 +1,13 @@
 import os
+import sys
+import random
+import multiprocessing
+from collections import OrderedDict
 
-from kyoka.utils import pickle_data, unpickle_data, value_function_check
+from kyoka.utils import pickle_data, unpickle_data, value_function_check,\
+        ForkedWorkerPool, seed_random_generators
 from kyoka.value_function import BaseTabularActionValueFunction, BaseApproxActionValueFunction
-from kyoka.algorithm.rl_algorithm import BaseRLAlgorithm, generate_episode
+from kyoka.algorithm.rl_algorithm import BaseRLAlgorithm, iterate_episode
 
 
 class MonteCarlo(BaseRLAlgorithm):
@@ -10,6 +15,7 @@ class MonteCarlo(BaseRLAlgorithm):
 
     "Every-visit" means "using every state for update in an episode even if
     same state appeared in the episode".
+    (First-visit method is also available by "first_visit" option)
 
     Algorithm is implemented based on the book "Reinforcement Learning: An Introduction"
     (reference : https://webdocs.cs.ualberta.ca/~sutton/book/bookdraft2016sep.pdf)
@@ -26,7 +32,7 @@ class MonteCarlo(BaseRLAlgorithm):
             Q(S, A) <- average G of S sampled ever
     """
 
-    def __init__(self, gamma=1):
+    def __init__(self, gamma=1, first_visit=False):
         """
         If you want to discount future reward then set gamma < 1.
 
@@ -41,27 +47,147 @@ class MonteCarlo(BaseRLAlgorithm):
 
         Args:
             gamma : discount factor of reward. default=1. 0 < gamma <= 1.
+            first_visit : if True, use only first appearance of each
+                          state-action pair in an episode for update.
+                          (states and actions must be hashable)
          """
         self.gamma = gamma
+        self.first_visit = first_visit
 
     def setup(self, task, policy, value_function):
         validate_value_function(value_function)
         super(MonteCarlo, self).setup(task, policy, value_function)
 
     def run_gpi_for_an_episode(self, task, policy, value_function):
-        episode = generate_episode(task, policy, value_function)
-        for idx, turn_info in enumerate(episode):
-            state, action, _next_state, _reward = turn_info
-            following_reward = self._calculate_following_state_reward(idx, episode)
+        episode = iterate_episode(task, policy, value_function)
+        for state, action, following_reward in self._calculate_returns(episode):
             value_function.backup(state, action, following_reward, alpha="dummy")
 
-    def _calculate_following_state_reward(self, current_turn, episode):
-        following_turn_info = episode[current_turn:]
-        following_reward = [reward for _, _, _, reward in following_turn_info]
-        return sum([self.__discount(step, reward) for step, reward in enumerate(following_reward)])
+    def _calculate_returns(self, episode):
+        """Calculate (discounted) reward sum gained after each step of the episode.
 
-    def __discount(self, step, reward):
-        return self.gamma ** step * reward
+        Only (state, action, reward) of each step is kept while the episode is
+        consumed (next_state is dropped). Returns are accumulated in place by a
+        single reverse pass over that list.
+
+        Args:
+            episode: array or iterator of experiences (see "generate_episode")
+        Returns:
+            returns: array of tuple (state, action, following_reward) in the
+                     order of the episode. If first_visit option is True,
+                     only first appearance of each state-action pair is included.
+        """
+        returns = [(state, action, reward) for state, action, _next_state, reward in episode]
+        following_reward = 0
+        for idx in xrange(len(returns) - 1, -1, -1):
+            state, action, reward = returns[idx]
+            following_reward = reward + self.gamma * following_reward
+            returns[idx] = (state, action, following_reward)
+        if self.first_visit:
+            returns = self.__filter_first_visit(returns)
+        return returns
+
+    def __filter_first_visit(self, returns):
+        visited, first_visits = set(), []
+        for state, action, following_reward in returns:
+            if (state, action) not in visited:
+                visited.add((state, action))
+                first_visits.append((state, action, following_reward))
+        return first_visits
+
+class ParallelMonteCarlo(MonteCarlo):
+    """MonteCarlo method which generates episodes on multiple processes.
+
+    In each iteration of GPI, every worker process rolls out
+    "nb_episode_per_worker" episodes against the snapshot of value function
+    which the worker holds. Workers send back the aggregates of returns
+    (state, action, average of returns, number of returns) and they are
+    merged into the value function by "merge_returns" method.
+
+    Worker processes are kept during "run_gpi" and forked again (to take new
+    snapshot of value function) every "snapshot_interval" iterations.
+    So task, policy and value function do not need to be picklable but states
+    and actions must be picklable and hashable. Random module (and numpy.random)
+    is reseeded in each worker.
+
+    Note that one iteration of GPI generates
+    "nb_worker * nb_episode_per_worker" episodes. So nb_iteration of "run_gpi",
+    the target of WatchIterationCount, annealing of EpsilonAnnealer and
+    intervals of callbacks are counted in these batches of episodes.
+    """
+
+    def __init__(self, gamma=1, nb_worker=None, nb_episode_per_worker=10, first_visit=False,
+            snapshot_interval=10):
+        """
+        Args:
+            gamma : discount factor of reward. default=1. 0 < gamma <= 1.
+            nb_worker : number of worker processes. default=number of cpu.
+            nb_episode_per_worker : number of episodes which each worker
+                                    generates in an iteration of GPI.
+            first_visit : use only first appearance of each state-action pair.
+            snapshot_interval : fork workers again every this number of
+                                iterations. Small value keeps the snapshot
+                                fresh but pays the cost of forking more.
+        """
+        super(ParallelMonteCarlo, self).__init__(gamma, first_visit)
+        self.nb_worker = nb_worker if nb_worker else multiprocessing.cpu_count()
+        self.nb_episode_per_worker = nb_episode_per_worker
+        self.snapshot_interval = snapshot_interval
+        self.worker_pool = None
+        self.nb_iteration_on_snapshot = 0
+
+    def setup(self, task, policy, value_function):
+        value_function_check("ParallelMonteCarlo", [MonteCarloTabularActionValueFunction], value_function)
+        super(ParallelMonteCarlo, self).setup(task, policy, value_function)
+
+    def run_gpi(self, nb_iteration, callbacks=None, verbose=1):
+        try:
+            super(ParallelMonteCarlo, self).run_gpi(nb_iteration, callbacks, verbose)
+        finally:
+            self.close_worker_pool()
+
+    def run_gpi_for_an_episode(self, task, policy, value_function):
+        seeds = [random.randint(0, sys.maxint) for _ in range(self.nb_worker)]
+        context = (task, policy, value_function)
+        if self.nb_worker == 1:
+            results = [self._rollout_episodes(context, seed) for seed in seeds]
+        else:
+            results = self._prepare_worker_pool(context).map(seeds)
+            self.nb_iteration_on_snapshot += 1
+        for aggregates in results:
+            for state, action, average_return, count in aggregates:
+                value_function.merge_returns(state, action, average_return, count)
+
+    def close_worker_pool(self):
+        """Release worker processes. Called at the end of "run_gpi"."""
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+        self.worker_pool = None
+
+    def _prepare_worker_pool(self, context):
+        """Fork workers if not yet or their snapshot is older than snapshot_interval"""
+        if self.worker_pool is None or self.nb_iteration_on_snapshot >= self.snapshot_interval:
+            self.close_worker_pool()
+            self.worker_pool = ForkedWorkerPool(self._rollout_episodes, context, self.nb_worker)
+            self.worker_pool.open()
+            self.nb_iteration_on_snapshot = 0
+        return self.worker_pool
+
+    def _rollout_episodes(self, context, seed):
+        """Generate episodes on worker and aggregate returns of each state-action pair
+        Returns:
+            aggregates: array of tuple (state, action, average_return, count)
+        """
+        task, policy, value_function = context
+        seed_random_generators(seed)
+        return_stats = OrderedDict()
+        for _ in range(self.nb_episode_per_worker):
+            episode = iterate_episode(task, policy, value_function)
+            for state, action, following_reward in self._calculate_returns(episode):
+                return_sum, count = return_stats.get((state, action), (0, 0))
+                return_stats[(state, action)] = (return_sum + following_reward, count + 1)
+        return [(state, action, 1.0 * return_sum / count, count)
+                for (state, action), (return_sum, count) in return_stats.items()]
 
 class MonteCarloTabularActionValueFunction(BaseTabularActionValueFunction):
     """Tabular action value function for MonteCarlo method.
@@ -74,10 +200,11 @@ class MonteCarloTabularActionValueFunction(BaseTabularActionValueFunction):
     """
 
     SAVE_FILE_NAME = "montecarlo_update_counter.pickle"
+    DELTA_FILE_NAME = "montecarlo_update_counter_delta.pickle"
 
     def setup(self):
         super(MonteCarloTabularActionValueFunction, self).setup()
-        self.update_counter = self.generate_initial_table()
+        self.update_counter = self.generate_zero_table()
 
     def define_save_file_prefix(self):
         return "montecarlo"
@@ -94,19 +221,49 @@ class MonteCarloTabularActionValueFunction(BaseTabularActionValueFunction):
                     load_dir_path)
         self.update_counter = unpickle_data(self._gen_update_counter_file_path(load_dir_path))
 
+    def save_delta(self, save_dir_path):
+        super(MonteCarloTabularActionValueFunction, self).save_delta(save_dir_path)
+        delta = self._gen_delta(self.update_counter)
+        pickle_data(self._gen_update_counter_file_path(save_dir_path, self.DELTA_FILE_NAME), delta)
+
+    def load_delta(self, load_dir_path):
+        super(MonteCarloTabularActionValueFunction, self).load_delta(load_dir_path)
+        file_path = self._gen_update_counter_file_path(load_dir_path, self.DELTA_FILE_NAME)
+        if not os.path.exists(file_path):
+            raise IOError(
+                    'The saved delta of "MonteCarlo" algorithm is not found in [ %s ]' %
+                    load_dir_path)
+        self._apply_delta(self.update_counter, unpickle_data(file_path))
+
     def backup(self, state, action, backup_target, alpha):
         update_count = self.fetch_value_from_table(self.update_counter, state, action)
         Q_value = self.fetch_value_from_table(self.table, state, action)
         new_value = self._calc_average_in_incremental_way(update_count, backup_target, Q_value)
         self.insert_value_into_table(self.table, state, action, new_value)
         self.insert_value_into_table(self.update_counter, state, action, update_count+1)
+        self.mark_dirty(state, action)
+
+    def merge_returns(self, state, action, average_return, count):
+        """Merge the average of returns which are sampled outside (ex. on other process).
+        The result is same as calling "backup" for each of the returns.
+
+        Args:
+            average_return : average of the returns of passed state-action pair
+            count : the number of returns used to calculate average_return
+        """
+        update_count = self.fetch_value_from_table(self.update_counter, state, action)
+        Q_value = self.fetch_value_from_table(self.table, state, action)
+        new_value = Q_value + 1.0 * count / (update_count + count) * (average_return - Q_value)
+        self.insert_value_into_table(self.table, state, action, new_value)
+        self.insert_value_into_table(self.update_counter, state, action, update_count+count)
+        self.mark_dirty(state, action)
 
     def _calc_average_in_incremental_way(self, k, r, Q):
         """Memory efficient implementation to calculate average"""
         return Q + 1.0 / (k + 1) * (r - Q)
 
-    def _gen_update_counter_file_path(self, dir_path):
-        return os.path.join(dir_path, self.SAVE_FILE_NAME)
+    def _gen_update_counter_file_path(self, dir_path, file_name=None):
+        return os.path.join(dir_path, file_name if file_name else self.SAVE_FILE_NAME)
 
 class MonteCarloApproxActionValueFunction(BaseApproxActionValueFunction):
     """Approximation action value function for MonteCarlo method.
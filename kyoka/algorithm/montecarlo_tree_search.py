@@ -1,8 +1,17 @@
+import sys
 import random
 import math
+from collections import namedtuple
 
-from kyoka.utils import build_not_implemented_msg
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from kyoka.utils import build_not_implemented_msg, map_on_forked_workers, ForkedWorkerPool,\
+        seed_random_generators
 from kyoka.task import BaseTask
+from kyoka.callback import WatchIterationCount
 
 
 class BaseMCTS(object):
@@ -43,6 +52,15 @@ class BaseMCTS(object):
         self.playout_policy = random_playout
         self.last_calculated_tree = None
         self.finish_rule = None
+        self.reuse_tree = False
+        self.reuse_search_depth = 2
+        self.nb_planning_worker = 1
+        self.planning_worker_pool = None
+        self.keep_planning_workers = False
+        self.nb_playout_worker = 1
+        self.playout_worker_pool = None
+        self.keep_playout_workers = False
+        self.virtual_loss_reward = 0
 
     def generate_node_from_state(self, state):
         """Transform state of the task into Node(child class of BaseNode).
@@ -88,6 +106,102 @@ class BaseMCTS(object):
         """
         self.finish_rule = finish_rule
 
+    def set_tree_reuse(self, reuse_tree=True, search_depth=2):
+        """Reuse the tree of last "planning" call in next "planning" call.
+
+        If enabled, "planning" searches the node whose state equals (==) to
+        passed state in the last calculated tree within "search_depth" from its
+        root. If found, planning restarts from that node with its visit counts
+        and rewards. Other branches of last tree are released.
+        (ex. search_depth=2 finds the state after my action and opponent's action)
+        If not found, planning starts from fresh root node as usual.
+
+        Args:
+            reuse_tree: enable tree reuse if True
+            search_depth: max depth from last root to search the node of new state
+        """
+        self.reuse_tree = reuse_tree
+        self.reuse_search_depth = search_depth
+
+    def set_root_parallel(self, nb_worker, keep_workers=False):
+        """Run "planning" on nb_worker forked processes (root parallelization).
+
+        Each worker grows independent tree from the passed state with different
+        random seed. Then visit counts and average rewards of root edges are
+        merged by action over workers and the action is chosen from the merged
+        root. The tree of each worker is discarded. So "last_calculated_tree"
+        is the root node which has merged statistics (its child edges have no
+        child).
+
+        The finish rule is shared by workers in following way.
+            WatchIterationCount : target count is divided into workers
+            others (ex. time limit) : each worker runs until the rule says stop
+        Workers are forked. So your Node class and playout policy are used
+        on workers as they are (they do not need to be picklable). But state
+        and finish rule are sent to workers, so they must be picklable.
+        Tree reuse is not applied on workers.
+
+        By default workers are forked on each "planning" call. It costs about
+        0.1 second per call with 4 workers (on ticktacktoe) and time limit
+        rules start counting after it.
+        If keep_workers is True, workers are forked once and reused by following
+        "planning" calls until "close_workers" is called. Workers keep the copy
+        of this object at the fork. So call "set_root_parallel" again after you
+        change its settings (ex. playout policy).
+
+        Args:
+            nb_worker: number of worker processes. 1 runs planning in current process.
+            keep_workers: reuse worker processes between "planning" calls
+        """
+        self.close_workers()
+        self.nb_planning_worker = nb_worker
+        self.keep_planning_workers = keep_workers
+
+    def close_workers(self):
+        """Release worker processes kept by "set_root_parallel(keep_workers=True)"
+        or "set_tree_parallel(keep_workers=True)"
+        """
+        if self.planning_worker_pool is not None:
+            self.planning_worker_pool.close()
+        self.planning_worker_pool = None
+        if self.playout_worker_pool is not None:
+            self.playout_worker_pool.close()
+        self.playout_worker_pool = None
+
+    def set_tree_parallel(self, nb_worker, virtual_loss_reward=0, keep_workers=False):
+        """Run playouts of "planning" on nb_worker forked processes on one
+        shared tree (tree parallelization).
+
+        Selection, expansion and backpropagation are run in current process
+        one by one, and up to nb_worker playouts run on workers concurrently.
+        While playout is in progress, the edges on its path hold a "virtual
+        loss" (a visit with virtual_loss_reward, see "BaseEdge.add_virtual_loss").
+        So concurrent selections descend to different paths. The virtual loss
+        is reverted before real reward is backpropagated.
+
+        Playout policy receives "PlayoutLeaf" (which has only "state" property)
+        as leaf_node on workers. So state needs to be picklable.
+        Finish rule counts the started playouts, and planning waits playouts
+        in progress before it finishes.
+
+        Same as "set_root_parallel", workers are forked on each "planning" call
+        by default. If keep_workers is True, workers are forked once and reused
+        by following "planning" calls until "close_workers" is called. Workers
+        keep the copy of task and playout policy at the fork. So call
+        "set_tree_parallel" again after you change them.
+
+        Args:
+            nb_worker: number of playout workers. 1 runs playout in current process.
+            virtual_loss_reward: temporary reward of playout in progress. Set
+                                 the worst reward of your task (default 0 is
+                                 the loss when reward is in [0, 1]).
+            keep_workers: reuse worker processes between "planning" calls
+        """
+        self.close_workers()
+        self.nb_playout_worker = nb_worker
+        self.virtual_loss_reward = virtual_loss_reward
+        self.keep_playout_workers = keep_workers
+
     def choose_action(self, _task, _value_function, state):
         """Utility method for calling "planning" method in the common format of
         this library. If you use this method, you must call "set_finish_rule"
@@ -125,11 +239,26 @@ class BaseMCTS(object):
             AssertionError: if passed state is terminal state, nothing to do.
         """
         assert not self.task.is_terminal_state(state)
+        if self.nb_planning_worker > 1 and self.nb_playout_worker > 1:
+            raise ValueError("Root parallel and tree parallel cannot be used together.")
         _log_start_msg(finish_rule)
-        iteration_count = 0
+        if self.nb_planning_worker > 1:
+            tree, iteration_count = self._grow_tree_on_workers(state, finish_rule)
+        else:
+            tree = self._prepare_root_node(state)
+            iteration_count = self._grow_tree(tree, finish_rule)
+        self.last_calculated_tree = tree
+        _log_finish_msg(finish_rule, iteration_count)
+        return self._greedy_action(tree)
 
-        # TODO use last calculation result like AlphaGo
-        root_node = self.generate_node_from_state(state)
+    def _grow_tree(self, root_node, finish_rule):
+        """Run MCTS iterations on the tree until finish_rule says stop
+        Returns:
+            iteration_count: number of iterations run
+        """
+        if self.nb_playout_worker > 1:
+            return self._grow_tree_with_playout_workers(root_node, finish_rule)
+        iteration_count = 0
         while not finish_rule.check_condition(iteration_count, self.task, None):
             finish_rule.before_update(iteration_count, self.task, None)
 
@@ -144,11 +273,123 @@ class BaseMCTS(object):
 
             finish_rule.after_update(iteration_count, self.task, None)
             iteration_count += 1
+        return iteration_count
 
-        self.last_calculated_tree = root_node
-        _log_finish_msg(finish_rule, iteration_count)
+    def _grow_tree_with_playout_workers(self, root_node, finish_rule):
+        """Same as "_grow_tree" but playouts run on forked workers concurrently
+        with virtual loss on their paths.
+        """
+        if self.keep_playout_workers:
+            if self.playout_worker_pool is None:
+                self.playout_worker_pool = self._open_playout_worker_pool()
+            pool = self.playout_worker_pool
+        else:
+            pool = self._open_playout_worker_pool()
+        finished = False
+        try:
+            iteration_count = self._run_playouts_on_pool(pool, root_node, finish_rule)
+            finished = True
+            return iteration_count
+        finally:
+            if not self.keep_playout_workers:
+                pool.close()
+            elif not finished:
+                # results of abandoned playouts must not reach next "planning"
+                self.close_workers()
+
+    def _open_playout_worker_pool(self):
+        context = (self.task, self.playout_policy)
+        pool = ForkedWorkerPool(_playout_on_worker, context, self.nb_playout_worker)
+        pool.open()
+        return pool
+
+    def _run_playouts_on_pool(self, pool, root_node, finish_rule):
+        iteration_count = 0
+        playing_leaves = {}
+        while True:
+            while len(playing_leaves) < self.nb_playout_worker and\
+                    not finish_rule.check_condition(iteration_count, self.task, None):
+                finish_rule.before_update(iteration_count, self.task, None)
+                selected_node = self._select(root_node)
+                if self.task.is_terminal_state(selected_node.state):
+                    reward = self.task.calculate_reward(selected_node.state)
+                    self._backpropagation(selected_node, reward)
+                    finish_rule.after_update(iteration_count, self.task, None)
+                else:
+                    leaf_node = self._expand(selected_node)
+                    self._add_virtual_loss(leaf_node)
+                    pool.submit(iteration_count, (random.randint(0, sys.maxint), leaf_node.state))
+                    playing_leaves[iteration_count] = leaf_node
+                iteration_count += 1
+            if len(playing_leaves) == 0:
+                return iteration_count
+            playout_id, reward = pool.wait_result()
+            leaf_node = playing_leaves.pop(playout_id)
+            self._revert_virtual_loss(leaf_node)
+            self._backpropagation(leaf_node, reward)
+            finish_rule.after_update(playout_id, self.task, None)
+
+    def _add_virtual_loss(self, leaf_node):
+        for edge in _iterate_path_to_root(leaf_node):
+            edge.add_virtual_loss(self.virtual_loss_reward)
+
+    def _revert_virtual_loss(self, leaf_node):
+        for edge in _iterate_path_to_root(leaf_node):
+            edge.revert_virtual_loss(self.virtual_loss_reward)
+
+    def _grow_tree_on_workers(self, state, finish_rule):
+        """Grow independent trees from state on forked worker processes and
+        merge the statistics of their root edges into a new root.
+        Returns:
+            tree: root node which has merged statistics on its child edges
+            iteration_count: total number of iterations run on workers
+        """
+        finish_rules = _split_finish_rule(finish_rule, self.nb_planning_worker)
+        args_list = [(random.randint(0, sys.maxint), rule, state) for rule in finish_rules]
+        if self.keep_planning_workers:
+            if self.planning_worker_pool is None:
+                self.planning_worker_pool = ForkedWorkerPool(
+                        _grow_tree_on_worker, self, self.nb_planning_worker)
+                self.planning_worker_pool.open()
+            results = self.planning_worker_pool.map(args_list)
+        elif len(args_list) == 1:
+            # runs in current process, so do not reseed random state of the caller
+            results = [_grow_tree_on_worker(self, (None, finish_rules[0], state))]
+        else:
+            results = map_on_forked_workers(_grow_tree_on_worker, self, args_list, len(args_list))
+        tree = self._build_root(state)
+        actions = [action for action, _, _ in self._root_edge_stats(tree)]
+        self._set_root_edge_stats(tree, merge_root_edge_stats(actions, [stats for _, stats in results]))
+        return tree, sum([iteration_count for iteration_count, _ in results])
+
+    def _build_root(self, state):
+        """Build new tree which has only the root of passed state"""
+        return self.generate_node_from_state(state)
+
+    def _greedy_action(self, root_node):
         return root_node.greedy_edge.action
 
+    def _root_edge_stats(self, root_node):
+        """Array of (action, visit_count, average_reward) of child edges of the root"""
+        return [(edge.action, edge.visit_count, edge.average_reward) for edge in root_node.child_edges]
+
+    def _set_root_edge_stats(self, root_node, edge_stats):
+        """Set stats in the format of "_root_edge_stats" (in the same order of edges)"""
+        for edge, (_action, visit_count, average_reward) in zip(root_node.child_edges, edge_stats):
+            edge.visit_count = visit_count
+            edge.average_reward = average_reward
+            root_node.visit_count += visit_count
+
+    def _prepare_root_node(self, state):
+        """Reuse the node of state in last tree as root if tree reuse is enabled"""
+        if self.reuse_tree and self.last_calculated_tree is not None:
+            node = find_node_of_state(self.last_calculated_tree, state, self.reuse_search_depth)
+            self.last_calculated_tree = None
+            if node is not None:
+                node.parent_edge = None  # detach from last tree to release other branches
+                return node
+        return self._build_root(state)
+
     def _select(self, root_node):
         """Find terminal or not expanded node"""
         target_node = root_node
@@ -177,6 +418,75 @@ class BaseMCTS(object):
             target.parent_edge.update_by_new_reward(reward)
             target = target.parent_edge.parent_node
 
+def _iterate_path_to_root(leaf_node):
+    """Yield edges from parent edge of leaf_node to the root"""
+    edge = leaf_node.parent_edge
+    while edge:
+        yield edge
+        edge = edge.parent_node.parent_edge
+
+def _playout_on_worker(context, arg):
+    task, playout_policy = context
+    seed, state = arg
+    seed_random_generators(seed)
+    return playout_policy(task, PlayoutLeaf(state))
+
+def _grow_tree_on_worker(mcts, arg):
+    """Grow a fresh tree from state by forked copy of mcts and return its root stats"""
+    seed, finish_rule, state = arg
+    if seed is not None: seed_random_generators(seed)
+    tree = mcts._build_root(state)
+    iteration_count = mcts._grow_tree(tree, finish_rule)
+    return iteration_count, mcts._root_edge_stats(tree)
+
+def _split_finish_rule(finish_rule, nb_worker):
+    """Divide target count of WatchIterationCount into workers. Other finish
+    rules are used by every worker as they are.
+    """
+    if not isinstance(finish_rule, WatchIterationCount):
+        return [finish_rule] * nb_worker
+    target = finish_rule.target_count
+    shares = [target // nb_worker + (1 if idx < target % nb_worker else 0) for idx in range(nb_worker)]
+    shares = [share for share in shares if share > 0] or [0]
+    return [WatchIterationCount(share, verbose=0) for share in shares]
+
+def merge_root_edge_stats(actions, edge_stats_list):
+    """Merge root edge statistics of independent trees by action.
+
+    Args:
+        actions: actions of the root. Merged stats are returned in this order.
+        edge_stats_list: array of edge stats of each tree. Edge stats is array of
+                         (action, visit_count, average_reward) of root edges.
+    Returns:
+        edge_stats: (action, visit_count, average_reward) of each action.
+                    Visit counts are summed and average rewards are averaged
+                    with weight of visit counts.
+    Raises:
+        ValueError: if a tree has the action which is not in actions
+    """
+    visit_counts, reward_sums = [0] * len(actions), [0] * len(actions)
+    for edge_stats in edge_stats_list:
+        for action, visit_count, average_reward in edge_stats:
+            if action not in actions:
+                raise ValueError("Unknown action [ %s ] found in the tree of worker" % (action,))
+            idx = actions.index(action)
+            visit_counts[idx] += visit_count
+            reward_sums[idx] += visit_count * average_reward
+    return [(action, count, 1.0 * reward_sum / count if count != 0 else 0)
+            for action, count, reward_sum in zip(actions, visit_counts, reward_sums)]
+
+def find_node_of_state(root_node, state, max_depth):
+    """Search the node whose state equals (==) to passed state in breadth-first
+    order from root_node (depth 0) to max_depth. Return None if not found.
+    """
+    nodes = [root_node]
+    for _ in range(max_depth + 1):
+        for node in nodes:
+            if node.state == state:
+                return node
+        nodes = [edge.child_node for node in nodes for edge in node.child_edges if edge.has_child]
+    return None
+
 def random_playout(task, leaf_node, rand=random):
     """Default implmentation of playout policy of BaseMCTS.
     Simulation is played by the action choosed from possible actions
@@ -223,7 +533,11 @@ class BaseNode(object):
         terminal: boolean. True if state of this node is terminal.
         is_expanded: boolean. False if this node is possible to expand.
         has_unvisited_edge: boolean. True if one of edge.visit_count is 0.
-        visit_count: sum of visit counts of child edges
+        visit_count: sum of visit counts of child edges. This is updated
+                     incrementally by "BaseEdge.visit" of child edges.
+        log_visit_count: math.log(visit_count). Cached until visit_count changes.
+        nb_unvisited_edge: number of child edges which has no child node yet.
+                           This is updated by "BaseEdge.build_child".
     """
 
     def __init__(self, task, state):
@@ -232,6 +546,10 @@ class BaseNode(object):
         self.parent_edge = None
         self.child_edges = self.build_child_edges(task, state)
         self.terminal = task.is_terminal_state(state)
+        self.visit_count = 0
+        self.nb_unvisited_edge = len([edge for edge in self.child_edges if not edge.has_child])
+        self._log_visit_count = None
+        self._log_cached_visit_count = None
 
     def generate_edge(self, parent_node, action):
         """Define how to create Edge object from passed action
@@ -252,8 +570,16 @@ class BaseNode(object):
         raise NotImplementedError(err_msg)
 
     def select_best_edge(self):
-        """Define how to choose next node to descend in SELECT procedure"""
-        return sorted([edge for edge in self.child_edges], key=self._edge_sort_key)[-1]
+        """Define how to choose next node to descend in SELECT procedure.
+        Default choose the edge of max value by "_edge_sort_key" (the last
+        one if multiple edges have max value).
+        """
+        best_edge, best_value = None, None
+        for edge in self.child_edges:
+            value = self._edge_sort_key(edge)
+            if best_edge is None or value >= best_value:
+                best_edge, best_value = edge, value
+        return best_edge
 
     def _edge_sort_key(self, edge):
         return edge.calculate_value()
@@ -263,7 +589,7 @@ class BaseNode(object):
         return [self.generate_edge(self, action) for action in actions]
 
     def select_unvisited_edge(self):
-        return [edge for edge in self.child_edges if not edge.has_child][0]
+        return next(edge for edge in self.child_edges if not edge.has_child)
 
     @property
     def greedy_edge(self):
@@ -274,17 +600,20 @@ class BaseNode(object):
     @property
     def is_expanded(self):
         """boolean. False if this node is possible to expand."""
-        return not (self.terminal or self.has_unvisited_edge)
+        return not (self.terminal or self.nb_unvisited_edge != 0)
 
     @property
     def has_unvisited_edge(self):
         """boolean. True if one of edge.visit_count is 0."""
-        return any([not edge.has_child for edge in self.child_edges])
+        return self.nb_unvisited_edge != 0
 
     @property
-    def visit_count(self):
-        """sum of visit counts of child edges"""
-        return sum([edge.visit_count for edge in self.child_edges])
+    def log_visit_count(self):
+        """math.log(visit_count) which is recalculated only when visit_count changed"""
+        if self._log_cached_visit_count != self.visit_count:
+            self._log_visit_count = math.log(self.visit_count)
+            self._log_cached_visit_count = self.visit_count
+        return self._log_visit_count
 
 class BaseEdge(object):
     """Base class to build Edge class of tree for MCTS
@@ -327,12 +656,33 @@ class BaseEdge(object):
         raise NotImplementedError(err_msg)
 
     def build_child(self, state2node):
+        if not self.has_child:
+            self.parent_node.nb_unvisited_edge -= 1
         child_state = self.parent_node.task.transit_state(self.parent_node.state, self.action)
         self.child_node = state2node(child_state)
         self.child_node.parent_edge = self
 
     def visit(self):
+        """Count up visit count of this edge and total visit count of parent node"""
         self.visit_count += 1
+        self.parent_node.visit_count += 1
+
+    def add_virtual_loss(self, loss_reward):
+        """Count the playout in progress as a visit which received loss_reward.
+        This is used in tree parallel MCTS to make concurrent selections diverge.
+        """
+        self.visit()
+        self.update_by_new_reward(loss_reward)
+
+    def revert_virtual_loss(self, loss_reward):
+        """Cancel a visit and loss_reward added by "add_virtual_loss" """
+        assert self.visit_count != 0
+        self.visit_count -= 1
+        self.parent_node.visit_count -= 1
+        if self.visit_count == 0:
+            self.average_reward = 0
+        else:
+            self.average_reward += 1.0 * (self.average_reward - loss_reward) / self.visit_count
 
     def update_by_new_reward(self, new_reward):
         self.average_reward = self._calc_average_in_incremental_way(
@@ -379,6 +729,260 @@ class UCTEdge(BaseEdge):
         if self.visit_count == 0:
             explore_term = float('inf')
         else:
-            explore_term = math.sqrt(2 * math.log(self.parent_node.visit_count) / self.visit_count)
+            explore_term = math.sqrt(2 * self.parent_node.log_visit_count / self.visit_count)
         return self.average_reward + 2 * self.C * explore_term
 
+
+
+class ArrayTree(object):
+    """Search tree of MCTS stored in struct-of-arrays.
+
+    Nodes and edges are identified by integer ids and their properties are
+    held in numpy arrays indexed by the id. Arrays are allocated with
+    "initial_capacity" and doubled when they get full (up to "max_nodes"
+    for nodes).
+    Child edges of a node are allocated in a contiguous range
+    [first_edge[node], first_edge[node] + nb_edge[node]).
+
+    States are held only while they are needed. State of a node is released
+    when all of its edges are expanded (it is no longer used to build child
+    node). Terminal node holds only its reward.
+
+    Property:
+        nb_node: number of nodes in the tree. Root node is id 0.
+        nb_edge: number of edges in the tree
+        is_full: True if nb_node reaches max_nodes
+    """
+
+    NODE_ARRAYS = [
+            ("parent_edge", "int64"), ("first_edge", "int64"), ("nb_child_edge", "int32"),
+            ("nb_unvisited_edge", "int32"), ("node_visit_count", "int64"),
+            ("terminal", "bool"), ("terminal_reward", "float64"), ("states", "object")
+            ]
+
+    def __init__(self, max_nodes, initial_capacity=1024, action_dtype="object"):
+        """
+        Args:
+            max_nodes: node budget of the tree
+            initial_capacity: initial length of arrays
+            action_dtype: numpy dtype to store actions. Use numeric dtype
+                          (ex. "int32") to save memory if actions are numbers.
+        """
+        if np is None:
+            raise ImportError('"ArrayTree" requires numpy.')
+        self.max_nodes = max_nodes
+        self.action_dtype = action_dtype
+        self.nb_node = 0
+        self.nb_edge = 0
+        node_capacity = max(1, min(initial_capacity, max_nodes))
+        for name, dtype in self.NODE_ARRAYS:
+            setattr(self, name, np.empty(node_capacity, dtype=dtype))
+        edge_capacity = max(1, initial_capacity)
+        self.edge_parent = np.empty(edge_capacity, dtype="int64")
+        self.child_node = np.empty(edge_capacity, dtype="int64")
+        self.actions = np.empty(edge_capacity, dtype=action_dtype)
+        self.edge_visit_count = np.empty(edge_capacity, dtype="int64")
+        self.average_reward = np.empty(edge_capacity, dtype="float64")
+
+    @property
+    def is_full(self):
+        return self.nb_node >= self.max_nodes
+
+    def add_node(self, task, state, parent_edge):
+        """Add node of passed state as child of parent_edge (-1 for root)
+        Returns:
+            node_id: id of added node
+        Raises:
+            AssertionError: if tree is full
+        """
+        assert not self.is_full
+        node = self.nb_node
+        if node == len(self.parent_edge):
+            self._grow_node_arrays()
+        terminal = task.is_terminal_state(state)
+        actions = [] if terminal else task.generate_possible_actions(state)
+        first_edge = self._allocate_edges(node, actions)
+        self.parent_edge[node] = parent_edge
+        self.first_edge[node] = first_edge
+        self.nb_child_edge[node] = len(actions)
+        self.nb_unvisited_edge[node] = len(actions)
+        self.node_visit_count[node] = 0
+        self.terminal[node] = terminal
+        self.terminal_reward[node] = task.calculate_reward(state) if terminal else 0
+        self.states[node] = None if terminal else state
+        if parent_edge != -1:
+            self.child_node[parent_edge] = node
+            parent = self.edge_parent[parent_edge]
+            self.nb_unvisited_edge[parent] -= 1
+            if self.nb_unvisited_edge[parent] == 0:
+                self.states[parent] = None
+        self.nb_node += 1
+        return node
+
+    def action_of(self, edge):
+        action = self.actions[edge]
+        return action.item() if isinstance(action, np.generic) else action
+
+    def edge_range(self, node):
+        first = self.first_edge[node]
+        return first, first + self.nb_child_edge[node]
+
+    def find_unvisited_edge(self, node):
+        first, end = self.edge_range(node)
+        return first + int(np.argmax(self.child_node[first:end] == -1))
+
+    def backpropagate(self, edge, reward):
+        """Update edges from passed edge to root by the reward"""
+        while edge != -1:
+            self.edge_visit_count[edge] += 1
+            old_value = self.average_reward[edge]
+            self.average_reward[edge] = old_value + 1.0 / self.edge_visit_count[edge] * (reward - old_value)
+            parent = self.edge_parent[edge]
+            self.node_visit_count[parent] += 1
+            edge = self.parent_edge[parent]
+
+    def _allocate_edges(self, node, actions):
+        first, end = self.nb_edge, self.nb_edge + len(actions)
+        while end > len(self.edge_parent):
+            for name in ["edge_parent", "child_node", "actions", "edge_visit_count", "average_reward"]:
+                setattr(self, name, _grow_array(getattr(self, name), 2 * len(self.edge_parent)))
+        self.edge_parent[first:end] = node
+        self.child_node[first:end] = -1
+        for idx, action in enumerate(actions):
+            self.actions[first + idx] = action
+        self.edge_visit_count[first:end] = 0
+        self.average_reward[first:end] = 0
+        self.nb_edge = end
+        return first
+
+    def _grow_node_arrays(self):
+        capacity = min(2 * len(self.parent_edge), self.max_nodes)
+        for name, _ in self.NODE_ARRAYS:
+            setattr(self, name, _grow_array(getattr(self, name), capacity))
+
+def _grow_array(array, capacity):
+    grown = np.empty(capacity, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+PlayoutLeaf = namedtuple("PlayoutLeaf", ["state"])
+
+class ArrayUCTSearch(BaseMCTS):
+    """UCT search on compact tree (ArrayTree) instead of Node and Edge objects.
+
+    Selection, expansion and backpropagation run on integer ids of the
+    ArrayTree. So memory and allocation cost per node is much smaller than
+    UCTNode and UCTEdge.
+    You do not need to implement "generate_node_from_state". Override
+    "select_edge" if you want other selection than UCT
+    (ex. choose minimum value at the node of opponent turn).
+
+    When number of nodes reaches "max_nodes", the tree stops growing and
+    simulation is started from the state after the selected edge without
+    adding new node.
+
+    Playout policy receives "PlayoutLeaf" (which has only "state" property)
+    as leaf_node. Tree reuse and tree parallel are not supported ("planning"
+    raises ValueError if they are enabled).
+    """
+
+    ROOT = 0
+
+    def __init__(self, task, max_nodes=1000000, C=0.7071067811865475, action_dtype="object"):
+        """
+        Args:
+            task: task object to apply MCTS method
+            max_nodes: node budget of the search tree
+            C: hyper parameter of UCT (see UCTEdge)
+            action_dtype: numpy dtype to store actions (see ArrayTree)
+        """
+        super(ArrayUCTSearch, self).__init__(task)
+        self.max_nodes = max_nodes
+        self.C = C
+        self.action_dtype = action_dtype
+
+    def generate_node_from_state(self, state):
+        raise NotImplementedError('"ArrayUCTSearch" does not use node objects.')
+
+    def planning(self, state, finish_rule):
+        """Same as BaseMCTS.planning
+        Raises:
+            ValueError: if tree reuse or tree parallel is enabled
+        """
+        if self.reuse_tree:
+            raise ValueError('"ArrayUCTSearch" does not support tree reuse.')
+        if self.nb_playout_worker > 1:
+            raise ValueError('"ArrayUCTSearch" does not support tree parallel.')
+        return super(ArrayUCTSearch, self).planning(state, finish_rule)
+
+    def _build_root(self, state):
+        tree = ArrayTree(self.max_nodes, action_dtype=self.action_dtype)
+        tree.add_node(self.task, state, -1)
+        return tree
+
+    def _grow_tree(self, tree, finish_rule):
+        iteration_count = 0
+        while not finish_rule.check_condition(iteration_count, self.task, None):
+            finish_rule.before_update(iteration_count, self.task, None)
+            leaf_edge, reward = self._simulate(tree, self.ROOT)
+            tree.backpropagate(leaf_edge, reward)
+            finish_rule.after_update(iteration_count, self.task, None)
+            iteration_count += 1
+        return iteration_count
+
+    def _greedy_action(self, tree):
+        return tree.action_of(self._greedy_edge(tree, self.ROOT))
+
+    def _root_edge_stats(self, tree):
+        first, end = tree.edge_range(self.ROOT)
+        actions = [tree.action_of(edge) for edge in range(first, end)]
+        return zip(actions, tree.edge_visit_count[first:end].tolist(), tree.average_reward[first:end].tolist())
+
+    def _set_root_edge_stats(self, tree, edge_stats):
+        first, end = tree.edge_range(self.ROOT)
+        for edge, (_action, visit_count, average_reward) in zip(range(first, end), edge_stats):
+            tree.edge_visit_count[edge] = visit_count
+            tree.average_reward[edge] = average_reward
+            tree.node_visit_count[self.ROOT] += visit_count
+
+    def select_edge(self, tree, node):
+        """Choose the edge to descend from the node by UCT value.
+        Unvisited edge has infinite value. Last edge is chosen if multiple
+        edges have max value (same as BaseNode.select_best_edge).
+        Returns:
+            edge_id: id of selected edge in the tree
+        """
+        first, end = tree.edge_range(node)
+        visit_counts = tree.edge_visit_count[first:end]
+        log_N = math.log(tree.node_visit_count[node]) if tree.node_visit_count[node] != 0 else 0
+        explore_term = np.sqrt(2 * log_N / np.maximum(visit_counts, 1))
+        explore_term[visit_counts == 0] = float('inf')
+        values = tree.average_reward[first:end] + 2 * self.C * explore_term
+        return end - 1 - int(np.argmax(values[::-1]))
+
+    def _simulate(self, tree, root):
+        """Descend the tree from root, expand a node and run playout
+        Returns:
+            leaf_edge: edge to start backpropagation
+            reward: reward of simulation
+        """
+        node = root
+        while True:
+            if tree.terminal[node]:
+                return tree.parent_edge[node], tree.terminal_reward[node]
+            if tree.nb_unvisited_edge[node] != 0 and not tree.is_full:
+                edge = tree.find_unvisited_edge(node)
+                child_state = self.task.transit_state(tree.states[node], tree.action_of(edge))
+                tree.add_node(self.task, child_state, edge)
+                return edge, self.playout_policy(self.task, PlayoutLeaf(child_state))
+            edge = self.select_edge(tree, node)
+            if tree.child_node[edge] == -1:
+                # tree is full. simulate without adding node.
+                child_state = self.task.transit_state(tree.states[node], tree.action_of(edge))
+                return edge, self.playout_policy(self.task, PlayoutLeaf(child_state))
+            node = tree.child_node[edge]
+
+    def _greedy_edge(self, tree, node):
+        """Edge of highest average reward (first one if multiple edges have it)"""
+        first, end = tree.edge_range(node)
+        return first + int(np.argmax(tree.average_reward[first:end]))
@@ -1,8 +1,8 @@
 import os
 
 from kyoka.utils import value_function_check
-from kyoka.policy import GreedyPolicy
-from kyoka.value_function import BaseTabularActionValueFunction, BaseApproxActionValueFunction
+from kyoka.value_function import BaseTabularActionValueFunction, BaseApproxActionValueFunction,\
+        ActionValueCache
 from kyoka.algorithm.rl_algorithm import BaseRLAlgorithm
 
 
@@ -51,17 +51,15 @@ class QLearning(BaseRLAlgorithm):
     def setup(self, task, policy, value_function):
         validate_value_function(value_function)
         super(QLearning, self).setup(task, policy, value_function)
-        self.greedy_policy = GreedyPolicy()
 
     def run_gpi_for_an_episode(self, task, policy, value_function):
         state = task.generate_initial_state()
         action = policy.choose_action(task, value_function, state)
         while not task.is_terminal_state(state):
             next_state = task.transit_state(state, action)
-            next_action = choose_action(task, policy, value_function, next_state)
+            next_action, greedy_Q_value = choose_action_with_greedy_value(
+                    task, policy, value_function, next_state)
             reward = task.calculate_reward(next_state)
-            greedy_action = choose_action(task, self.greedy_policy, value_function, next_state)
-            greedy_Q_value = predict_value(value_function, next_state, greedy_action)
             backup_target = reward + self.gamma * greedy_Q_value
             value_function.backup(state, action, backup_target, self.alpha)
             state, action = next_state, next_action
@@ -81,6 +79,7 @@ class QLearningTabularActionValueFunction(BaseTabularActionValueFunction):
         Q_value = self.predict_value(state, action)
         new_Q_value = Q_value + alpha * (backup_target - Q_value)
         self.insert_value_into_table(self.table, state, action, new_Q_value)
+        self.mark_dirty(state, action)
 
 class QLearningApproxActionValueFunction(BaseApproxActionValueFunction):
     """Approximation action value function for QLearning.
@@ -94,17 +93,18 @@ class QLearningApproxActionValueFunction(BaseApproxActionValueFunction):
 
 ACTION_ON_TERMINAL_FLG = "action_on_terminal"
 
-def choose_action(task, policy, value_function, state):
+def choose_action_with_greedy_value(task, policy, value_function, state):
+    """Choose action at passed state by policy and return it with the value of
+    greedy action at the state.
+    Values of the actions are predicted only once (by batch prediction) and
+    shared between the policy and the greedy backup target.
+    """
     if task.is_terminal_state(state):
-        return ACTION_ON_TERMINAL_FLG
-    else:
-        return policy.choose_action(task, value_function, state)
-
-def predict_value(value_function, next_state, next_action):
-    if ACTION_ON_TERMINAL_FLG == next_action:
-        return 0
-    else:
-        return value_function.predict_value(next_state, next_action)
+        return ACTION_ON_TERMINAL_FLG, 0
+    actions = task.generate_possible_actions(state)
+    values = value_function.predict_value_on_batch([(state, action) for action in actions])
+    action = policy.choose_action(task, ActionValueCache(value_function, state, actions, values), state)
+    return action, max(values)
 
 def validate_value_function(value_function):
     value_function_check("QLearning",
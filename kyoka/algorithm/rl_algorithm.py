@@ -1,6 +1,10 @@
+import sys
+
 from kyoka.utils import build_not_implemented_msg
-from kyoka.policy import EpsilonGreedyPolicy
-from kyoka.callback import EpsilonAnnealer, WatchIterationCount
+from kyoka.policy import EpsilonGreedyPolicy, BoltzmannPolicy
+from kyoka.value_function import ActionValueCache
+from kyoka.callback import BaseCallback, EpsilonAnnealer, TemperatureAnnealer,\
+        WatchIterationCount, build_hook_dispatch_list
 
 
 def generate_episode(task, policy, value_function):
@@ -16,15 +20,67 @@ def generate_episode(task, policy, value_function):
                   Last item(experience) of next_state(3rd element of experience)
                   must be terminal state.
     """
+    return list(iterate_episode(task, policy, value_function))
+
+def iterate_episode(task, policy, value_function):
+    """Generator version of "generate_episode".
+    Experiences are yielded one by one without holding the whole episode.
+
+    Args:
+        task: Task object which represents some RL problem
+        policy : generate episode by following this policy
+        value_function : choose action by following this value function
+    Yields:
+        experience : tuple of (state, action, next_state, reward)
+    """
     state = task.generate_initial_state()
-    episode = []
     while not task.is_terminal_state(state):
         action = policy.choose_action(task, value_function, state)
         next_state = task.transit_state(state, action)
         reward = task.calculate_reward(next_state)
-        episode.append((state, action, next_state, reward))
+        yield (state, action, next_state, reward)
         state = next_state
-    return episode
+
+def generate_episodes_in_lockstep(tasks, policy, value_function):
+    """Generate an episode for each passed task by advancing them together.
+
+    Action values of all active tasks are predicted by one call of
+    "value_function.predict_value_on_batch" in each step. So this method is
+    much faster than calling "generate_episode" for each task when the value
+    function has large overhead on each prediction (ex. neuralnetwork).
+    The task whose episode finished drops out and others keep going.
+
+    Args:
+        tasks: array of independent task objects (ex. copies of same task)
+        policy : generate episodes by following this policy
+        value_function : choose action by following this value function
+    Returns:
+        episodes : array of episode in the same order of passed tasks.
+                   Format of each episode is same as "generate_episode".
+    """
+    states = [task.generate_initial_state() for task in tasks]
+    episodes = [[] for _ in tasks]
+    active_ids = [idx for idx, task in enumerate(tasks) if not task.is_terminal_state(states[idx])]
+    while len(active_ids) != 0:
+        actions_list = [tasks[idx].generate_possible_actions(states[idx]) for idx in active_ids]
+        state_action_pairs = [(states[idx], action)
+                for idx, actions in zip(active_ids, actions_list) for action in actions]
+        values = value_function.predict_value_on_batch(state_action_pairs)
+
+        next_active_ids, offset = [], 0
+        for idx, actions in zip(active_ids, actions_list):
+            task, state = tasks[idx], states[idx]
+            cache = ActionValueCache(value_function, state, actions, values[offset:offset+len(actions)])
+            offset += len(actions)
+            action = policy.choose_action(task, cache, state)
+            next_state = task.transit_state(state, action)
+            reward = task.calculate_reward(next_state)
+            episodes[idx].append((state, action, next_state, reward))
+            states[idx] = next_state
+            if not task.is_terminal_state(next_state):
+                next_active_ids.append(idx)
+        active_ids = next_active_ids
+    return episodes
 
 class BaseRLAlgorithm(object):
     """Base class for all of offline RL algorithms.
@@ -62,6 +118,29 @@ class BaseRLAlgorithm(object):
         self.value_function.load(load_dir_path)
         self.load_algorithm_state(load_dir_path)
 
+    def save_delta(self, save_dir_path):
+        """Save only the changes of value function and state of algorithm
+        since last "clear_delta" call.
+        Args:
+            save_dir_path: items are saved under this directory
+        """
+        self.value_function.save_delta(save_dir_path)
+        self.save_algorithm_state_delta(save_dir_path)
+
+    def load_delta(self, load_dir_path):
+        """Apply the changes saved by "save_delta" on current items.
+        Args:
+            load_dir_path: this should be the path you passed "save_delta"
+                           as save_dir_path
+        """
+        self.value_function.load_delta(load_dir_path)
+        self.load_algorithm_state_delta(load_dir_path)
+
+    def clear_delta(self):
+        """Start tracking the changes which will be saved by next "save_delta" call"""
+        self.value_function.clear_delta()
+        self.clear_algorithm_state_delta()
+
     def save_algorithm_state(self, save_dir_path):
         """If algorithm uses some state variables in the training save it.
         Args:
@@ -78,6 +157,22 @@ class BaseRLAlgorithm(object):
         """
         pass
 
+    def save_algorithm_state_delta(self, save_dir_path):
+        """Save the changes of state of algorithm since last
+        "clear_algorithm_state_delta" call. Default saves whole state.
+        """
+        self.save_algorithm_state(save_dir_path)
+
+    def load_algorithm_state_delta(self, load_dir_path):
+        """Apply the changes saved by "save_algorithm_state_delta".
+        Default loads whole state.
+        """
+        self.load_algorithm_state(load_dir_path)
+
+    def clear_algorithm_state_delta(self):
+        """Start tracking the changes of state of algorithm"""
+        pass
+
     def run_gpi_for_an_episode(self, task, policy, value_function):
         """Define how to update value function for an episode."""
         err_msg = build_not_implemented_msg(self, "run_gpi_for_an_episode")
@@ -97,34 +192,53 @@ class BaseRLAlgorithm(object):
         default_finish_rule = WatchIterationCount(nb_iteration, verbose)
         callbacks = self.__setup_callbacks(default_finish_rule, callbacks)
         [callback.before_gpi_start(self.task, self.value_function) for callback in callbacks]
+        error_hooks = build_hook_dispatch_list(callbacks, "after_gpi_error")
+        try:
+            self.__run_gpi_iterations(callbacks, default_finish_rule)
+        except Exception:
+            # keep the original error because the hooks may handle errors inside
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            for _callback, hook, _interval in error_hooks:
+                hook(self.task, self.value_function)
+            raise exc_type, exc_value, exc_traceback
+
+    def __run_gpi_iterations(self, callbacks, default_finish_rule):
+        before_update_hooks, after_update_hooks, interrupt_hooks = [
+                build_hook_dispatch_list(callbacks, hook) for hook in BaseCallback.PER_ITERATION_HOOKS]
 
         iteration_counter = 1
         while True:
-            [callback.before_update(iteration_counter, self.task, self.value_function) for callback in callbacks]
+            for _callback, hook, interval in before_update_hooks:
+                if iteration_counter % interval == 0:
+                    hook(iteration_counter, self.task, self.value_function)
             self.run_gpi_for_an_episode(self.task, self.policy, self.value_function)
-            [callback.after_update(iteration_counter, self.task, self.value_function) for callback in callbacks]
-            for finish_rule in callbacks:
-                if finish_rule.interrupt_gpi(iteration_counter, self.task, self.value_function):
+            for _callback, hook, interval in after_update_hooks:
+                if iteration_counter % interval == 0:
+                    hook(iteration_counter, self.task, self.value_function)
+            for finish_rule, hook, interval in interrupt_hooks:
+                if iteration_counter % interval == 0 and\
+                        hook(iteration_counter, self.task, self.value_function):
                     [callback.after_gpi_finish(self.task, self.value_function) for callback in callbacks]
                     if finish_rule != default_finish_rule:
                         default_finish_rule.log(default_finish_rule.generate_finish_message(iteration_counter))
                     return
             iteration_counter += 1
 
-
     def __check_setup_call(self):
         """Raise exception with message if run_gpi is called without setup"""
         if not all([hasattr(self, attr) for attr in ["task", "value_function", "policy"]]):
             raise Exception('You need to call "setup" method before calling "run_gpi" method.')
 
     def __setup_callbacks(self, default_finish_rule, user_callbacks):
-        """Add EpsilonAnnealer if needed and put default_callback
-        at top of callback list.
+        """Add EpsilonAnnealer or TemperatureAnnealer if needed and put
+        default_callback at top of callback list.
         """
         user_callbacks = self.__wrap_item_if_single(user_callbacks)
         default_callbacks = [default_finish_rule]
         if isinstance(self.policy, EpsilonGreedyPolicy) and self.policy.do_annealing:
             default_callbacks.append(EpsilonAnnealer(self.policy))
+        if isinstance(self.policy, BoltzmannPolicy) and self.policy.do_annealing:
+            default_callbacks.append(TemperatureAnnealer(self.policy))
         return default_callbacks + user_callbacks
 
     def __wrap_item_if_single(self, item):
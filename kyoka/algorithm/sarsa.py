@@ -1,7 +1,8 @@
 import os
 
 from kyoka.utils import value_function_check
-from kyoka.value_function import BaseTabularActionValueFunction, BaseApproxActionValueFunction
+from kyoka.value_function import BaseTabularActionValueFunction, BaseApproxActionValueFunction,\
+        ActionValueCache
 from kyoka.algorithm.rl_algorithm import BaseRLAlgorithm, generate_episode
 
 
@@ -51,9 +52,8 @@ class Sarsa(BaseRLAlgorithm):
         action = policy.choose_action(task, value_function, state)
         while not task.is_terminal_state(state):
             next_state = task.transit_state(state, action)
-            next_action = choose_action(task, policy, value_function, next_state)
+            next_action, next_Q_value = choose_action_with_value(task, policy, value_function, next_state)
             reward = task.calculate_reward(next_state)
-            next_Q_value = predict_value(value_function, next_state, next_action)
             backup_target = reward + self.gamma * next_Q_value
             value_function.backup(state, action, backup_target, self.alpha)
             state, action = next_state, next_action
@@ -73,6 +73,7 @@ class SarsaTabularActionValueFunction(BaseTabularActionValueFunction):
         Q_value = self.predict_value(state, action)
         new_Q_value = Q_value + alpha * (backup_target - Q_value)
         self.insert_value_into_table(self.table, state, action, new_Q_value)
+        self.mark_dirty(state, action)
 
 class SarsaApproxActionValueFunction(BaseApproxActionValueFunction):
     """Approximation action value function for Sarsa.
@@ -86,17 +87,18 @@ class SarsaApproxActionValueFunction(BaseApproxActionValueFunction):
 
 ACTION_ON_TERMINAL_FLG = "action_on_terminal"
 
-def choose_action(task, policy, value_function, state):
+def choose_action_with_value(task, policy, value_function, state):
+    """Choose action at passed state and return it with its value.
+    Values of the actions are predicted only once (by batch prediction) and
+    shared between the policy and the backup target.
+    """
     if task.is_terminal_state(state):
-        return ACTION_ON_TERMINAL_FLG
-    else:
-        return policy.choose_action(task, value_function, state)
-
-def predict_value(value_function, next_state, next_action):
-    if ACTION_ON_TERMINAL_FLG == next_action:
-        return 0
-    else:
-        return value_function.predict_value(next_state, next_action)
+        return ACTION_ON_TERMINAL_FLG, 0
+    actions = task.generate_possible_actions(state)
+    values = value_function.predict_value_on_batch([(state, action) for action in actions])
+    cache = ActionValueCache(value_function, state, actions, values)
+    action = policy.choose_action(task, cache, state)
+    return action, cache.predict_value(state, action)
 
 def validate_value_function(value_function):
     value_function_check("Sarsa",
@@ -1,5 +1,9 @@
 import os
+import math
 import time
+import timeit
+import traceback
+from collections import OrderedDict
 
 from utils import build_not_implemented_msg
 
@@ -14,9 +18,16 @@ class BaseCallback(object):
     before_update : called before each call of RLalgorithm.run_gpi_for_an_episode
     after_update : called after each call of RLalgorithm.run_gpi_for_an_episode
     after_gpi_finish : called when training is finished
+    after_gpi_error : called when exception is raised during training (before it is re-raised)
     interrupt_gpi : called after each update is finished to judge if finish the training
+
+    "before_update", "after_update" and "interrupt_gpi" are called on every
+    iteration of GPI. You can skip calling them by
+    "define_implemented_hooks" and "define_callback_interval".
     """
 
+    PER_ITERATION_HOOKS = ["before_update", "after_update", "interrupt_gpi"]
+
     def before_gpi_start(self, task, value_function):
         pass
 
@@ -29,10 +40,33 @@ class BaseCallback(object):
     def after_gpi_finish(self, task, value_function):
         pass
 
+    def after_gpi_error(self, task, value_function):
+        """Release what the callback set up in "before_gpi_start" if needed.
+        "after_gpi_finish" is not called when training stopped by exception.
+        """
+        pass
+
     def interrupt_gpi(self, iteration_count, task, value_function):
         """Return True if you want to stop the training."""
         return False
 
+    def define_implemented_hooks(self):
+        """Define names of per-iteration hooks which this callback implements.
+        Hooks not included in here are never called in GPI.
+
+        Default implementation returns the hooks overridden in child class.
+        """
+        return [hook for hook in self.PER_ITERATION_HOOKS if _is_overridden(self, hook)]
+
+    def define_callback_interval(self):
+        """Define interval of iteration to call per-iteration hooks.
+
+        For example, if you return 10 then "after_update" is called
+        after 10th, 20th, 30th... update of training.
+        This method is called after "before_gpi_start".
+        """
+        return 1
+
     def define_log_tag(self):
         """Define tag string which displayed with log message.
 
@@ -50,8 +84,46 @@ class BaseCallback(object):
         if message and len(message) != 0:
             print "[%s] %s" % (self.tag, message)
 
+def _is_overridden(callback, method_name):
+    method = getattr(callback.__class__, method_name)
+    base_method = getattr(BaseCallback, method_name)
+    return getattr(method, "__func__", method) is not getattr(base_method, "__func__", base_method)
+
+def build_hook_dispatch_list(callbacks, hook_name):
+    """Pick up the callbacks which implement passed hook.
+
+    Per-iteration hooks are picked up by "define_implemented_hooks" with the
+    interval of "define_callback_interval". Other hooks (ex. "after_gpi_error")
+    are picked up if the callback overrides them, with interval 1.
+    Objects which do not inherit BaseCallback are regarded as implementing
+    all of hooks with interval 1.
+
+    Returns:
+        dispatch_list: array of tuple (callback, bound hook method, interval)
+    Raises:
+        ValueError: if "define_callback_interval" does not return positive int
+    """
+    dispatch_list = []
+    for callback in callbacks:
+        if isinstance(callback, BaseCallback) and hook_name not in BaseCallback.PER_ITERATION_HOOKS:
+            if not _is_overridden(callback, hook_name): continue
+            interval = 1
+        elif isinstance(callback, BaseCallback):
+            if hook_name not in callback.define_implemented_hooks(): continue
+            interval = callback.define_callback_interval()
+            if isinstance(interval, bool) or not isinstance(interval, (int, long)) or interval <= 0:
+                raise ValueError('[ %s ] returned invalid callback interval [ %s ]. It must be positive int.'
+                        % (callback.__class__.__name__, interval))
+        else:
+            interval = 1
+        dispatch_list.append((callback, getattr(callback, hook_name), interval))
+    return dispatch_list
+
 class BasePerformanceWatcher(BaseCallback):
     """Utility class to execute some calculation with intermediate result of training.
+
+    Per-iteration hooks of this class are called only on the interval defined
+    in "define_performance_test_interval".
     """
 
     def setUp(self, task, value_function):
@@ -83,6 +155,9 @@ class BasePerformanceWatcher(BaseCallback):
         base_msg = "Performance test result : %s (nb_iteration=%d)"
         return base_msg % (test_result, iteration_count)
 
+    def define_callback_interval(self):
+        return self.test_interval
+
 
     def before_gpi_start(self, task, value_function):
         self.performance_log = []
@@ -124,6 +199,31 @@ class EpsilonAnnealer(BaseCallback):
             finish_msg = "Annealing has finished at %d iteration." % iteration_count
             self.log(finish_msg)
 
+class TemperatureAnnealer(BaseCallback):
+    """Callback to decay temperature of BoltzmannPolicy during training."""
+
+    def __init__(self, boltzmann_policy):
+        """
+        Args:
+            boltzmann_policy: target to execute temperature annealing.
+        """
+        self.policy = boltzmann_policy
+        self.anneal_finished = False
+
+    def define_log_tag(self):
+        return "BoltzmannAnnealing"
+
+    def before_gpi_start(self, _task, _value_function):
+        start_msg = "Anneal temperature from %s to %s." % (self.policy.temperature, self.policy.min_temperature)
+        self.log(start_msg)
+
+    def after_update(self, iteration_count, _task, _value_function):
+        self.policy.anneal_temperature()
+        if not self.anneal_finished and self.policy.temperature == self.policy.min_temperature:
+            self.anneal_finished = True
+            finish_msg = "Annealing has finished at %d iteration." % iteration_count
+            self.log(finish_msg)
+
 class LearningRecorder(BaseCallback):
     """Callback to save intermediate result of training.
 
@@ -135,18 +235,52 @@ class LearningRecorder(BaseCallback):
 
     training_results/after_100_iteration/...
                     /after_200_iteration/...
+
+    If you also set full_save_interval=500, algorithm is saved fully only on
+    start of training and every 500 iteration. Other checkpoints save only the
+    changes since previous checkpoint by "algorithm.save_delta".
+
+    training_results/after_0_iteration/...
+                    /after_100_iteration_delta/...
+                    ...
+                    /after_400_iteration_delta/...
+                    /after_500_iteration/...
+
+    Use "load_checkpoint" to restore the algorithm from these checkpoints.
+
+    If you set background=True, each checkpoint is saved by forked child
+    process. The child saves the snapshot of the algorithm at the time of fork
+    (by copy-on-write of OS) and fsyncs the files while training goes on.
+    If "max_in_flight" saves are still running, next checkpoint waits for the
+    oldest one. Error in the child process is raised at later "after_update"
+    or "after_gpi_finish" call. If GPI stops by exception, running saves are
+    waited and their errors are logged. (Fork is not safe if your value
+    function uses threads internally. ex. some backends of neuralnetwork library.)
     """
 
-    def __init__(self, algorithm, root_save_dir_path, save_interval):
+    def __init__(self, algorithm, root_save_dir_path, save_interval, full_save_interval=None,
+            background=False, max_in_flight=1):
         """
         Args:
             algorithm: the RL algorithm which will be used in training.
             root_save_dir_path: save method is executed under this path of directory.
             save_interval: interval of training to execute save method.
+            full_save_interval: interval of training to save algorithm fully.
+                                Must be multiple of save_interval. If None,
+                                algorithm is saved fully on every checkpoint.
+            background: save checkpoints in forked child processes if True.
+            max_in_flight: max number of checkpoints saved in background at once.
         """
+        if full_save_interval is not None and full_save_interval % save_interval != 0:
+            raise ValueError("full_save_interval (%d) must be multiple of save_interval (%d)"
+                    % (full_save_interval, save_interval))
         self.algorithm = algorithm
         self.root_save_dir_path = root_save_dir_path
         self.save_interval = save_interval
+        self.full_save_interval = full_save_interval
+        self.background = background
+        self.max_in_flight = max_in_flight
+        self.in_flight_saves = []
 
     def before_gpi_start(self, _task, _value_function):
         if not os.path.exists(self.root_save_dir_path):
@@ -154,28 +288,282 @@ class LearningRecorder(BaseCallback):
             raise Exception(err_msg  % self.root_save_dir_path)
         base_msg = 'Your algorithm will be saved after each %d iteration on directory [ %s ].'
         self.log(base_msg % (self.save_interval, self.root_save_dir_path))
+        if self.full_save_interval is not None:
+            self.log("Only the changes are saved except every %d iteration." % self.full_save_interval)
+            self._save_checkpoint(self.define_checkpoint_save_dir_name(0), delta=False)
 
     def after_update(self, iteration_count, _task, _value_function):
+        if len(self.in_flight_saves) != 0:
+            self._collect_background_saves(block=False)
         if iteration_count % self.save_interval == 0:
-            dir_name = self.define_checkpoint_save_dir_name(iteration_count)
-            save_path = os.path.join(self.root_save_dir_path, dir_name)
-            os.mkdir(save_path)
-            self.algorithm.save(save_path)
-            base_msg = "Saved algorithm after %d iteration at [ %s ]."
+            if self._is_delta_checkpoint(iteration_count):
+                save_path = self._save_checkpoint(
+                        self.define_delta_save_dir_name(iteration_count), delta=True)
+                base_msg = "Saved changes of algorithm after %d iteration at [ %s ]."
+            else:
+                save_path = self._save_checkpoint(
+                        self.define_checkpoint_save_dir_name(iteration_count), delta=False)
+                base_msg = "Saved algorithm after %d iteration at [ %s ]."
+            if self.background: base_msg = base_msg.replace("Saved", "Started to save")
             self.log(base_msg % (iteration_count, save_path))
 
     def after_gpi_finish(self, task, value_function):
-        dir_name = self.define_finish_save_dir_name()
-        save_path = os.path.join(self.root_save_dir_path, dir_name)
-        os.mkdir(save_path)
-        self.algorithm.save(save_path)
+        self._save_checkpoint(self.define_finish_save_dir_name(), delta=False)
+        self._collect_background_saves(block=True)
+
+    def after_gpi_error(self, _task, _value_function):
+        """Wait the checkpoints still saved in background and log the failed
+        ones. (They are not raised to keep the error of GPI.)
+        """
+        while len(self.in_flight_saves) != 0:
+            try:
+                self._collect_background_saves(block=True, nb_collect=1)
+            except Exception as e:
+                self.log(str(e))
+
+    def load_checkpoint(self, iteration_count):
+        """Restore the algorithm to the checkpoint after passed iteration.
+        Latest full checkpoint until the iteration is loaded, and then
+        the delta checkpoints after it are applied in order.
+
+        Args:
+            iteration_count: iteration count of the checkpoint to restore
+        """
+        checkpoints = range(0, iteration_count + 1, self.save_interval)
+        gen_path = lambda dir_name: os.path.join(self.root_save_dir_path, dir_name)
+        full_path = lambda count: gen_path(self.define_checkpoint_save_dir_name(count))
+        full_saved = [count for count in checkpoints if os.path.exists(full_path(count))]
+        if len(full_saved) == 0:
+            raise IOError("Full checkpoint until %d iteration is not found in [ %s ]"
+                    % (iteration_count, self.root_save_dir_path))
+        self.algorithm.load(full_path(full_saved[-1]))
+        for count in checkpoints:
+            if count > full_saved[-1]:
+                self.algorithm.load_delta(gen_path(self.define_delta_save_dir_name(count)))
 
     def define_checkpoint_save_dir_name(self, iteration_count):
         return "after_%d_iteration" % iteration_count
 
+    def define_delta_save_dir_name(self, iteration_count):
+        return "after_%d_iteration_delta" % iteration_count
+
     def define_finish_save_dir_name(self):
         return "gpi_finished"
 
+    def _is_delta_checkpoint(self, iteration_count):
+        return self.full_save_interval is not None and iteration_count % self.full_save_interval != 0
+
+    def _save_checkpoint(self, dir_name, delta):
+        save_path = os.path.join(self.root_save_dir_path, dir_name)
+        os.mkdir(save_path)
+        save = self.algorithm.save_delta if delta else self.algorithm.save
+        if self.background:
+            self._start_background_save(save, save_path)
+        else:
+            save(save_path)
+        if self.full_save_interval is not None:
+            self.algorithm.clear_delta()
+        return save_path
+
+    def _start_background_save(self, save, save_path):
+        while len(self.in_flight_saves) >= self.max_in_flight:
+            self._collect_background_saves(block=True, nb_collect=1)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            exit_status = 0
+            try:
+                save(save_path)
+                _fsync_directory(save_path)
+            except BaseException:
+                os.write(write_fd, traceback.format_exc())
+                exit_status = 1
+            finally:
+                os._exit(exit_status)
+        os.close(write_fd)
+        self.in_flight_saves.append((pid, read_fd, save_path))
+
+    def _collect_background_saves(self, block, nb_collect=None):
+        """Wait finished child processes in order of start and raise the error
+        happened in them. If block is False, stop at the first running one.
+        """
+        collected = 0
+        while len(self.in_flight_saves) != 0 and (nb_collect is None or collected < nb_collect):
+            pid, read_fd, save_path = self.in_flight_saves[0]
+            if block:
+                err_msg = _read_until_eof(read_fd)
+                _, status = os.waitpid(pid, 0)
+            else:
+                finished_pid, status = os.waitpid(pid, os.WNOHANG)
+                if finished_pid == 0: return
+                err_msg = _read_until_eof(read_fd)
+            os.close(read_fd)
+            self.in_flight_saves.pop(0)
+            collected += 1
+            if status != 0:
+                raise Exception("Failed to save algorithm at [ %s ] in background.\n%s"
+                        % (save_path, err_msg))
+
+def _read_until_eof(fd):
+    chunks = []
+    while True:
+        chunk = os.read(fd, 4096)
+        if not chunk: return "".join(chunks)
+        chunks.append(chunk)
+
+def _fsync_directory(dir_path):
+    """fsync all files under passed directory and the directory itself"""
+    for root, dir_names, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            fd = os.open(os.path.join(root, file_name), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class ComponentProfiler(BaseCallback):
+    """Callback to measure where the time goes in the training.
+
+    While GPI runs, methods of task, policy and value function which are set
+    to the algorithm are wrapped by timer. Call count and histogram of latency
+    of each method are recorded, and the breakdown is logged every
+    "report_interval" iterations and when GPI finishes.
+    (Time of a method includes the time of methods called inside it.
+     ex. "backup" of tabular value function calls "predict_value".)
+
+    Property:
+        stats: dict of "component.method" to LatencyStats object
+    """
+
+    PROFILE_TARGETS = [
+            ("task", ["transit_state", "generate_possible_actions", "is_terminal_state", "calculate_reward"]),
+            ("policy", ["choose_action"]),
+            ("value_function", ["predict_value", "predict_value_on_batch", "backup"])
+            ]
+
+    def __init__(self, algorithm, report_interval=None):
+        """
+        Args:
+            algorithm: the RL algorithm which will be used in training.
+            report_interval: interval of training to log the breakdown. If None,
+                             the breakdown is logged only when GPI finishes.
+        """
+        self.algorithm = algorithm
+        self.report_interval = report_interval
+        self.stats = OrderedDict()
+        self.wrapped_methods = []
+
+    def define_log_tag(self):
+        return "Profiler"
+
+    def define_implemented_hooks(self):
+        return ["after_update"] if self.report_interval else []
+
+    def define_callback_interval(self):
+        return self.report_interval
+
+    def before_gpi_start(self, _task, _value_function):
+        self.start_time = _profile_timer()
+        for component_name, method_names in self.PROFILE_TARGETS:
+            component = getattr(self.algorithm, component_name)
+            for method_name in method_names:
+                if hasattr(component, method_name):
+                    self.__wrap_method(component, component_name, method_name)
+
+    def after_update(self, iteration_count, _task, _value_function):
+        self.log(self.generate_report("after %d iterations" % iteration_count))
+
+    def after_gpi_finish(self, _task, _value_function):
+        self.log(self.generate_report("GPI finished"))
+        self.restore_methods()
+
+    def after_gpi_error(self, _task, _value_function):
+        self.restore_methods()
+
+    def restore_methods(self):
+        """Remove timers from wrapped methods. Calling this twice is harmless."""
+        for component, method_name, has_own_attr, original in reversed(self.wrapped_methods):
+            if has_own_attr:
+                setattr(component, method_name, original)
+            else:
+                delattr(component, method_name)
+        self.wrapped_methods = []
+
+    def generate_report(self, title):
+        elapsed = _profile_timer() - self.start_time
+        lines = ["Time breakdown %s (total %.3fs)" % (title, elapsed)]
+        ordered = sorted(self.stats.items(), key=lambda item: item[1].total_time, reverse=True)
+        for name, stats in ordered:
+            if stats.call_count == 0: continue
+            share = 100.0 * stats.total_time / elapsed if elapsed > 0 else 0
+            base_msg = "  %s : %.1f%% (calls=%d, total=%.3fs, mean=%.1fus, p50<%.1fus, p99<%.1fus)"
+            lines.append(base_msg % (name, share, stats.call_count, stats.total_time,
+                1e6 * stats.mean, 1e6 * stats.percentile(50), 1e6 * stats.percentile(99)))
+        return "\n".join(lines)
+
+    def __wrap_method(self, component, component_name, method_name):
+        key = "%s.%s" % (component_name, method_name)
+        stats = self.stats.setdefault(key, LatencyStats())
+        has_own_attr = method_name in getattr(component, "__dict__", {})
+        original = getattr(component, method_name)
+        setattr(component, method_name, _wrap_with_timer(original, stats))
+        self.wrapped_methods.append((component, method_name, has_own_attr, original))
+
+# highest resolution timer available (time.perf_counter is python3 only)
+_profile_timer = getattr(time, "perf_counter", timeit.default_timer)
+
+def _wrap_with_timer(method, stats):
+    timer = _profile_timer
+    def timed_method(*args, **kwargs):
+        start = timer()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats.record(timer() - start)
+    return timed_method
+
+class LatencyStats(object):
+    """Call count and latency histogram of a method.
+
+    Latency is counted in the buckets of power of 2 seconds. (bucket "e" holds
+    the latency in range [2**(e-1), 2**e) seconds.) So recording is cheap and
+    percentile is reported as upper bound of the bucket. Latency shorter than
+    the resolution of the timer (recorded as 0) goes into the smallest bucket.
+    """
+
+    # smallest bucket holds the latency under 2**-30 seconds (about 1ns)
+    MIN_BUCKET = -30
+
+    def __init__(self):
+        self.call_count = 0
+        self.total_time = 0.0
+        self.histogram = {}
+
+    def record(self, elapsed):
+        self.call_count += 1
+        self.total_time += elapsed
+        bucket = max(math.frexp(elapsed)[1], self.MIN_BUCKET) if elapsed > 0 else self.MIN_BUCKET
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    @property
+    def mean(self):
+        return self.total_time / self.call_count if self.call_count != 0 else 0
+
+    def percentile(self, percent):
+        """Return upper bound of latency of passed percentile (ex. 99)"""
+        threshold, count = self.call_count * percent / 100.0, 0
+        for bucket in sorted(self.histogram):
+            count += self.histogram[bucket]
+            if count >= threshold:
+                return math.ldexp(1.0, bucket)
+        return 0
+
 class BaseFinishRule(BaseCallback):
     """Base class to define the rule to stop the training.
 
@@ -275,6 +663,9 @@ class WatchIterationCount(BaseFinishRule):
     def define_log_tag(self):
         return "Progress"
 
+    def define_implemented_hooks(self):
+        return super(WatchIterationCount, self).define_implemented_hooks() if self.verbose > 0 else ["interrupt_gpi"]
+
     def check_condition(self, iteration_count, task, value_function):
         return iteration_count >= self.target_count
 
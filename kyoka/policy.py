@@ -1,6 +1,13 @@
+import math
 import random
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from kyoka.utils import build_not_implemented_msg
+from kyoka.value_function import DenseTabularActionValueFunction
 
 
 def choose_best_action(task, value_function, state, rand=None):
@@ -11,15 +18,37 @@ def choose_best_action(task, value_function, state, rand=None):
         value_function : used to calculate value of each action
         state : greedy action is selected from possible actions of this state
     """
-    rand = rand if rand else random
     actions = task.generate_possible_actions(state)
-    Q_value_for_actions = [value_function.predict_value(state, action) for action in actions]
+    return choose_best_action_from(value_function, state, actions, rand)
+
+def choose_best_action_from(value_function, state, actions, rand=None):
+    """Calculate greedy action from passed actions by using passed value function
+
+    Values of all actions are predicted by one call of
+    "value_function.predict_value_on_batch". (DenseTabularActionValueFunction
+    chooses the action by argmax on its table instead.)
+
+    Args:
+        value_function : used to calculate value of each action
+        state : the state where passed actions are possible
+        actions : greedy action is selected from these actions
+    """
+    rand = rand if rand else random
+    if isinstance(value_function, DenseTabularActionValueFunction):
+        return value_function.choose_greedy_action(state, actions, rand)
+    Q_value_for_actions = predict_action_values(value_function, state, actions)
     max_Q_value = max(Q_value_for_actions)
     Q_act_pair = zip(Q_value_for_actions, actions)
     best_actions = [act for Q_value, act in Q_act_pair if max_Q_value == Q_value]
     best_action = rand.choice(best_actions)
     return best_action
 
+def predict_action_values(value_function, state, actions):
+    """Predict values of passed actions at the state by one call of
+    "value_function.predict_value_on_batch"
+    """
+    return value_function.predict_value_on_batch([(state, action) for action in actions])
+
 class BasePolicy(object):
     """Base class for creating new Policy as you like.
 
@@ -47,9 +76,25 @@ class GreedyPolicy(BasePolicy):
     def choose_action(self, task, value_function, state):
         return choose_best_action(task, value_function, state, self.rand)
 
+class RandomPolicy(BasePolicy):
+    """Choose action uniformly at random. Value function is never used."""
+
+    def __init__(self, rand=None):
+        """Args:
+            rand : rand.choice is used to choose action.
+                   Default is random module of python module.
+        """
+        self.rand = rand if rand else random
+
+    def choose_action(self, task, value_function, state):
+        return self.rand.choice(task.generate_possible_actions(state))
+
 class EpsilonGreedyPolicy(BasePolicy):
     """Choose explore action in probability epsilon else choose best action
 
+    Explore action is chosen uniformly from all possible actions (best action
+    included). Value function is used only when best action is chosen.
+
     If you want to decaly epsilon (most of the case it's good idea) during training,
     call "set_eps_annealing" before start training.
 
@@ -65,10 +110,10 @@ class EpsilonGreedyPolicy(BasePolicy):
 
     def choose_action(self, task, value_function, state):
         actions = task.generate_possible_actions(state)
-        best_action = choose_best_action(task, value_function, state, self.rand)
-        probs = self.__calc_select_probability(best_action, actions)
-        selected_action_idx = self.__roulette(probs)
-        return actions[selected_action_idx]
+        if self.rand.random() < self.eps:
+            return self.rand.choice(actions)
+        else:
+            return choose_best_action_from(value_function, state, actions, self.rand)
 
     def set_eps_annealing(self, initial_eps, final_eps, anneal_duration):
         """Call this method enables epsilon annealing in training
@@ -86,20 +131,65 @@ class EpsilonGreedyPolicy(BasePolicy):
     def anneal_eps(self):
         self.eps = max(self.min_eps, self.eps - self.anneal_step)
 
-    def __calc_select_probability(self, best_action, actions):
-        e = self.eps / len(actions)
-        bonus = 1 - self.eps
-        calc_prob = lambda action: e + bonus if action == best_action else e
-        return [calc_prob(action) for action in actions]
-
-    def __roulette(self, probs):
-        hit_idx = -1
-        prob_sum = 0
-        dart = self.rand.random()
-        for idx, prob in enumerate(probs):
-            prob_sum += prob
-            if dart < prob_sum:
-                hit_idx = idx
-                break
-        return hit_idx
+class BoltzmannPolicy(BasePolicy):
+    """Choose action in probability of softmax of action values
+
+    P(a) = exp(Q(s,a) / temperature) / sum of exp(Q(s,b) / temperature)
+
+    High temperature makes choice close to uniform and low temperature makes
+    it close to greedy. Values of all actions are predicted by one call of
+    "value_function.predict_value_on_batch".
+
+    If you want to decay temperature during training, call
+    "set_temperature_annealing" before start training.
+
+    Properties:
+        temperature : temperature of softmax. Must be positive.
+        rand : rand.random() is used to sample action
+    """
+
+    def __init__(self, temperature=1.0, rand=None):
+        self.temperature = temperature
+        self.rand = rand if rand else random
+        self.do_annealing = False
+
+    def choose_action(self, task, value_function, state):
+        actions = task.generate_possible_actions(state)
+        Q_value_for_actions = predict_action_values(value_function, state, actions)
+        cumulative_weights = self.__calc_cumulative_weights(Q_value_for_actions)
+        dart = self.rand.random() * cumulative_weights[-1]
+        for action, cumulative_weight in zip(actions, cumulative_weights):
+            if dart < cumulative_weight:
+                return action
+        return actions[-1]
+
+    def set_temperature_annealing(self, initial_temperature, final_temperature, anneal_duration):
+        """Call this method enables temperature annealing in training
+
+        Args:
+            initial_temperature: Override temperature passed in constructor
+            final_temperature: Temperature is decayed from initial_temperature
+                               to final_temperature through anneal_duration
+            anneal_duration: Temperature is uniformly decayed through this duration
+        """
+        self.do_annealing = True
+        self.temperature = initial_temperature
+        self.min_temperature = final_temperature
+        self.anneal_step = 1.0 * (initial_temperature - final_temperature) / anneal_duration
 
+    def anneal_temperature(self):
+        self.temperature = max(self.min_temperature, self.temperature - self.anneal_step)
+
+    def __calc_cumulative_weights(self, Q_value_for_actions):
+        """Cumulative sum of unnormalized softmax weights.
+        Max value is subtracted before exp to avoid overflow.
+        """
+        if np is not None:
+            values = np.asarray(Q_value_for_actions, dtype=np.float64)
+            return np.cumsum(np.exp((values - values.max()) / self.temperature)).tolist()
+        max_Q_value = max(Q_value_for_actions)
+        cumulative_weights, weight_sum = [], 0
+        for Q_value in Q_value_for_actions:
+            weight_sum += math.exp((Q_value - max_Q_value) / float(self.temperature))
+            cumulative_weights.append(weight_sum)
+        return cumulative_weights
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 from utils import build_not_implemented_msg
 
 
@@ -59,3 +61,134 @@ class BaseTask(object):
         err_msg = build_not_implemented_msg(self, "calculate_reward")
         raise NotImplementedError(err_msg)
 
+
+
+class CachedTask(BaseTask):
+    """Wrapper of task which memoizes the results of task methods.
+
+    The results of following methods are cached in LRU caches of bounded size.
+    - is_terminal_state
+    - generate_possible_actions
+    - transit_state
+    So wrap the task only if these methods are deterministic.
+    (Returned actions are shared between calls. So do not modify them.)
+
+    Other attributes are delegated to wrapped task. If your task mutates its
+    rule during training (ex. changes the maze), call "clear_cache" after that.
+
+    States and actions must be hashable to be cached. The call with unhashable
+    item is just delegated to wrapped task.
+
+        task = CachedTask(MyTask(), max_size=100000)
+    """
+
+    def __init__(self, task, max_size=100000):
+        """
+        Args:
+            task: the task to wrap
+            max_size: max number of items which each cache holds. 0 disables caching.
+        """
+        self.task = task
+        self.max_size = max_size
+        self.clear_cache()
+
+    def clear_cache(self):
+        """Invalidate all of cached results"""
+        self.caches = {
+                "is_terminal_state": LRUCache(self.max_size),
+                "generate_possible_actions": LRUCache(self.max_size),
+                "transit_state": LRUCache(self.max_size)
+                }
+
+    def cache_info(self):
+        """
+        Returns:
+            info: dict of method name to tuple of (hit_count, miss_count, size)
+        """
+        return dict([(name, (cache.hit_count, cache.miss_count, len(cache)))
+            for name, cache in self.caches.items()])
+
+    @property
+    def hit_count(self):
+        return sum([cache.hit_count for cache in self.caches.values()])
+
+    @property
+    def miss_count(self):
+        return sum([cache.miss_count for cache in self.caches.values()])
+
+    def generate_initial_state(self):
+        return self.task.generate_initial_state()
+
+    def is_terminal_state(self, state):
+        return self.__fetch("is_terminal_state", state, self.task.is_terminal_state, state)
+
+    def transit_state(self, state, action):
+        return self.__fetch("transit_state", (state, action), self.task.transit_state, state, action)
+
+    def generate_possible_actions(self, state):
+        return self.__fetch("generate_possible_actions", state, self.task.generate_possible_actions, state)
+
+    def calculate_reward(self, state):
+        return self.task.calculate_reward(state)
+
+    def __getattr__(self, name):
+        if name == "task": raise AttributeError(name)
+        return getattr(self.task, name)
+
+    def __fetch(self, cache_name, key, method, *args):
+        cache = self.caches[cache_name]
+        try:
+            return cache.get(key)
+        except KeyError:
+            value = method(*args)
+            cache.put(key, value)
+            return value
+        except TypeError:
+            return method(*args)
+
+class LRUCache(object):
+    """Cache which discards least recently used item when it's full.
+
+    Property:
+        hit_count : the number of "get" call which found the item
+        miss_count : the number of "get" call which did not find the item
+    """
+
+    def __init__(self, max_size):
+        """
+        Args:
+            max_size: max number of items to hold. 0 means nothing is cached.
+        Raises:
+            ValueError: if max_size is negative
+        """
+        if max_size < 0:
+            raise ValueError("max_size of LRUCache must be >= 0 but got %s" % max_size)
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def get(self, key):
+        """Raises:
+            KeyError: if item of passed key is not cached
+        """
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.miss_count += 1
+            raise
+        self.items[key] = value
+        self.hit_count += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_size == 0:
+            return
+        if key in self.items:
+            del self.items[key]
+        elif len(self.items) >= self.max_size:
+            self.items.popitem(last=False)
+        self.items[key] = value
+
+    def __len__(self):
+        return len(self.items)
@@ -1,4 +1,13 @@
 import pickle
+import random
+import traceback
+import multiprocessing
+from Queue import Queue, Empty
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def build_not_implemented_msg(instance, method_name):
@@ -6,7 +15,7 @@ def build_not_implemented_msg(instance, method_name):
     return base_msg.format(instance.__class__.__name__, method_name)
 
 def pickle_data(file_path, data):
-    with open(file_path, "wb") as f: pickle.dump(data, f)
+    with open(file_path, "wb") as f: pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
 
 def unpickle_data(file_path):
     with open(file_path, "rb") as f: return pickle.load(f)
@@ -18,3 +27,140 @@ def value_function_check(algorithm_name, valid_types, value_function):
         valid_type_names = " or ".join([v_type.__name__ for v_type in valid_types])
         raise TypeError(base_err_msg % (algorithm_name, algorithm_name, valid_type_names))
 
+
+def seed_random_generators(seed):
+    """Seed random module and numpy.random (if numpy is installed).
+    Forked worker processes inherit the random state of parent. So call this
+    with different seed on each worker to get independent random streams.
+    """
+    random.seed(seed)
+    if np is not None: np.random.seed(seed % 2**32)
+
+def map_on_forked_workers(func, context, args_list, nb_worker):
+    """Run "func(context, arg)" for each arg of args_list on forked worker processes.
+
+    The context (and func) are inherited by forking worker processes. So they
+    do not need to be picklable. Only items of args_list and returned values
+    are pickled to be passed between processes.
+    If nb_worker is 1, func is run in current process without forking.
+    Worker processes are forked on every call. Use ForkedWorkerPool if you
+    want to keep them between calls.
+
+    Returns:
+        results: array of returned values in the same order of args_list
+    """
+    if nb_worker == 1:
+        return [func(context, arg) for arg in args_list]
+    with ForkedWorkerPool(func, context, nb_worker) as pool:
+        return pool.map(args_list)
+
+_forked_worker_context = None  # set in worker processes of ForkedWorkerPool
+
+def _run_with_forked_worker_context(arg):
+    func, context = _forked_worker_context
+    return func(context, arg)
+
+class ForkedWorkerPool(object):
+    """Run "func(context, arg)" asynchronously on forked worker processes.
+
+    Same as "map_on_forked_workers", context (and func) are inherited by
+    forking. The context is held by each worker process of this pool. So
+    multiple pools can be used at the same time.
+    Submit args with the key to identify them and receive results in the
+    order of completion. Use this class by "with" statement (or call "open"
+    and "close") to release worker processes after use.
+
+        with ForkedWorkerPool(func, context, nb_worker=4) as pool:
+            pool.submit("key", arg)
+            key, result = pool.wait_result()
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, func, context, nb_worker, timeout=None):
+        """
+        Args:
+            func: function to run on workers. func(context, arg)
+            context: passed to func on workers without pickling
+            nb_worker: number of worker processes
+            timeout: "wait_result" raises if no result comes in this seconds.
+                     None waits until result comes (or a worker dies).
+        """
+        self.func = func
+        self.context = context
+        self.nb_worker = nb_worker
+        self.timeout = timeout
+        self.pool = None
+        self.workers = []
+        self.results = Queue()
+
+    def open(self):
+        self.pool = multiprocessing.Pool(self.nb_worker, _set_forked_worker_context, (self.func, self.context))
+        self.workers = list(self.pool._pool)
+        self.results = Queue()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.pool = None
+        self.workers = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        self.close()
+
+    def submit(self, key, arg):
+        self.pool.apply_async(_run_with_forked_worker_context_safely, (key, arg), callback=self.results.put)
+
+    def map(self, args_list):
+        """Run func for each arg on workers and wait all of them.
+        Do not call this while other submitted args are in progress.
+        Returns:
+            results: array of returned values in the same order of args_list
+        """
+        for idx, arg in enumerate(args_list):
+            self.submit(idx, arg)
+        results = [None] * len(args_list)
+        for _ in args_list:
+            idx, result = self.wait_result()
+            results[idx] = result
+        return results
+
+    def wait_result(self):
+        """Block until one of submitted args is processed.
+        Returns:
+            key: the key passed with the arg
+            result: returned value of func
+        Raises:
+            Exception: if func raised on worker. Its traceback is in the message.
+            RuntimeError: if a worker process died or timeout passed
+        """
+        waited_time = 0
+        while True:
+            try:
+                key, success, result = self.results.get(True, self.POLL_INTERVAL)
+                break
+            except Empty:
+                waited_time += self.POLL_INTERVAL
+                if any([worker.exitcode is not None for worker in self.workers]):
+                    raise RuntimeError("A worker process died before returning result.")
+                if self.timeout is not None and waited_time >= self.timeout:
+                    raise RuntimeError("No result came from worker processes in %s seconds." % self.timeout)
+        if not success:
+            raise Exception("Error on worker process (key=%s)\n%s" % (key, result))
+        return key, result
+
+def _set_forked_worker_context(func, context):
+    """Initializer of worker process of ForkedWorkerPool"""
+    global _forked_worker_context
+    _forked_worker_context = (func, context)
+
+def _run_with_forked_worker_context_safely(key, arg):
+    try:
+        return key, True, _run_with_forked_worker_context(arg)
+    except Exception:
+        return key, False, traceback.format_exc()
@@ -1,4 +1,11 @@
 import os
+import random
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from kyoka.utils import build_not_implemented_msg, pickle_data, unpickle_data
 
@@ -19,6 +26,20 @@ class BaseActionValueFunction(object):
         err_msg = build_not_implemented_msg(self, "predict_value")
         raise NotImplementedError(err_msg)
 
+    def predict_value_on_batch(self, state_action_pairs):
+        """Predict the values of passed state-action pairs in one call.
+
+        Default implementation just calls "predict_value" for each pair.
+        Override this method if your value function can predict multiple
+        values at once more efficiently (ex. batch prediction of neuralnetwork).
+
+        Args:
+            state_action_pairs: array of tuple (state, action)
+        Returns:
+            values: array of predicted values in the same order of passed pairs
+        """
+        return [self.predict_value(state, action) for state, action in state_action_pairs]
+
     def backup(self, state, action, backup_target, alpha):
         """Update the value of passed state-action pair
         Args:
@@ -39,6 +60,22 @@ class BaseActionValueFunction(object):
     def load(self, load_dir_path):
       pass
 
+    def save_delta(self, save_dir_path):
+        """Save the changes since last "clear_delta" call.
+        Default implementation saves everything by "save" method.
+        """
+        self.save(save_dir_path)
+
+    def load_delta(self, load_dir_path):
+        """Apply the changes saved by "save_delta" on current state.
+        Default implementation loads everything by "load" method.
+        """
+        self.load(load_dir_path)
+
+    def clear_delta(self):
+        """Start tracking the changes which will be saved by next "save_delta" call"""
+        pass
+
 
 class BaseTabularActionValueFunction(BaseActionValueFunction):
     """Base class of tabular value function used in RL algorithms
@@ -49,6 +86,10 @@ class BaseTabularActionValueFunction(BaseActionValueFunction):
     """
 
     BASE_SAVE_FILE_NAME = "table_action_value_function_data.pickle"
+    BASE_DELTA_FILE_NAME = "table_action_value_function_delta.pickle"
+
+    # set of updated state-action pairs. None until "clear_delta" is called.
+    dirty_pairs = None
 
     def generate_initial_table(self):
         """Initialize table to store the values of state-action pairs.
@@ -59,6 +100,14 @@ class BaseTabularActionValueFunction(BaseActionValueFunction):
         err_msg = build_not_implemented_msg(self, "generate_initial_table")
         raise NotImplementedError(err_msg)
 
+    def generate_zero_table(self):
+        """Initialize table of same layout as "generate_initial_table" whose
+        values are all 0 (ex. counter of updates used by some algorithms).
+        Default implementation uses "generate_initial_table". Override this
+        if your initial table is not filled with 0.
+        """
+        return self.generate_initial_table()
+
     def fetch_value_from_table(self, table, state, action):
         """Define how to fetch the value of state-action pair from table.
         Args:
@@ -101,6 +150,17 @@ class BaseTabularActionValueFunction(BaseActionValueFunction):
     def predict_value(self, state, action):
         return self.fetch_value_from_table(self.table, state, action)
 
+    def mark_dirty(self, state, action):
+        """Record that the value of passed state-action pair is updated.
+        Call this in "backup" to include the pair in next "save_delta".
+        """
+        if self.dirty_pairs is not None:
+            self.dirty_pairs.add((state, action))
+
+    def predict_value_on_batch(self, state_action_pairs):
+        table = self.table
+        return [self.fetch_value_from_table(table, state, action) for state, action in state_action_pairs]
+
     def save(self, save_dir_path):
         pickle_data(self._gen_table_data_file_path(save_dir_path), self.table)
 
@@ -111,13 +171,291 @@ class BaseTabularActionValueFunction(BaseActionValueFunction):
                           ' is not found on [ %s ]' % load_dir_path)
         self.table = unpickle_data(file_path)
 
-    def _gen_table_data_file_path(self, dir_path):
-        return os.path.join(dir_path, self._gen_table_data_file_name())
+    def clear_delta(self):
+        self.dirty_pairs = set()
 
-    def _gen_table_data_file_name(self):
+    def save_delta(self, save_dir_path):
+        """Save the values of state-action pairs updated since last "clear_delta" call"""
+        delta = self._gen_delta(self.table)
+        pickle_data(self._gen_table_data_file_path(save_dir_path, self.BASE_DELTA_FILE_NAME), delta)
+
+    def load_delta(self, load_dir_path):
+        file_path = self._gen_table_data_file_path(load_dir_path, self.BASE_DELTA_FILE_NAME)
+        if not os.path.exists(file_path):
+            raise IOError('The saved delta of "TableActionValueFunction"' +
+                          ' is not found on [ %s ]' % load_dir_path)
+        self._apply_delta(self.table, unpickle_data(file_path))
+
+    def _gen_delta(self, table):
+        if self.dirty_pairs is None:
+            raise Exception('You need to call "clear_delta" before "save_delta" to track the changes.')
+        return [(state, action, self.fetch_value_from_table(table, state, action))
+                for state, action in self.dirty_pairs]
+
+    def _apply_delta(self, table, delta):
+        for state, action, value in delta:
+            self.insert_value_into_table(table, state, action, value)
+
+    def _gen_table_data_file_path(self, dir_path, base_file_name=None):
+        return os.path.join(dir_path, self._gen_table_data_file_name(base_file_name))
+
+    def _gen_table_data_file_name(self, base_file_name=None):
         prefix = self.define_save_file_prefix()
         if len(prefix) != 0: prefix += "_"
-        return prefix + self.BASE_SAVE_FILE_NAME
+        return prefix + (base_file_name if base_file_name else self.BASE_SAVE_FILE_NAME)
+
+
+class DenseTabularActionValueFunction(BaseTabularActionValueFunction):
+    """Tabular value function which stores the values in a numpy array.
+
+    Values are stored in contiguous array of shape (state_shape + (nb_action,)).
+    State and action are transformed into the index of the array by encoders.
+    (Default encoders use passed state and action as index as it is.)
+    This class requires numpy.
+
+    Combine this class with tabular value function of the algorithm you use
+    by multiple inheritance. Put the class of the algorithm first.
+
+        class MazeTable(SarsaTabularActionValueFunction, DenseTabularActionValueFunction):
+            pass
+
+        # state = (row, col), action = 0~3
+        value_function = MazeTable(state_shape=(6, 9), nb_action=4)
+
+    The table is saved in ".npy" format. If you pass "mmap_mode", "load" maps
+    the saved file into memory instead of reading it. So loading is instant and
+    pages are read lazily.
+        - "r"  : read-only. Processes which load same file share the memory.
+        - "r+" : writable. Updates are written back to the file, and "save" into
+                 the loaded directory just flushes them.
+        - "c"  : copy-on-write. Updates are not written back to the file.
+
+    Property:
+        table : numpy array of shape (state_shape + (nb_action,))
+    """
+
+    BASE_SAVE_FILE_NAME = "table_action_value_function_data.npy"
+    BASE_DELTA_FILE_NAME = "table_action_value_function_delta.npz"
+
+    def __init__(self, state_shape, nb_action, state_encoder=None, action_encoder=None,
+            initial_value=0, dtype="float64", mmap_mode=None):
+        """
+        Args:
+            state_shape : shape of the array to index states (ex. (height, width) of maze)
+            nb_action : the number of actions which are indexed by 0~(nb_action-1)
+            state_encoder : function which transforms state into int or tuple of int
+                            which indexes the state in state_shape.
+            action_encoder : function which transforms action into int in range of nb_action
+            initial_value : initial value of all state-action pairs
+            dtype : data type of the array
+            mmap_mode : "r", "r+" or "c" to memory-map the table on load.
+                        None reads whole table into memory.
+        """
+        if np is None:
+            raise ImportError('"DenseTabularActionValueFunction" requires numpy.')
+        self.state_shape = tuple(state_shape)
+        self.nb_action = nb_action
+        self.state_encoder = state_encoder if state_encoder else _identity
+        self.action_encoder = action_encoder if action_encoder else _identity
+        self.initial_value = initial_value
+        self.dtype = dtype
+        self.mmap_mode = mmap_mode
+
+    def generate_initial_table(self):
+        return np.full(self.state_shape + (self.nb_action,), self.initial_value, dtype=self.dtype)
+
+    def generate_zero_table(self):
+        return np.zeros(self.state_shape + (self.nb_action,), dtype=self.dtype)
+
+    def fetch_value_from_table(self, table, state, action):
+        return table.item(self._encode(state, action))
+
+    def insert_value_into_table(self, table, state, action, new_value):
+        table.itemset(self._encode(state, action), new_value)
+
+    def predict_value_on_batch(self, state_action_pairs):
+        if len(state_action_pairs) == 0: return []
+        indices = zip(*[self._encode(state, action) for state, action in state_action_pairs])
+        return self.table[tuple(indices)].tolist()
+
+    def fetch_values_of_state(self, state):
+        """Return the values of all actions at passed state as numpy array
+        (value of action "a" is at index "action_encoder(a)").
+        """
+        return self.table[self._encode_state(state)]
+
+    def choose_greedy_action(self, state, actions, rand=None):
+        """Choose the action which has highest value from passed actions by
+        vectorized argmax on the row of the state. If multiple best actions
+        are found, one of them is chosen by "rand.choice" (same as GreedyPolicy).
+        """
+        rand = rand if rand else random
+        action_indices = [self.action_encoder(action) for action in actions]
+        values = self.fetch_values_of_state(state)[action_indices]
+        return actions[int(rand.choice(np.flatnonzero(values == values.max())))]
+
+    def save(self, save_dir_path):
+        """Save the table in ".npy" format.
+        If the table is writable memory-map of the file to save, just flush it.
+        Otherwise the file is written to temporary path and renamed, so the
+        mapping of previous file (by this or other processes) is kept valid.
+
+        Saving into other directory (ex. each checkpoint of LearningRecorder)
+        always writes whole table. Use "save_delta" to save only the updates.
+        """
+        file_path = self._gen_table_data_file_path(save_dir_path)
+        if self._is_writable_mapping_of(file_path):
+            self.table.flush()
+        else:
+            tmp_file_path = file_path + ".tmp.npy"
+            np.save(tmp_file_path, self.table)
+            os.rename(tmp_file_path, file_path)
+
+    def load(self, load_dir_path):
+        file_path = self._gen_table_data_file_path(load_dir_path)
+        if not os.path.exists(file_path):
+            raise IOError('The saved data of "DenseTabularActionValueFunction"' +
+                          ' is not found on [ %s ]' % load_dir_path)
+        self.table = np.load(file_path, mmap_mode=self.mmap_mode)
+
+    def save_delta(self, save_dir_path):
+        """Save the flat indices and values of updated state-action pairs
+        in ".npz" format (two arrays instead of pickled list of pairs).
+        """
+        if self.dirty_pairs is None:
+            raise Exception('You need to call "clear_delta" before "save_delta" to track the changes.')
+        indices = [self._encode(state, action) for state, action in self.dirty_pairs]
+        if len(indices) == 0:
+            flat_indices = np.zeros(0, dtype=np.intp)
+        else:
+            flat_indices = np.ravel_multi_index(tuple(zip(*indices)), self.table.shape)
+        file_path = self._gen_table_data_file_path(save_dir_path, self.BASE_DELTA_FILE_NAME)
+        with open(file_path, "wb") as f:
+            np.savez(f, indices=flat_indices, values=self.table.flat[flat_indices])
+
+    def load_delta(self, load_dir_path):
+        file_path = self._gen_table_data_file_path(load_dir_path, self.BASE_DELTA_FILE_NAME)
+        if not os.path.exists(file_path):
+            raise IOError('The saved delta of "DenseTabularActionValueFunction"' +
+                          ' is not found on [ %s ]' % load_dir_path)
+        with np.load(file_path) as delta:
+            self.table.flat[delta["indices"]] = delta["values"]
+
+    def _is_writable_mapping_of(self, file_path):
+        return isinstance(self.table, np.memmap) and self.table.mode == "r+" and\
+                self.table.filename is not None and\
+                os.path.realpath(self.table.filename) == os.path.realpath(file_path)
+
+    def _encode(self, state, action):
+        return self._encode_state(state) + (self.action_encoder(action),)
+
+    def _encode_state(self, state):
+        index = self.state_encoder(state)
+        return index if isinstance(index, tuple) else (index,)
+
+def _identity(item):
+    return item
+
+class SparseTabularActionValueFunction(BaseTabularActionValueFunction):
+    """Tabular value function for the task whose reachable states are unknown
+    in advance (ex. board game).
+
+    The table is "SparseActionValueTable". Only the states which are inserted
+    some value hold memory, and the value of unseen state-action pair is
+    "default_value". Combine this class with tabular value function of the
+    algorithm you use by multiple inheritance (put the class of algorithm first).
+
+        class BoardTable(QLearningTabularActionValueFunction, SparseTabularActionValueFunction):
+            pass
+
+    States and actions must be hashable.
+    """
+
+    def __init__(self, default_value=0, typecode="d"):
+        """
+        Args:
+            default_value : the value of state-action pair never inserted
+            typecode : typecode of "array.array" to store the values
+                       (ex. "f" halves the memory with single precision).
+        """
+        self.default_value = default_value
+        self.typecode = typecode
+
+    def generate_initial_table(self):
+        return SparseActionValueTable(self.default_value, self.typecode)
+
+    def generate_zero_table(self):
+        return SparseActionValueTable(0, self.typecode)
+
+    def fetch_value_from_table(self, table, state, action):
+        return table.fetch(state, action)
+
+    def insert_value_into_table(self, table, state, action, new_value):
+        table.insert(state, action, new_value)
+
+    def predict_value_on_batch(self, state_action_pairs):
+        return self.table.fetch_on_batch(state_action_pairs)
+
+class SparseActionValueTable(object):
+    """Table which holds the values of state-action pairs compactly.
+
+    Each state is interned to integer id when its value is inserted first
+    time, and values of its actions are stored in an "array.array" row.
+    Actions are also interned to the column index shared by all rows.
+
+    Property:
+        state_ids : dict of state to the index of rows
+        action_ids : dict of action to the column index of row
+        rows : array of "array.array" which stores the values of each state
+    """
+
+    def __init__(self, default_value=0, typecode="d"):
+        self.default_value = default_value
+        self.typecode = typecode
+        self.state_ids = {}
+        self.action_ids = {}
+        self.rows = []
+
+    def __len__(self):
+        """the number of states stored in the table"""
+        return len(self.rows)
+
+    def fetch(self, state, action):
+        state_id = self.state_ids.get(state)
+        if state_id is None: return self.default_value
+        return self._fetch_from_row(self.rows[state_id], action)
+
+    def fetch_on_batch(self, state_action_pairs):
+        """Fetch values of pairs. Row of the state is looked up only once for
+        the consecutive pairs of the same state object.
+        """
+        values, last_state, row = [], _NOT_FOUND, None
+        for state, action in state_action_pairs:
+            if state is not last_state:
+                state_id = self.state_ids.get(state)
+                row = self.rows[state_id] if state_id is not None else None
+                last_state = state
+            values.append(self._fetch_from_row(row, action) if row is not None else self.default_value)
+        return values
+
+    def insert(self, state, action, value):
+        state_id = self.state_ids.get(state)
+        if state_id is None:
+            state_id = self.state_ids[state] = len(self.rows)
+            self.rows.append(array(self.typecode))
+        column = self.action_ids.get(action)
+        if column is None:
+            column = self.action_ids[action] = len(self.action_ids)
+        row = self.rows[state_id]
+        if column >= len(row):
+            row.extend([self.default_value] * (column + 1 - len(row)))
+        row[column] = value
+
+    def _fetch_from_row(self, row, action):
+        column = self.action_ids.get(action)
+        return row[column] if column is not None and column < len(row) else self.default_value
+
+_NOT_FOUND = object()
 
 
 class BaseApproxActionValueFunction(BaseActionValueFunction):
@@ -134,6 +472,10 @@ class BaseApproxActionValueFunction(BaseActionValueFunction):
     def predict_value(self, state, action):
         return self.approx_predict_value(self.construct_features(state, action))
 
+    def predict_value_on_batch(self, state_action_pairs):
+        features_list = [self.construct_features(state, action) for state, action in state_action_pairs]
+        return self.approx_predict_value_on_batch(features_list)
+
     def backup(self, state, action, backup_target, alpha):
         self.approx_backup(self.construct_features(state, action), backup_target, alpha)
 
@@ -158,6 +500,20 @@ class BaseApproxActionValueFunction(BaseActionValueFunction):
         err_msg = build_not_implemented_msg(self, "approx_predict_value")
         raise NotImplementedError(err_msg)
 
+    def approx_predict_value_on_batch(self, features_list):
+        """Predict values of multiple state-action pairs by using their features
+
+        Default implementation calls "approx_predict_value" for each features.
+        Override this method to predict them at once (ex. "model.predict_on_batch"
+        of keras) because it's called from policies for all actions of a state.
+
+        Args:
+            features_list: array of features transformed by "construct_features" method
+        Returns:
+            values : array of predicted values in the same order of features_list
+        """
+        return [self.approx_predict_value(features) for features in features_list]
+
     def approx_backup(self, features, backup_target, alpha):
         """Update value by using feature representation of state-action pair
         Args:
@@ -168,3 +524,40 @@ class BaseApproxActionValueFunction(BaseActionValueFunction):
         err_msg = build_not_implemented_msg(self, "approx_backup")
         raise NotImplementedError(err_msg)
 
+
+class ActionValueCache(BaseActionValueFunction):
+    """Serve the values of a state's actions which are predicted in advance.
+
+    This wrapper is used to share one batch prediction among the components
+    which evaluate the same state (ex. policy and backup target).
+    Prediction of other state-action pair is delegated to wrapped value function.
+
+    Property:
+        value_function : wrapped value function
+        state : the state whose action values are cached
+        actions : the actions of the state whose values are cached
+        values : cached values of the actions (same order of actions)
+    """
+
+    def __init__(self, value_function, state, actions, values):
+        self.value_function = value_function
+        self.state = state
+        self.actions = actions
+        self.values = values
+
+    def predict_value(self, state, action):
+        if state is self.state and action in self.actions:
+            return self.values[self.actions.index(action)]
+        else:
+            return self.value_function.predict_value(state, action)
+
+    def predict_value_on_batch(self, state_action_pairs):
+        if self._is_cached_pairs(state_action_pairs):
+            return list(self.values)
+        else:
+            return [self.predict_value(state, action) for state, action in state_action_pairs]
+
+    def _is_cached_pairs(self, state_action_pairs):
+        return len(state_action_pairs) == len(self.actions) and\
+                all([state is self.state and action == cached_action for (state, action), cached_action
+                    in zip(state_action_pairs, self.actions)])
@@ -0,0 +1,63 @@
+from nose.tools import raises
+
+from benchmarks.suite import run_suite, compare_with_baseline, run_in_forked_process
+from tests.base_unittest import BaseUnitTest
+
+
+class SuiteTest(BaseUnitTest):
+
+    def test_run_suite(self):
+        targets = ["sarsa.maze", "mcts.ticktacktoe"]
+        report = run_suite(seed=1, scale=0.01, repeat=1, targets=targets)
+        self.eq(targets, report["results"].keys())
+        self.eq(1, report["meta"]["seed"])
+        sarsa_result = report["results"]["sarsa.maze"]
+        self.eq(5, sarsa_result["nb_episode"])
+        self.true(sarsa_result["steps_per_sec"] > 0)
+        self.true(sarsa_result["peak_memory_kb"] > 0)
+        self.eq(20, report["results"]["mcts.ticktacktoe"]["nb_playout"])
+
+    def test_workload_is_reproduced_by_seed(self):
+        run = lambda: run_suite(seed=1, scale=0.01, repeat=2, targets=["q_learning.ticktacktoe"])
+        nb_step = lambda report: report["results"]["q_learning.ticktacktoe"]["nb_step"]
+        self.eq(nb_step(run()), nb_step(run()))
+
+    def test_run_in_forked_process(self):
+        allocate = lambda size: len(bytearray(size))
+        small_result, small_peak = run_in_forked_process(allocate, 1)
+        large_result, large_peak = run_in_forked_process(allocate, 64 * 1024 * 1024)
+        self.eq(1, small_result)
+        self.eq(64 * 1024 * 1024, large_result)
+        self.true(large_peak - small_peak > 32 * 1024)
+        # peak of previous child must not leak into next measurement
+        self.true(run_in_forked_process(allocate, 1)[1] < large_peak - 32 * 1024)
+
+    @raises(RuntimeError)
+    def test_error_in_forked_process(self):
+        run_in_forked_process(lambda: 1 / 0)
+
+    def test_compare_with_baseline(self):
+        baseline = self.__gen_report(steps_per_sec=100, peak_memory_kb=1000, nb_step=50)
+        self.eq([], compare_with_baseline(
+            self.__gen_report(steps_per_sec=80, peak_memory_kb=1200, nb_step=50), baseline))
+        messages = compare_with_baseline(
+                self.__gen_report(steps_per_sec=60, peak_memory_kb=1400, nb_step=51), baseline)
+        metric_names = sorted([message.split(" : ")[0] for message in messages])
+        self.eq(["sarsa.maze.nb_step", "sarsa.maze.peak_memory_kb", "sarsa.maze.steps_per_sec"], metric_names)
+
+    def test_ignore_skipped_benchmark(self):
+        baseline = self.__gen_report(steps_per_sec=100, peak_memory_kb=1000, nb_step=50)
+        report = self.__gen_report(steps_per_sec=1, peak_memory_kb=1, nb_step=1)
+        report["results"]["sarsa.maze"] = {"skipped": "numpy is not installed"}
+        self.eq([], compare_with_baseline(report, baseline))
+
+    @raises(ValueError)
+    def test_compare_with_baseline_of_different_scale(self):
+        baseline = self.__gen_report(steps_per_sec=100, peak_memory_kb=1000, nb_step=50)
+        report = self.__gen_report(steps_per_sec=100, peak_memory_kb=1000, nb_step=50)
+        report["meta"]["scale"] = 0.5
+        compare_with_baseline(report, baseline)
+
+    def __gen_report(self, steps_per_sec, peak_memory_kb, nb_step):
+        result = {"steps_per_sec": steps_per_sec, "peak_memory_kb": peak_memory_kb, "nb_step": nb_step}
+        return {"meta": {"seed": 0, "scale": 1.0}, "results": {"sarsa.maze": result}}
@@ -1,12 +1,15 @@
 import os
+import shutil
 
 from nose.tools import raises
+from nose.plugins.skip import SkipTest
 from mock import patch, Mock
 
 from kyoka.utils import pickle_data, unpickle_data
-from kyoka.policy import GreedyPolicy
 from kyoka.algorithm.deep_q_learning import DeepQLearning,\
-        DeepQLearningApproxActionValueFunction, ExperienceReplay
+        DeepQLearningApproxActionValueFunction, ExperienceReplay,\
+        PrioritizedExperienceReplay, ChunkedExperienceReplay, SumTree, PickledColumnReader,\
+        initialize_replay_memory, _write_pickled_column, predict_greedy_values_on_batch, _max_on_segments
 from tests.base_unittest import BaseUnitTest
 from tests.utils import generate_tmp_dir_path, setup_tmp_dir, teardown_tmp_dir, NegativePolicy
 
@@ -32,12 +35,42 @@ class DeepQLearningTest(BaseUnitTest):
         value_func = self.DeepQLearningApproxActionValueFunctionImpl(strict_mode=False)
         # Overrider terminal judge logic to avoid infinite episode by random policy
         task.is_terminal_state.side_effect = lambda state: state == 4 or state >= 100
-        self.eq(0, len(algo.replay_memory.queue))
+        self.eq(0, len(algo.replay_memory))
         algo.setup(task, policy, value_func)
-        self.eq(2, len(algo.replay_memory.queue))
+        self.eq(2, len(algo.replay_memory))
+
+    def test_initialize_replay_memory_without_prediction(self):
+        task = setup_stub_task()
+        value_func = Mock()
+        replay_memory = ExperienceReplay(max_size=10)
+        replay_memory.store_transition(1, 3, 16, 4)
+        initialize_replay_memory(task, value_func, replay_memory, start_size=5)
+        self.eq(5, len(replay_memory))
+        self.eq([], value_func.method_calls)
+        for state, action, reward, next_state in replay_memory.queue[1:]:
+            self.include(action, [state + 1, state + 2])
+            self.eq(state + action, next_state)
+            self.eq(next_state**2, reward)
+
+    def test_initialize_replay_memory_on_workers(self):
+        task = setup_stub_task()
+        replay_memory = ExperienceReplay(max_size=10)
+        initialize_replay_memory(task, "dummy", replay_memory, start_size=7, nb_worker=3)
+        self.eq(7, len(replay_memory))
+        for state, action, reward, next_state in replay_memory.queue:
+            self.eq(state + action, next_state)
+        # each worker starts from initial state of the task
+        self.eq([0, 0, 0], [replay_memory.queue[idx][0] for idx in [0, 3, 5]])
+
+    def test_pass_nb_warmup_worker(self):
+        algo = DeepQLearning(replay_start_size=3, nb_warmup_worker=2)
+        with patch('kyoka.algorithm.deep_q_learning.initialize_replay_memory') as initialize:
+            algo.setup(self.task, self.policy, self.value_func)
+        initialize.assert_called_once_with(
+                self.task, self.value_func, algo.replay_memory, 3, nb_worker=2)
 
     def test_check_backup_minibatch_delivery_in_gpi(self):
-        with patch('random.sample', side_effect=lambda lst, n: lst[len(lst)-n:]):
+        with patch('random.sample', side_effect=lambda lst, n: list(lst)[len(lst)-n:]):
             self.algo.run_gpi_for_an_episode(self.task, self.policy, self.value_func)
 
         backup_minibatch_expected = [
@@ -48,8 +81,17 @@ class DeepQLearningTest(BaseUnitTest):
         self.eq(backup_minibatch_expected, actual)
         self.value_func.q_hat_network.train_on_minibatch.assert_not_called()
 
+    def test_predict_targets_of_minibatch_at_once(self):
+        self.value_func.predict_value_by_network_on_batch = Mock(side_effect=lambda network, pairs: [1] * len(pairs))
+        experience_minibatch = [(0, 1, 1, 1), (1, 3, 16, 4), (0, 2, 4, 2)]
+        backup_minibatch = self.algo._gen_backup_minibatch(self.task, self.value_func, experience_minibatch)
+        self.eq([(0, 1, 1.1), (1, 3, 16), (0, 2, 4.1)], backup_minibatch)
+        self.value_func.predict_value_by_network_on_batch.assert_called_once_with(
+                self.value_func.q_hat_network, [(1, 2), (1, 3), (2, 3), (2, 4)])
+        self.false(self.value_func.use_target_network_flg)
+
     def test_update_value_function_reset_target_network(self):
-        with patch('random.sample', side_effect=lambda lst, n: lst[-n:]):
+        with patch('random.sample', side_effect=lambda lst, n: list(lst)[-n:]):
             self.algo.run_gpi_for_an_episode(self.task, self.policy, self.value_func)
         self.eq(2, self.algo.reset_step_counter)
         self.eq("Q_hat_network_0", self.value_func.q_hat_network.name)
@@ -84,10 +126,9 @@ class DeepQLearningTest(BaseUnitTest):
         self.eq(value_func, new_algo.value_function)
         self.eq(self.algo.replay_memory.max_size, new_algo.replay_memory.max_size)
         self.eq(self.algo.replay_memory.queue, new_algo.replay_memory.queue)
-        self.true(isinstance(new_algo.greedy_policy, GreedyPolicy))
 
        # Validate that loaded algorithm works like original one
-        with patch('random.sample', side_effect=lambda lst, n: lst[len(lst)-n:]):
+        with patch('random.sample', side_effect=lambda lst, n: list(lst)[len(lst)-n:]):
             new_algo.run_gpi_for_an_episode(self.task, self.policy, self.value_func)
         replay_memory_expected = [
                 (5.0, 7, 144, 4),
@@ -96,6 +137,63 @@ class DeepQLearningTest(BaseUnitTest):
         ]
         self.eq(replay_memory_expected, new_algo.replay_memory.queue)
 
+    def test_pass_replay_memory(self):
+        replay_memory = ExperienceReplay(max_size=5)
+        algo = DeepQLearning(replay_memory=replay_memory)
+        self.eq(replay_memory, algo.replay_memory)
+
+    def test_save_and_load_algorithm_state_delta(self):
+        dir_path = generate_tmp_dir_path(__file__)
+        setup_tmp_dir(__file__)
+        self.algo.save_algorithm_state(dir_path)
+        self.algo.clear_algorithm_state_delta()
+        self.algo.replay_memory.store_transition(1, 3, 16, 4)
+        self.algo.reset_step_counter = 2
+        self.algo.save_algorithm_state_delta(dir_path)
+        self.true(os.path.exists(os.path.join(dir_path, "dq_replay_memory_delta.pickle")))
+
+        new_algo = DeepQLearning()
+        new_algo.load_algorithm_state(dir_path)
+        self.eq([(2.5, 3, 25, 5), (5.0, 7, 144, 4)], new_algo.replay_memory.queue)
+        new_algo.load_algorithm_state_delta(dir_path)
+        self.eq(self.algo.replay_memory.queue, new_algo.replay_memory.queue)
+        self.eq(2, new_algo.reset_step_counter)
+
+    def test_backup_on_prioritized_minibatch(self):
+        replay_memory = PrioritizedExperienceReplay(max_size=3, alpha=1.0, beta=1.0, epsilon=0)
+        algo = DeepQLearning(gamma=0.1, C=3, minibatch_size=2, replay_start_size=2, replay_memory=replay_memory)
+        algo.replay_memory.store_transition(2.5, 3, 25, 5)
+        algo.replay_memory.store_transition(5.0, 7, 144, 4)
+        algo.setup(self.task, self.policy, self.value_func)
+        with patch.object(replay_memory, "sample_weighted_minibatch",
+                return_value=([(0, 1, 1, 1), (1, 3, 16, 4)], [1, 2], [0.5, 1.0])):
+            with patch.object(replay_memory, "sample_minibatch") as sample_minibatch:
+                with patch.object(replay_memory, "update_priorities") as update_priorities:
+                    algo.run_gpi_for_an_episode(self.task, self.policy, self.value_func)
+        sample_minibatch.assert_not_called()
+        self.eq(2, update_priorities.call_count)
+        positions, td_errors = update_priorities.call_args[0]
+        self.eq([1, 2], positions)
+        self.almosteq(0.6, td_errors[0], 0.001)
+        self.eq(13, td_errors[1])
+        self.value_func.q_network.train_on_minibatch.assert_called_with([(0, 1, 1.6), (1, 3, 16)])
+
+    def test_use_td_errors_returned_by_weighted_backup(self):
+        replay_memory = PrioritizedExperienceReplay(max_size=3)
+        algo = DeepQLearning(gamma=0.1, C=3, minibatch_size=2, replay_start_size=2, replay_memory=replay_memory)
+        algo.replay_memory.store_transition(2.5, 3, 25, 5)
+        algo.replay_memory.store_transition(5.0, 7, 144, 4)
+        algo.setup(self.task, self.policy, self.value_func)
+        self.value_func.backup_on_weighted_minibatch = Mock(return_value=[0.5, 2])
+        self.value_func.predict_value_on_batch = Mock(wraps=self.value_func.predict_value_on_batch)
+        with patch.object(replay_memory, "sample_weighted_minibatch",
+                return_value=([(0, 1, 1, 1), (1, 3, 16, 4)], [1, 2], [0.5, 1.0])):
+            with patch.object(replay_memory, "update_priorities") as update_priorities:
+                algo.run_gpi_for_an_episode(self.task, self.policy, self.value_func)
+        update_priorities.assert_called_with([1, 2], [0.5, 2])
+        predicted_pairs = [call[0][0] for call in self.value_func.predict_value_on_batch.call_args_list]
+        self.not_include([(0, 1), (1, 3)], predicted_pairs)
+
     class DeepQLearningApproxActionValueFunctionImpl(DeepQLearningApproxActionValueFunction):
 
         def __init__(self, strict_mode=True):
@@ -180,6 +278,20 @@ class DeepQLearningApproxValueFunctionTest(BaseUnitTest):
     def test_load_networks(self):
         self.empty_func.load_networks("dummy")
 
+    def test_backup_on_weighted_minibatch_ignores_weights_by_default(self):
+        self.func.backup_on_minibatch = Mock()
+        self.func.backup_on_weighted_minibatch("q", [(0, 1, 2)], [0.5])
+        self.func.backup_on_minibatch.assert_called_once_with("q", [(0, 1, 2)])
+
+    def test_predict_value_by_network_on_batch(self):
+        self.eq([6, 0], self.func.predict_value_by_network_on_batch(3, [(1, 2), (0, 5)]))
+
+    def test_predict_value_on_batch(self):
+        self.func.q_network = 2
+        self.eq([4, 0], self.func.predict_value_on_batch([(1, 2), (0, 5)]))
+        self.func.use_target_network(True)
+        self.eq([2, 0], self.func.predict_value_on_batch([(1, 2), (0, 5)]))
+
     def test_setup(self):
         self.eq(0, self.func.q_network)
         self.eq(1, self.func.q_hat_network)
@@ -249,11 +361,59 @@ class ExperienceReplayTest(BaseUnitTest):
         for e in experiences:
             er.store_transition(state=e[0], action=e[1], reward=e[2], next_state=e[3])
         self.eq(1, len(er.sample_minibatch(minibatch_size=1)))
-        with patch('random.sample', side_effect=lambda lst, num: lst[len(lst)-num:]):
+        with patch('random.sample', side_effect=lambda lst, num: list(lst)[len(lst)-num:]):
             minibatch = er.sample_minibatch(minibatch_size=2)
             expected = experiences[1:]
             self.eq(expected, minibatch)
 
+    def test_circular_buffer(self):
+        er = ExperienceReplay(max_size=3)
+        experiences = [(i, i, i, i) for i in range(7)]
+        for e in experiences:
+            er.store_transition(*e)
+        self.eq(3, len(er))
+        self.eq(7, er.stored_count)
+        self.eq(experiences[4:], er.queue)
+        self.eq(3, len(er.columns[0]))
+        with patch('random.sample', side_effect=lambda lst, num: [2, 0]):
+            self.eq([experiences[6], experiences[4]], er.sample_minibatch(minibatch_size=2))
+
+    def test_typed_columns(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise SkipTest("numpy is not installed")
+        column_dtypes = {"reward": "float32", "state": ("int8", (2,)), "next_state": ("int8", (2,))}
+        er = ExperienceReplay(max_size=2, column_dtypes=column_dtypes)
+        for i in range(3):
+            er.store_transition([i, i], "a%d" % i, 0.5 * i, [i+1, i+1])
+        self.eq(np.float32, er.columns[2].dtype)
+        self.eq((2, 2), er.columns[0].shape)
+        state, action, reward, next_state = er.queue[-1]
+        self.eq([2, 2], state.tolist())
+        self.eq("a2", action)
+        self.eq(1.0, reward)
+        self.true(isinstance(reward, float))
+        self.eq([3, 3], next_state.tolist())
+        state[0] = 100
+        self.eq([2, 2], er.queue[-1][0].tolist())
+
+        dump = er.dump()
+        new_er = ExperienceReplay(max_size=1, column_dtypes=column_dtypes)
+        new_er.load(dump)
+        self.eq(2, len(new_er))
+        self.eq([1, 1], new_er.queue[0][0].tolist())
+
+    def test_fetch_recent_transitions(self):
+        er = ExperienceReplay(max_size=2)
+        experiences = [(0, 1, 2, 3), (4, 5, 6, 7), (8, 9 ,0, 1)]
+        for e in experiences:
+            er.store_transition(state=e[0], action=e[1], reward=e[2], next_state=e[3])
+        self.eq(3, er.stored_count)
+        self.eq([], er.fetch_recent_transitions(0))
+        self.eq(experiences[2:], er.fetch_recent_transitions(1))
+        self.eq(experiences[1:], er.fetch_recent_transitions(3))
+
     def test_dump_load(self):
         er = ExperienceReplay(max_size=2)
         experiences = [(0, 1, 2, 3), (4, 5, 6, 7), (8, 9 ,0, 1)]
@@ -266,6 +426,293 @@ class ExperienceReplayTest(BaseUnitTest):
         self.eq(er.max_size, new_er.max_size)
         self.eq(er.queue, new_er.queue)
 
+    def test_load_dump_of_prioritized_memory(self):
+        er = PrioritizedExperienceReplay(max_size=2)
+        er.store_transition(0, 1, 2, 3)
+        new_er = ExperienceReplay(max_size=3)
+        new_er.load(er.dump())
+        self.eq(2, new_er.max_size)
+        self.eq([(0, 1, 2, 3)], new_er.queue)
+
+class PredictGreedyValuesTest(BaseUnitTest):
+
+    def test_predict_greedy_values_on_batch(self):
+        task = setup_stub_task()
+        value_func = Mock()
+        value_func.predict_value_on_batch.side_effect = lambda pairs: [state * action for state, action in pairs]
+        self.eq([8, 0, 3, 15], predict_greedy_values_on_batch(task, value_func, [2, 4, 1, 3]))
+        value_func.predict_value_on_batch.assert_called_once_with(
+                [(2, 3), (2, 4), (1, 2), (1, 3), (3, 4), (3, 5)])
+
+    def test_predict_greedy_values_on_terminal_states(self):
+        task = setup_stub_task()
+        value_func = Mock()
+        self.eq([0, 0], predict_greedy_values_on_batch(task, value_func, [4, 4]))
+        value_func.predict_value_on_batch.assert_not_called()
+
+    def test_max_on_segments(self):
+        values, sizes = [1, 3, 2, -1, -5, 4], [0, 3, 0, 2, 1, 0]
+        self.eq([0, 3, 0, -1, 4, 0], _max_on_segments(values, sizes))
+        with patch('kyoka.algorithm.deep_q_learning.np', None):
+            self.eq([0, 3, 0, -1, 4, 0], _max_on_segments(values, sizes))
+        self.eq([0, 0], _max_on_segments([], [0, 0]))
+
+class PrioritizedExperienceReplayTest(BaseUnitTest):
+
+    def setUp(self):
+        self.er = PrioritizedExperienceReplay(max_size=3, alpha=1.0, beta=1.0, epsilon=0)
+        self.experiences = [(0, 1, 2, 3), (4, 5, 6, 7), (8, 9 ,0, 1)]
+        for e in self.experiences:
+            self.er.store_transition(*e)
+
+    def test_new_transition_gets_max_priority(self):
+        self.er.update_priorities([0, 1, 2], [1, 4, 2])
+        self.er.store_transition(1, 1, 1, 1)
+        self.eq(4, self.er.sum_tree.get(0))
+        self.eq(10, self.er.sum_tree.total())
+
+    def test_sample_weighted_minibatch(self):
+        self.er.update_priorities([0, 1, 2], [1, 2, 1])
+        with patch('random.uniform', side_effect=[0.5, 3.5]):
+            minibatch, positions, weights = self.er.sample_weighted_minibatch(2)
+        self.eq([self.experiences[0], self.experiences[2]], minibatch)
+        self.eq([0, 2], positions)
+        self.eq([1.0, 1.0], weights)
+        with patch('random.uniform', side_effect=[1.5, 2.5]):
+            minibatch, positions, weights = self.er.sample_weighted_minibatch(2)
+        self.eq([1, 1], positions)
+        self.eq([1.0, 1.0], weights)
+
+    def test_importance_sampling_weights(self):
+        self.er.update_priorities([0, 1, 2], [1, 2, 1])
+        with patch('random.uniform', side_effect=[0.5, 1.5]):
+            _, positions, weights = self.er.sample_weighted_minibatch(2)
+        self.eq([0, 1], positions)
+        self.eq([1.0, 0.5], weights)
+
+    def test_beta_annealing(self):
+        er = PrioritizedExperienceReplay(max_size=3, beta=0.4, beta_anneal_duration=3)
+        er.store_transition(0, 1, 2, 3)
+        for expected in [0.6, 0.8, 1.0, 1.0]:
+            er.sample_weighted_minibatch(1)
+            self.almosteq(expected, er.beta, 0.001)
+
+    def test_sample_only_stored_transitions(self):
+        er = PrioritizedExperienceReplay(max_size=4)
+        er.store_transition(0, 1, 2, 3)
+        er.store_transition(4, 5, 6, 7)
+        minibatch, positions, _ = er.sample_weighted_minibatch(10)
+        self.true(all([position in [0, 1] for position in positions]))
+        self.eq(10, len(minibatch))
+
+    def test_dump_load(self):
+        self.er.update_priorities([0, 1, 2], [1, 2, 3])
+        self.er.store_transition(1, 1, 1, 1)
+        new_er = PrioritizedExperienceReplay(max_size=1)
+        new_er.load(self.er.dump())
+        self.eq(self.er.queue, new_er.queue)
+        self.eq(self.er.sum_tree.total(), new_er.sum_tree.total())
+        self.eq(self.er.max_priority, new_er.max_priority)
+        self.eq([2, 3, 3], [new_er.sum_tree.get(new_er._idx_to_position(i)) for i in range(3)])
+
+    def test_load_dump_of_plain_memory(self):
+        er = ExperienceReplay(max_size=2)
+        er.store_transition(0, 1, 2, 3)
+        er.store_transition(4, 5, 6, 7)
+        new_er = PrioritizedExperienceReplay(max_size=1)
+        new_er.load(er.dump())
+        self.eq(er.queue, new_er.queue)
+        self.eq(2, new_er.sum_tree.total())
+
+    def test_weights_of_zero_priority(self):
+        self.er.update_priorities([0, 1, 2], [0, 2, 1])
+        with patch.object(self.er, "_find_position", return_value=0):
+            _, positions, weights = self.er.sample_weighted_minibatch(2)
+        self.eq([0, 0], positions)
+        self.eq([1.0, 1.0], weights)
+        with patch.object(self.er, "_find_position", side_effect=[0, 1]):
+            _, _, weights = self.er.sample_weighted_minibatch(2)
+        self.eq(1.0, weights[0])
+        self.true(weights[1] < 1e-10)
+
+class ChunkedExperienceReplayTest(BaseUnitTest):
+
+    def setUp(self):
+        self.dir_path = generate_tmp_dir_path(__file__)
+        self.experiences = [(i, "a%d" % i, i * 0.5, i + 1) for i in range(7)]
+
+    def tearDown(self):
+        if os.path.exists(self.dir_path):
+            for file_name in os.listdir(self.dir_path):
+                file_path = os.path.join(self.dir_path, file_name)
+                if os.path.isdir(file_path): shutil.rmtree(file_path)
+            teardown_tmp_dir(__file__, os.listdir(self.dir_path))
+
+    def test_seal_chunk_into_file(self):
+        er = ChunkedExperienceReplay(max_size=6, store_dir_path=self.dir_path, chunk_size=2)
+        for e in self.experiences[:3]:
+            er.store_transition(*e)
+        self.eq([0], er.sealed_chunk_ids)
+        self.eq(3, len(er))
+        self.true(os.path.exists(os.path.join(self.dir_path, "replay_chunk_0_state.pickle")))
+        self.false(os.path.exists(os.path.join(self.dir_path, "replay_chunk_1_state.pickle")))
+        self.eq(self.experiences[:3], er.queue)
+
+    def test_delete_oldest_chunk_when_full(self):
+        er = ChunkedExperienceReplay(max_size=4, store_dir_path=self.dir_path, chunk_size=2)
+        for e in self.experiences:
+            er.store_transition(*e)
+        self.eq([2], er.sealed_chunk_ids)
+        self.eq(3, len(er))
+        self.eq(7, er.stored_count)
+        self.eq(self.experiences[4:], er.queue)
+        self.false(os.path.exists(os.path.join(self.dir_path, "replay_chunk_0_state.pickle")))
+        with patch('random.sample', side_effect=lambda lst, num: [2, 0]):
+            self.eq([self.experiences[6], self.experiences[4]], er.sample_minibatch(minibatch_size=2))
+
+    def test_read_chunk_from_file_out_of_hot_window(self):
+        er = ChunkedExperienceReplay(max_size=6, store_dir_path=self.dir_path, chunk_size=2, nb_hot_chunk=1)
+        for e in self.experiences[:5]:
+            er.store_transition(*e)
+        self.eq([1], list(er.hot_chunks.keys()))
+        self.eq(self.experiences[1], er._fetch_transition(1))
+        self.eq([1], list(er.hot_chunks.keys()))
+
+    def test_pin_newest_chunks_after_load(self):
+        er = ChunkedExperienceReplay(max_size=6, store_dir_path=self.dir_path, chunk_size=2, nb_hot_chunk=1)
+        for e in self.experiences[:5]:
+            er.store_transition(*e)
+        new_er = ChunkedExperienceReplay(max_size=6, store_dir_path=self.dir_path, chunk_size=2, nb_hot_chunk=1)
+        new_er.load(er.dump())
+        self.eq(self.experiences[:4], new_er.fetch_recent_transitions(5)[:4])
+        self.eq([1], list(new_er.hot_chunks.keys()))
+        new_er.store_transition(*self.experiences[5])
+        new_er.store_transition(*self.experiences[6])
+        self.eq([2], list(new_er.hot_chunks.keys()))
+
+    def test_read_each_chunk_once_in_minibatch(self):
+        er = ChunkedExperienceReplay(max_size=6, store_dir_path=self.dir_path, chunk_size=2, nb_hot_chunk=0)
+        for e in self.experiences[:5]:
+            er.store_transition(*e)
+        with patch.object(er, "_read_column", wraps=er._read_column) as read_column:
+            with patch('random.sample', side_effect=lambda lst, num: [3, 0, 4, 2, 1]):
+                minibatch = er.sample_minibatch(minibatch_size=5)
+        self.eq([self.experiences[idx] for idx in [3, 0, 4, 2, 1]], minibatch)
+        self.eq(8, read_column.call_count)
+
+    def test_pickled_column_reader(self):
+        setup_tmp_dir(__file__)
+        file_path = os.path.join(self.dir_path, "replay_chunk_0_action.pickle")
+        column = ["a", (1, 2), None, {"b": [3]}]
+        _write_pickled_column(file_path, column)
+        reader = PickledColumnReader(file_path)
+        self.eq(4, len(reader))
+        self.eq(column[::-1], [reader[position] for position in [3, 2, 1, 0]])
+
+    def test_invalid_max_size(self):
+        with self.assertRaises(ValueError):
+            ChunkedExperienceReplay(max_size=5, store_dir_path=self.dir_path, chunk_size=2)
+
+    def test_dump_load(self):
+        er = ChunkedExperienceReplay(max_size=6, store_dir_path=self.dir_path, chunk_size=2)
+        for e in self.experiences[:5]:
+            er.store_transition(*e)
+        dump = er.dump()
+        self.eq([0, 1], dump[2])
+        self.eq([self.experiences[4]], dump[5])
+
+        new_er = ChunkedExperienceReplay(max_size=2, store_dir_path=self.dir_path, chunk_size=1)
+        new_er.load(dump)
+        self.eq(0, len(new_er.hot_chunks))
+        self.eq(er.queue, new_er.queue)
+        self.eq(5, new_er.stored_count)
+        new_er.store_transition(*self.experiences[5])
+        new_er.store_transition(*self.experiences[6])
+        self.eq([1, 2], new_er.sealed_chunk_ids)
+        self.eq(self.experiences[2:], new_er.queue)
+
+    @raises(IOError)
+    def test_load_missing_chunk(self):
+        er = ChunkedExperienceReplay(max_size=6, store_dir_path=self.dir_path, chunk_size=2)
+        for e in self.experiences[:3]:
+            er.store_transition(*e)
+        dump = er.dump()
+        os.remove(os.path.join(self.dir_path, "replay_chunk_0_state.pickle"))
+        ChunkedExperienceReplay(max_size=6, store_dir_path=self.dir_path, chunk_size=2).load(dump)
+
+    def test_memory_map_typed_columns(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise SkipTest("numpy is not installed")
+        column_dtypes = {"state": ("int8", (2,)), "reward": "float32"}
+        er = ChunkedExperienceReplay(max_size=4, store_dir_path=self.dir_path,
+                chunk_size=2, nb_hot_chunk=0, column_dtypes=column_dtypes)
+        for i in range(3):
+            er.store_transition([i, i], "a%d" % i, 0.5 * i, i + 1)
+        self.true(os.path.exists(os.path.join(self.dir_path, "replay_chunk_0_state.npy")))
+        self.true(os.path.exists(os.path.join(self.dir_path, "replay_chunk_0_action.pickle")))
+        with patch('numpy.load', wraps=np.load) as load:
+            state, action, reward, next_state = er._fetch_transition(1)
+        self.eq("r", load.call_args_list[0][1]["mmap_mode"])
+        self.eq([1, 1], state.tolist())
+        self.eq(("a1", 0.5, 2), (action, reward, next_state))
+
+    def test_use_in_deep_q_learning(self):
+        er = ChunkedExperienceReplay(max_size=4, store_dir_path=self.dir_path, chunk_size=2)
+        algo = DeepQLearning(gamma=0.1, C=3, minibatch_size=2, replay_start_size=3, replay_memory=er)
+        for e in self.experiences[:3]:
+            er.store_transition(*e)
+        algo.save_algorithm_state(self.dir_path)
+        new_algo = DeepQLearning(replay_memory=ChunkedExperienceReplay(
+            max_size=4, store_dir_path=self.dir_path, chunk_size=2))
+        new_algo.load_algorithm_state(self.dir_path)
+        self.eq(er.queue, new_algo.replay_memory.queue)
+
+    def test_restore_older_checkpoint_after_chunk_deleted(self):
+        store_dir_path = os.path.join(self.dir_path, "store")
+        checkpoint_path = os.path.join(self.dir_path, "checkpoint")
+        er = ChunkedExperienceReplay(max_size=4, store_dir_path=store_dir_path, chunk_size=2)
+        algo = DeepQLearning(gamma=0.1, C=3, minibatch_size=2, replay_start_size=3, replay_memory=er)
+        for e in self.experiences[:3]:
+            er.store_transition(*e)
+        os.mkdir(checkpoint_path)
+        algo.save_algorithm_state(checkpoint_path)
+        expected = er.queue
+        for e in self.experiences[3:]:
+            er.store_transition(*e)
+        self.false(os.path.exists(os.path.join(store_dir_path, "replay_chunk_0_state.pickle")))
+        new_algo = DeepQLearning(replay_memory=ChunkedExperienceReplay(
+            max_size=4, store_dir_path=store_dir_path, chunk_size=2))
+        new_algo.load_algorithm_state(checkpoint_path)
+        self.eq(expected, new_algo.replay_memory.queue)
+
+class SumTreeTest(BaseUnitTest):
+
+    def test_update_and_total(self):
+        tree = SumTree(5)
+        for position, priority in enumerate([1, 2, 3, 4, 5]):
+            tree.update(position, priority)
+        self.eq(15, tree.total())
+        tree.update(2, 0.5)
+        self.eq(12.5, tree.total())
+        self.eq(0.5, tree.get(2))
+
+    def test_find(self):
+        tree = SumTree(5)
+        priorities = [1, 2, 3, 4, 5]
+        for position, priority in enumerate(priorities):
+            tree.update(position, priority)
+        for value in [0.1 * i for i in range(150)]:
+            leaf = tree.find(value)
+            cumsum = sum(priorities[:leaf])
+            self.true(cumsum <= value < cumsum + priorities[leaf])
+
+    def test_find_skips_empty_leaves(self):
+        tree = SumTree(4)
+        tree.update(0, 1)
+        self.eq(0, tree.find(1.0))
+        self.eq(0, tree.find(0.5))
 
 def setup_stub_task():
     mock_task = Mock()
@@ -280,6 +727,6 @@ def gen_tmp_file_path(dir_path):
     return os.path.join(dir_path, "hoge.pickle")
 
 def cleanup_trash():
-    filenames = ["hoge.pickle", "dq_replay_memory.pickle"]
+    filenames = ["hoge.pickle", "dq_replay_memory.pickle", "dq_replay_memory_delta.pickle"]
     teardown_tmp_dir(__file__, filenames)
 
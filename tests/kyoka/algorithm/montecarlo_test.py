@@ -3,8 +3,9 @@ import os
 from mock import Mock
 from nose.tools import raises
 
-from kyoka.algorithm.montecarlo import MonteCarlo, MonteCarloTabularActionValueFunction,\
-        MonteCarloApproxActionValueFunction, validate_value_function
+from kyoka.algorithm.montecarlo import MonteCarlo, ParallelMonteCarlo,\
+        MonteCarloTabularActionValueFunction, MonteCarloApproxActionValueFunction,\
+        validate_value_function
 from kyoka.value_function import BaseActionValueFunction
 from kyoka.policy import GreedyPolicy
 from tests.base_unittest import BaseUnitTest
@@ -62,17 +63,83 @@ class MonteCarloTest(BaseUnitTest):
     def test_reward_discounting(self):
         no_discount = MonteCarlo()
         episode = [("s", "a", "ns", 4), ("s", "a", "ns", 2), ("s", "a", "ns", 1), ("s", "a", "ns", 8)]
-        self.eq(15, no_discount._calculate_following_state_reward(0, episode))
-        self.eq(11, no_discount._calculate_following_state_reward(1, episode))
-        self.eq(9, no_discount._calculate_following_state_reward(2, episode))
-        self.eq(8, no_discount._calculate_following_state_reward(3, episode))
+        returns = [G for _, _, G in no_discount._calculate_returns(episode)]
+        self.eq([15, 11, 9, 8], returns)
         discount = MonteCarlo(gamma=0.9)
-        self.eq(12.442, discount._calculate_following_state_reward(0, episode))
-        self.eq(9.38, discount._calculate_following_state_reward(1, episode))
-        self.eq(8.2, discount._calculate_following_state_reward(2, episode))
-        self.eq(8, discount._calculate_following_state_reward(3, episode))
+        returns = [G for _, _, G in discount._calculate_returns(episode)]
+        self.almosteq(12.442, returns[0], 0.0001)
+        self.almosteq(9.38, returns[1], 0.0001)
+        self.almosteq(8.2, returns[2], 0.0001)
+        self.almosteq(8, returns[3], 0.0001)
 
+    def test_first_visit(self):
+        episode = [("s", "a", "ns", 4), ("s", "b", "ns", 2), ("s", "a", "ns", 1), ("s", "b", "ns", 8)]
+        every_visit = MonteCarlo()._calculate_returns(episode)
+        self.eq([("s", "a", 15), ("s", "b", 11), ("s", "a", 9), ("s", "b", 8)], every_visit)
+        first_visit = MonteCarlo(first_visit=True)._calculate_returns(episode)
+        self.eq([("s", "a", 15), ("s", "b", 11)], first_visit)
 
+    def test_calculate_returns_from_iterator(self):
+        episode = iter([("s", "a", "ns", 4), ("s", "b", "ns", 2)])
+        self.eq([("s", "a", 6), ("s", "b", 2)], MonteCarlo()._calculate_returns(episode))
+
+
+class ParallelMonteCarloTest(BaseUnitTest):
+
+    def test_value_function_validation(self):
+        with self.assertRaises(TypeError):
+            ParallelMonteCarlo().setup("dummy", "dummy", MonteCarloApproxActionValueFunction())
+
+    def test_run_gpi_for_an_episode(self):
+        algo = ParallelMonteCarlo(nb_worker=2, nb_episode_per_worker=3)
+        task = setup_stub_task()
+        value_func = MonteCarloTabularActionValueFunctionImpl()
+        policy = GreedyPolicy()
+        algo.setup(task, policy, value_func)
+        algo.run_gpi_for_an_episode(task, policy, value_func)
+        algo.close_worker_pool()
+        expected = [(0, 1, 59, 6), (1, 2, 58, 6), (3, 4, 49, 6), (0, 0, 0, 0)]
+        update_counter = value_func.update_counter
+        for state, action, value, update_count in expected:
+            self.eq(value, value_func.fetch_value_from_table(value_func.table, state, action))
+            self.eq(update_count, value_func.fetch_value_from_table(update_counter, state, action))
+
+    def test_refresh_snapshot_of_workers(self):
+        algo = ParallelMonteCarlo(nb_worker=2, nb_episode_per_worker=1, snapshot_interval=2)
+        task = setup_stub_task()
+        value_func = MonteCarloTabularActionValueFunctionImpl()
+        policy = GreedyPolicy()
+        algo.setup(task, policy, value_func)
+        try:
+            algo.run_gpi_for_an_episode(task, policy, value_func)
+            first_pool = algo.worker_pool
+            algo.run_gpi_for_an_episode(task, policy, value_func)
+            self.eq(first_pool, algo.worker_pool)
+            algo.run_gpi_for_an_episode(task, policy, value_func)
+            self.neq(first_pool, algo.worker_pool)
+            self.assertIsNone(first_pool.pool)
+        finally:
+            algo.close_worker_pool()
+        self.eq(6, value_func.update_counter[0][1])
+
+    def test_run_gpi_releases_workers(self):
+        algo = ParallelMonteCarlo(nb_worker=2, nb_episode_per_worker=3)
+        task = setup_stub_task()
+        value_func = MonteCarloTabularActionValueFunctionImpl()
+        algo.setup(task, GreedyPolicy(), value_func)
+        algo.run_gpi(2, verbose=0)
+        self.assertIsNone(algo.worker_pool)
+        self.eq(12, value_func.update_counter[0][1])
+
+    def test_run_gpi_for_an_episode_in_single_process(self):
+        algo = ParallelMonteCarlo(nb_worker=1, nb_episode_per_worker=2)
+        task = setup_stub_task()
+        value_func = MonteCarloTabularActionValueFunctionImpl()
+        policy = GreedyPolicy()
+        algo.setup(task, policy, value_func)
+        algo.run_gpi_for_an_episode(task, policy, value_func)
+        self.eq(59, value_func.predict_value(0, 1))
+        self.eq(2, value_func.update_counter[0][1])
 
 class MonteCarloTabularActionValueFunctionTest(BaseUnitTest):
 
@@ -105,6 +172,34 @@ class MonteCarloTabularActionValueFunctionTest(BaseUnitTest):
         self.eq(2, self.func.update_counter[0][1])
         self.eq(1, self.func.update_counter[1][0])
 
+    def test_save_and_load_delta(self):
+        self.func.setup()
+        self.func.backup(state=0, action=1, backup_target=2, alpha="dummy")
+        setup_tmp_dir(__file__)
+        dir_path = generate_tmp_dir_path(__file__)
+        self.func.save(dir_path)
+        self.func.clear_delta()
+        self.func.backup(state=1, action=0, backup_target=3, alpha="dummy")
+        self.func.merge_returns(state=0, action=1, average_return=4, count=1)
+        self.eq(set([(1, 0), (0, 1)]), self.func.dirty_pairs)
+        self.func.save_delta(dir_path)
+
+        new_func = MonteCarloTabularActionValueFunctionImpl()
+        new_func.load(dir_path)
+        self.eq(0, new_func.predict_value(state=1, action=0))
+        new_func.load_delta(dir_path)
+        self.eq(3, new_func.predict_value(state=1, action=0))
+        self.eq(3, new_func.predict_value(state=0, action=1))
+        self.eq(2, new_func.update_counter[0][1])
+        self.eq(1, new_func.update_counter[1][0])
+
+    def test_merge_returns(self):
+        self.func.setup()
+        self.func.backup(state=0, action=1, backup_target=2, alpha="dummy")
+        self.func.merge_returns(state=0, action=1, average_return=5, count=3)
+        self.almosteq(4.25, self.func.predict_value(state=0, action=1), 0.0001)
+        self.eq(4, self.func.update_counter[0][1])
+
 class MonteCarloApproxActionValueFunctionTest(BaseUnitTest):
 
     def setUp(self):
@@ -144,6 +239,7 @@ def setup_stub_task():
     return mock_task
 
 def cleanup_trash():
-    filenames = ["montecarlo_update_counter.pickle", "montecarlo_table_action_value_function_data.pickle"]
+    filenames = ["montecarlo_update_counter.pickle", "montecarlo_table_action_value_function_data.pickle",
+            "montecarlo_update_counter_delta.pickle", "montecarlo_table_action_value_function_delta.pickle"]
     teardown_tmp_dir(__file__, filenames)
 
@@ -1,9 +1,19 @@
+import math
+
 from mock import patch
+from nose.plugins.skip import SkipTest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from kyoka.task import BaseTask
 from kyoka.algorithm.montecarlo_tree_search import BaseMCTS, BaseNode, BaseEdge,\
-        UCTNode, UCTEdge, random_playout
-from kyoka.callback import WatchIterationCount
+        UCTNode, UCTEdge, random_playout, find_node_of_state, ArrayTree, ArrayUCTSearch,\
+        merge_root_edge_stats, _split_finish_rule, _playout_on_worker, _grow_tree_on_worker
+from kyoka.callback import WatchIterationCount, ManualInterruption
+from kyoka.utils import ForkedWorkerPool
 from tests.base_unittest import BaseUnitTest
 
 
@@ -110,6 +120,173 @@ class MCTSTest(BaseUnitTest):
         self.almosteq(2.94, nodeA.child_edges[0].calculate_value(), 0.01)
         self.almosteq(2.85, nodeA.child_edges[1].calculate_value(), 0.01)
 
+    def test_tree_reuse(self):
+        self.mcts.set_playout_policy(self.mcts._mock_playout)
+        self.mcts.set_tree_reuse(search_depth=1)
+        self.mcts.planning("A", WatchIterationCount(5, verbose=0))
+        nodeB = self.mcts.last_calculated_tree.child_edges[0].child_node
+        visit_counts = [edge.visit_count for edge in nodeB.child_edges]
+        self.eq([1, 1], visit_counts)
+
+        self.mcts.planning("B", WatchIterationCount(0, verbose=0))
+        self.eq(nodeB, self.mcts.last_calculated_tree)
+        self.assertIsNone(nodeB.parent_edge)
+        self.eq(visit_counts, [edge.visit_count for edge in nodeB.child_edges])
+
+        self.mcts.planning("B", WatchIterationCount(2, verbose=0))
+        self.eq(nodeB, self.mcts.last_calculated_tree)
+        self.eq(4, nodeB.visit_count)
+
+    def test_tree_reuse_not_found(self):
+        self.mcts.set_playout_policy(self.mcts._mock_playout)
+        self.mcts.set_tree_reuse(search_depth=1)
+        self.mcts.planning("A", WatchIterationCount(5, verbose=0))
+        nodeD = self.mcts.last_calculated_tree.child_edges[0].child_node.child_edges[1].child_node
+        self.eq("D", nodeD.state)
+        # D is depth 2 from A
+        self.mcts.planning("D", WatchIterationCount(0, verbose=0))
+        self.neq(nodeD, self.mcts.last_calculated_tree)
+        self.eq(0, self.mcts.last_calculated_tree.visit_count)
+
+    def test_tree_is_not_reused_by_default(self):
+        self.mcts.set_playout_policy(self.mcts._mock_playout)
+        self.mcts.planning("A", WatchIterationCount(5, verbose=0))
+        last_tree = self.mcts.last_calculated_tree
+        self.mcts.planning("A", WatchIterationCount(1, verbose=0))
+        self.neq(last_tree, self.mcts.last_calculated_tree)
+        self.eq(1, self.mcts.last_calculated_tree.visit_count)
+
+    def test_root_parallel_planning(self):
+        self.mcts.set_playout_policy(self.mcts._mock_playout)
+        expected_stats = []
+        for nb_iteration in [7, 6]:
+            self.mcts.planning("A", WatchIterationCount(nb_iteration, verbose=0))
+            expected_stats.append(self.mcts._root_edge_stats(self.mcts.last_calculated_tree))
+
+        self.mcts.set_root_parallel(2)
+        action = self.mcts.planning("A", WatchIterationCount(13, verbose=0))
+        root = self.mcts.last_calculated_tree
+        self.eq(1, action)
+        self.true(isinstance(root, TestNode))
+        self.eq(13, root.visit_count)
+        self.eq(merge_root_edge_stats([1, 5], expected_stats), self.mcts._root_edge_stats(root))
+        self.false(any([edge.has_child for edge in root.child_edges]))
+
+    def test_root_parallel_planning_on_kept_workers(self):
+        self.mcts.set_playout_policy(self.mcts._mock_playout)
+        self.mcts.set_root_parallel(2, keep_workers=True)
+        try:
+            self.mcts.planning("A", WatchIterationCount(13, verbose=0))
+            pool = self.mcts.planning_worker_pool
+            stats = self.mcts._root_edge_stats(self.mcts.last_calculated_tree)
+            self.mcts.planning("A", WatchIterationCount(13, verbose=0))
+            self.eq(pool, self.mcts.planning_worker_pool)
+            self.eq(stats, self.mcts._root_edge_stats(self.mcts.last_calculated_tree))
+            self.mcts.set_root_parallel(2)
+            self.assertIsNone(self.mcts.planning_worker_pool)
+            self.assertIsNone(pool.pool)
+        finally:
+            self.mcts.close_workers()
+
+    def test_root_parallel_on_one_share_keeps_random_state(self):
+        self.mcts.set_playout_policy(self.mcts._mock_playout)
+        self.mcts.set_root_parallel(2)
+        with patch("kyoka.algorithm.montecarlo_tree_search.map_on_forked_workers") as map_on_workers,\
+                patch("kyoka.algorithm.montecarlo_tree_search.seed_random_generators") as seed:
+            self.mcts.planning("A", WatchIterationCount(1, verbose=0))
+        self.false(map_on_workers.called)
+        self.false(seed.called)
+        self.eq(1, self.mcts.last_calculated_tree.visit_count)
+
+    def test_grow_tree_on_worker_reseeds_numpy(self):
+        if np is None: raise SkipTest("numpy is not installed")
+        self.mcts.set_playout_policy(lambda task, leaf_node: np.random.rand())
+        results = [_grow_tree_on_worker(self.mcts, (seed, WatchIterationCount(1, verbose=0), "A"))
+                for seed in [1, 2, 1]]
+        self.neq(results[0], results[1])
+        self.eq(results[0], results[2])
+
+    def test_tree_parallel_planning(self):
+        self.mcts.set_playout_policy(self.mcts._mock_playout)
+        self.mcts.set_tree_parallel(2)
+        action = self.mcts.planning("A", WatchIterationCount(13, verbose=0))
+        nodeA = self.mcts.last_calculated_tree
+        nodeB = nodeA.child_edges[0].child_node
+        self.include(action, [1, 5])
+        self.eq(13, nodeA.visit_count)
+        self.eq(13, sum([edge.visit_count for edge in nodeA.child_edges]))
+        self.eq(nodeA.child_edges[0].visit_count, nodeB.visit_count + 1)  # +1 for playout from B
+        # reward of F is always 1 and virtual loss must be reverted
+        self.eq(1, nodeA.child_edges[1].average_reward)
+        self.true(0 < nodeA.child_edges[0].average_reward <= 2)
+
+    def test_tree_parallel_planning_on_kept_workers(self):
+        self.mcts.set_playout_policy(self.mcts._mock_playout)
+        self.mcts.set_tree_parallel(2, keep_workers=True)
+        try:
+            self.mcts.planning("A", WatchIterationCount(13, verbose=0))
+            pool = self.mcts.playout_worker_pool
+            pids = [worker.pid for worker in pool.workers]
+            self.mcts.planning("A", WatchIterationCount(13, verbose=0))
+            self.eq(pool, self.mcts.playout_worker_pool)
+            self.eq(pids, [worker.pid for worker in self.mcts.playout_worker_pool.workers])
+            self.eq(13, self.mcts.last_calculated_tree.visit_count)
+            self.mcts.close_workers()
+            self.assertIsNone(self.mcts.playout_worker_pool)
+            self.assertIsNone(pool.pool)
+        finally:
+            self.mcts.close_workers()
+
+    def test_tree_parallel_workers_are_not_kept_by_default(self):
+        self.mcts.set_playout_policy(self.mcts._mock_playout)
+        self.mcts.set_tree_parallel(2)
+        with patch.object(ForkedWorkerPool, "close", autospec=True, side_effect=ForkedWorkerPool.close) as close:
+            self.mcts.planning("A", WatchIterationCount(3, verbose=0))
+        self.eq(1, close.call_count)
+        self.assertIsNone(close.call_args[0][0].pool)
+        self.assertIsNone(self.mcts.playout_worker_pool)
+
+    def test_playout_on_worker_reseeds_numpy(self):
+        if np is None: raise SkipTest("numpy is not installed")
+        context = (TestTask(), lambda task, leaf_node: np.random.rand())
+        rewards = [_playout_on_worker(context, (seed, "A")) for seed in [1, 2, 1]]
+        self.neq(rewards[0], rewards[1])
+        self.eq(rewards[0], rewards[2])
+
+    def test_tree_parallel_with_root_parallel(self):
+        self.mcts.set_tree_parallel(2)
+        self.mcts.set_root_parallel(2)
+        with self.assertRaises(ValueError):
+            self.mcts.planning("A", WatchIterationCount(1, verbose=0))
+
+    def test_split_finish_rule(self):
+        rules = _split_finish_rule(WatchIterationCount(5), 3)
+        self.eq([2, 2, 1], [rule.target_count for rule in rules])
+        self.eq([0, 0, 0], [rule.verbose for rule in rules])
+        self.eq([1], [rule.target_count for rule in _split_finish_rule(WatchIterationCount(1), 3)])
+        self.eq([0], [rule.target_count for rule in _split_finish_rule(WatchIterationCount(0), 3)])
+        other_rule = ManualInterruption("dummy")
+        self.eq([other_rule, other_rule], _split_finish_rule(other_rule, 2))
+
+    def test_merge_root_edge_stats(self):
+        edge_stats_list = [[(1, 1, 0.5), (2, 3, 1.0), (3, 0, 0)], [(2, 0, 0), (1, 3, 1.5)]]
+        merged = merge_root_edge_stats([1, 2, 3], edge_stats_list)
+        self.eq([(1, 4, 1.25), (2, 3, 1.0), (3, 0, 0)], merged)
+        with self.assertRaises(ValueError):
+            merge_root_edge_stats([1, 2], edge_stats_list)
+
+    def test_find_node_of_state(self):
+        root = self.mcts.generate_node_from_state("A")
+        root.child_edges[0].build_child(self.mcts.generate_node_from_state)
+        nodeB = root.child_edges[0].child_node
+        nodeB.child_edges[1].build_child(self.mcts.generate_node_from_state)
+        nodeD = nodeB.child_edges[1].child_node
+        self.eq(root, find_node_of_state(root, "A", 0))
+        self.eq(nodeB, find_node_of_state(root, "B", 1))
+        self.assertIsNone(find_node_of_state(root, "D", 1))
+        self.eq(nodeD, find_node_of_state(root, "D", 2))
+        self.assertIsNone(find_node_of_state(root, "C", 5))
+
     def test_select(self):
         root = self.mcts.generate_node_from_state("A")
         self.eq("A", self.mcts._select(root).state)
@@ -218,6 +395,14 @@ class BaseNodeTest(BaseUnitTest):
        node.child_edges[0].update_by_new_reward(1)
        self.eq(1, node.select_best_edge().action)
 
+    def test_select_last_edge_of_max_value(self):
+       node = TestNode(TestTask(), "A")
+       self.eq(node.child_edges[1], node.select_best_edge())
+       node.child_edges[0].average_reward = 1
+       self.eq(node.child_edges[0], node.select_best_edge())
+       node.child_edges[1].average_reward = 1
+       self.eq(node.child_edges[1], node.select_best_edge())
+
     def test_select_greedy_edge(self):
        node = TestNode(TestTask(), "A")
        node.child_edges[0].visit()
@@ -264,6 +449,32 @@ class BaseNodeTest(BaseUnitTest):
        node.child_edges[1].visit()
        self.eq(3, node.visit_count)
 
+    def test_log_visit_count(self):
+       node = TestNode(TestTask(), "A")
+       node.child_edges[0].visit()
+       node.child_edges[1].visit()
+       log2, log3 = math.log(2), math.log(3)
+       with patch("math.log", wraps=math.log) as log:
+           self.almosteq(log2, node.log_visit_count, 0.0001)
+           self.almosteq(log2, node.log_visit_count, 0.0001)
+           self.eq(1, log.call_count)
+           node.child_edges[0].visit()
+           self.almosteq(log3, node.log_visit_count, 0.0001)
+           self.eq(2, log.call_count)
+
+    def test_nb_unvisited_edge(self):
+       node = TestNode(TestTask(), "A")
+       state2node = lambda state: TestNode(TestTask(), state)
+       self.eq(2, node.nb_unvisited_edge)
+       self.false(node.is_expanded)
+       node.child_edges[1].build_child(state2node)
+       node.child_edges[1].build_child(state2node)
+       self.eq(1, node.nb_unvisited_edge)
+       self.eq(node.child_edges[0], node.select_unvisited_edge())
+       node.child_edges[0].build_child(state2node)
+       self.eq(0, node.nb_unvisited_edge)
+       self.true(node.is_expanded)
+
 class BaseEdgeTest(BaseUnitTest):
 
     def setUp(self):
@@ -294,6 +505,25 @@ class BaseEdgeTest(BaseUnitTest):
         self.edge.visit()
         self.eq(1, self.edge.visit_count)
 
+    def test_add_and_revert_virtual_loss(self):
+        for reward in [1, 0.5]:
+            self.edge.visit()
+            self.edge.update_by_new_reward(reward)
+        self.edge.add_virtual_loss(-1)
+        self.eq(3, self.edge.visit_count)
+        self.eq(3, self.edge.parent_node.visit_count)
+        self.almosteq(0.1666, self.edge.average_reward, 0.001)
+        self.edge.revert_virtual_loss(-1)
+        self.eq(2, self.edge.visit_count)
+        self.eq(2, self.edge.parent_node.visit_count)
+        self.almosteq(0.75, self.edge.average_reward, 1e-10)
+
+    def test_revert_virtual_loss_of_unvisited_edge(self):
+        self.edge.add_virtual_loss(0)
+        self.edge.revert_virtual_loss(0)
+        self.eq(0, self.edge.visit_count)
+        self.eq(0, self.edge.average_reward)
+
 class UCTEdgeNodeTest(BaseUnitTest):
 
     def setUp(self):
@@ -310,6 +540,129 @@ class UCTEdgeNodeTest(BaseUnitTest):
         self.edge.update_by_new_reward(1)
         self.almosteq(1.982303807367511, self.edge.calculate_value(), 0.0001)
 
+    def test_virtual_loss_diverts_selection(self):
+        for edge, reward in zip(self.nodeA.child_edges, [1, 0.9]):
+            edge.visit()
+            edge.update_by_new_reward(reward)
+        self.eq(self.edge, self.nodeA.select_best_edge())
+        self.edge.add_virtual_loss(0)
+        self.eq(self.nodeA.child_edges[1], self.nodeA.select_best_edge())
+        self.edge.revert_virtual_loss(0)
+        self.eq(self.edge, self.nodeA.select_best_edge())
+
+class ArrayTreeTest(BaseUnitTest):
+
+    def setUp(self):
+        if np is None: raise SkipTest("numpy is not installed")
+        self.tree = ArrayTree(max_nodes=4, initial_capacity=1)
+
+    def test_add_node(self):
+        root = self.tree.add_node(TestTask(), "A", -1)
+        self.eq(0, root)
+        self.eq((0, 2), self.tree.edge_range(root))
+        self.eq([1, 5], [self.tree.action_of(edge) for edge in range(2)])
+        self.eq(2, self.tree.nb_unvisited_edge[root])
+        self.eq("A", self.tree.states[root])
+        self.false(self.tree.terminal[root])
+
+        nodeB = self.tree.add_node(TestTask(), "B", 0)
+        self.eq(1, nodeB)
+        self.eq(nodeB, self.tree.child_node[0])
+        self.eq(1, self.tree.find_unvisited_edge(root))
+        self.eq(1, self.tree.nb_unvisited_edge[root])
+        self.eq((2, 4), self.tree.edge_range(nodeB))
+        self.eq(4, self.tree.nb_edge)
+
+    def test_release_state_of_expanded_node(self):
+        self.tree.add_node(TestTask(), "A", -1)
+        self.tree.add_node(TestTask(), "B", 0)
+        self.eq("A", self.tree.states[0])
+        nodeF = self.tree.add_node(TestTask(), "F", 1)
+        self.assertIsNone(self.tree.states[0])
+        self.assertIsNone(self.tree.states[nodeF])
+        self.true(self.tree.terminal[nodeF])
+        self.eq(1, self.tree.terminal_reward[nodeF])
+
+    def test_node_budget(self):
+        self.tree.add_node(TestTask(), "A", -1)
+        self.tree.add_node(TestTask(), "B", 0)
+        self.tree.add_node(TestTask(), "F", 1)
+        self.false(self.tree.is_full)
+        self.tree.add_node(TestTask(), "C", 2)
+        self.true(self.tree.is_full)
+        self.eq(4, len(self.tree.parent_edge))
+        with self.assertRaises(AssertionError):
+            self.tree.add_node(TestTask(), "D", 3)
+
+    def test_backpropagate(self):
+        self.tree.add_node(TestTask(), "A", -1)
+        self.tree.add_node(TestTask(), "B", 0)
+        self.tree.backpropagate(0, 2)
+        self.tree.backpropagate(2, 0.5)
+        self.eq([2, 1], self.tree.edge_visit_count[[0, 2]].tolist())
+        self.eq([1.25, 0.5], self.tree.average_reward[[0, 2]].tolist())
+        self.eq([2, 1], self.tree.node_visit_count[:2].tolist())
+
+    def test_numeric_action_dtype(self):
+        tree = ArrayTree(max_nodes=4, action_dtype="int8")
+        tree.add_node(TestTask(), "A", -1)
+        self.eq(np.int8, tree.actions.dtype)
+        self.eq(5, tree.action_of(1))
+        self.true(isinstance(tree.action_of(1), int))
+
+class ArrayUCTSearchTest(BaseUnitTest):
+
+    def setUp(self):
+        if np is None: raise SkipTest("numpy is not installed")
+        self.mcts = ArrayUCTSearch(TestTask())
+        self.mcts.set_playout_policy(TestMCTS(TestTask())._mock_playout)
+
+    def test_same_result_as_uct_search(self):
+        uct = ObjectUCTSearch(TestTask())
+        uct.set_playout_policy(TestMCTS(TestTask())._mock_playout)
+        for nb_iteration in range(1, 14):
+            action = self.mcts.planning("A", WatchIterationCount(nb_iteration, verbose=0))
+            expected = uct.planning("A", WatchIterationCount(nb_iteration, verbose=0))
+            self.eq(expected, action)
+            tree, root = self.mcts.last_calculated_tree, uct.last_calculated_tree
+            self.eq([edge.visit_count for edge in root.child_edges], tree.edge_visit_count[:2].tolist())
+            for edge, expected_edge in enumerate(root.child_edges):
+                self.almosteq(expected_edge.average_reward, tree.average_reward[edge], 1e-10)
+
+    def test_planning_on_node_budget(self):
+        self.mcts.max_nodes = 2
+        self.mcts.planning("A", WatchIterationCount(5, verbose=0))
+        tree = self.mcts.last_calculated_tree
+        self.eq(2, tree.nb_node)
+        self.eq(5, tree.node_visit_count[0])
+        self.eq(5, tree.edge_visit_count[:2].sum())
+        self.eq(-1, tree.child_node[1])
+
+    def test_root_parallel_planning(self):
+        uct = ObjectUCTSearch(TestTask())
+        uct.set_playout_policy(TestMCTS(TestTask())._mock_playout)
+        uct.set_root_parallel(2)
+        self.mcts.set_root_parallel(2)
+        expected = uct.planning("A", WatchIterationCount(13, verbose=0))
+        action = self.mcts.planning("A", WatchIterationCount(13, verbose=0))
+        self.eq(expected, action)
+        tree = self.mcts.last_calculated_tree
+        self.eq(1, tree.nb_node)
+        self.eq(13, tree.node_visit_count[0])
+        self.eq(uct._root_edge_stats(uct.last_calculated_tree), self.mcts._root_edge_stats(tree))
+
+    def test_tree_reuse_is_not_supported(self):
+        self.mcts.set_tree_reuse()
+        with self.assertRaises(ValueError) as e:
+            self.mcts.planning("A", WatchIterationCount(1, verbose=0))
+        self.include("tree reuse", e.exception.message)
+
+    def test_tree_parallel_is_not_supported(self):
+        self.mcts.set_tree_parallel(2)
+        with self.assertRaises(ValueError) as e:
+            self.mcts.planning("A", WatchIterationCount(1, verbose=0))
+        self.include("tree parallel", e.exception.message)
+
 class TestTask(BaseTask):
 
     def is_terminal_state(self, state):
@@ -350,3 +703,7 @@ class TestEdge(BaseEdge):
             explore_term = 1.0 * self.parent_node.visit_count / self.visit_count
         return self.average_reward + explore_term
 
+class ObjectUCTSearch(BaseMCTS):
+
+    def generate_node_from_state(self, state):
+        return UCTNode(self.task, state)
@@ -35,6 +35,19 @@ class QLearningTest(BaseUnitTest):
         for state, action, value in expected:
             self.eq(value, value_func.predict_value(state, action))
 
+    def test_predict_action_values_once_per_step(self):
+        algo = QLearning(alpha=0.5, gamma=0.1)
+        task = setup_stub_task()
+        value_func = QLearningTabularActionValueFunctionImpl()
+        policy = NegativePolicy()
+        algo.setup(task, policy, value_func)
+        batch_args = []
+        original_predict = value_func.predict_value_on_batch
+        value_func.predict_value_on_batch = lambda pairs: batch_args.append(pairs) or original_predict(pairs)
+
+        algo.run_gpi_for_an_episode(task, policy, value_func)
+        self.eq([[(1, 2), (1, 3)], [(3, 4), (3, 5)]], batch_args)
+
 class QLearningTabularActionValueFunctionTest(BaseUnitTest):
 
     def test_backup(self):
@@ -3,10 +3,11 @@ import sys
 
 from mock import Mock
 
-from kyoka.algorithm.rl_algorithm import BaseRLAlgorithm, generate_episode
-from kyoka.policy import GreedyPolicy, EpsilonGreedyPolicy
+from kyoka.algorithm.rl_algorithm import BaseRLAlgorithm, generate_episode,\
+        iterate_episode, generate_episodes_in_lockstep
+from kyoka.policy import GreedyPolicy, EpsilonGreedyPolicy, BoltzmannPolicy
 from kyoka.value_function import BaseActionValueFunction
-from kyoka.callback import BaseFinishRule
+from kyoka.callback import BaseCallback, BaseFinishRule
 from tests.base_unittest import BaseUnitTest
 
 
@@ -48,6 +49,19 @@ class BaseRLAlgorithmTest(BaseUnitTest):
         self.eq(1, algo.load_count)
 
 
+    def test_save_and_load_delta(self):
+        algo = self.TestImplementation()
+        mock_func = Mock()
+        algo.setup(task=0, policy=1, value_function=mock_func)
+        algo.clear_delta()
+        mock_func.clear_delta.assert_called_with()
+        algo.save_delta("hoge")
+        mock_func.save_delta.assert_called_with("hoge")
+        self.eq(1, algo.save_count)
+        algo.load_delta("hoge")
+        mock_func.load_delta.assert_called_with("hoge")
+        self.eq(1, algo.load_count)
+
     def test_error_msg_when_not_implement_abstract_method(self):
         self.__check_err_msg(lambda : self.algo.run_gpi_for_an_episode("dummy", "dummy", "dummy"), "run_gpi_for_an_episode")
 
@@ -61,6 +75,27 @@ class BaseRLAlgorithmTest(BaseUnitTest):
         self.eq((1, 2, 3, 9), episode[1])
         self.eq((3, 4, 7, 49), episode[2])
 
+    def test_iterate_episode(self):
+        task = self.__setup_stub_task()
+        policy = GreedyPolicy()
+        value_func = self.__setup_stub_value_function()
+        episode = iterate_episode(task, policy, value_func)
+        self.eq((0, 1, 1, 1), next(episode))
+        self.eq(1, task.transit_state.call_count)
+        self.eq([(1, 2, 3, 9), (3, 4, 7, 49)], list(episode))
+
+    def test_generate_episodes_in_lockstep(self):
+        tasks = [self.__setup_stub_task(), self.__setup_stub_task()]
+        tasks[1].generate_initial_state.return_value = 3
+        policy = GreedyPolicy()
+        value_func = self.__setup_stub_value_function()
+        episodes = generate_episodes_in_lockstep(tasks, policy, value_func)
+        self.eq([(0, 1, 1, 1), (1, 2, 3, 9), (3, 4, 7, 49)], episodes[0])
+        self.eq([(3, 4, 7, 49)], episodes[1])
+        batch_sizes = [len(args[0][0]) for args in value_func.predict_value_on_batch.call_args_list]
+        self.eq([2, 1, 1], batch_sizes)
+        value_func.predict_value.assert_not_called()
+
     def test_GPI(self):
         algo = self.TestImplementation()
         task = self.__setup_stub_task()
@@ -139,6 +174,17 @@ class BaseRLAlgorithmTest(BaseUnitTest):
         algo.run_gpi(nb_iteration=2)
         self.include("[EpsilonGreedyAnnealing]", self.capture.getvalue())
 
+    def test_default_temperature_annealing(self):
+        algo = self.TestImplementation()
+        task = self.__setup_stub_task()
+        policy = BoltzmannPolicy()
+        policy.set_temperature_annealing(10, 1, 3)
+        value_func = self.__setup_stub_value_function()
+        algo.setup(task, policy, value_func)
+        algo.run_gpi(nb_iteration=2)
+        self.include("[BoltzmannAnnealing]", self.capture.getvalue())
+        self.eq(4, policy.temperature)
+
     def test_set_callback(self):
         algo = self.TestImplementation()
         value_func = Mock(name="value_func")
@@ -156,6 +202,35 @@ class BaseRLAlgorithmTest(BaseUnitTest):
         callback.after_update.assert_called_with(2, "task", value_func)
         callback.after_gpi_finish.assert_called_with("task", value_func)
 
+    def test_callback_interval(self):
+        algo = self.TestImplementation()
+        algo.setup("task", "dummy", Mock(name="value_func"))
+        callback = self.TestIntervalCallback()
+        algo.run_gpi(nb_iteration=7, callbacks=callback, verbose=0)
+        self.eq([3, 6], callback.after_update_log)
+
+    def test_callbacks_are_notified_of_error(self):
+        algo = self.TestImplementation()
+        algo.setup("task", "dummy", Mock(name="value_func"))
+        algo.run_gpi_for_an_episode = Mock(side_effect=ValueError("broken"))
+        callback = self.TestErrorCallback()
+        duck_callback = Mock()
+        with self.assertRaises(ValueError) as e:
+            algo.run_gpi(nb_iteration=2, callbacks=[callback, duck_callback], verbose=0)
+        self.eq("broken", e.exception.message)
+        self.eq([("task", algo.value_function)], callback.error_log)
+        duck_callback.after_gpi_error.assert_called_with("task", algo.value_function)
+        duck_callback.after_gpi_finish.assert_not_called()
+
+    def test_keyboard_interrupt_is_not_handled_by_callbacks(self):
+        algo = self.TestImplementation()
+        algo.setup("task", "dummy", Mock(name="value_func"))
+        algo.run_gpi_for_an_episode = Mock(side_effect=KeyboardInterrupt)
+        callback = self.TestErrorCallback()
+        with self.assertRaises(KeyboardInterrupt):
+            algo.run_gpi(nb_iteration=2, callbacks=[callback], verbose=0)
+        self.eq([], callback.error_log)
+
     def test_error_when_run_gpi_called_without_setup(self):
         algo = self.TestImplementation()
         with self.assertRaises(Exception) as e: algo.run_gpi(nb_iteration=2)
@@ -174,6 +249,7 @@ class BaseRLAlgorithmTest(BaseUnitTest):
     def __setup_stub_value_function(self):
         mock_value_func = Mock(spec=BaseActionValueFunction)
         mock_value_func.predict_value.return_value = 0
+        mock_value_func.predict_value_on_batch.side_effect = lambda pairs: [0 for _ in pairs]
         return mock_value_func
 
     def __check_err_msg(self, target_method, target_word):
@@ -205,6 +281,29 @@ class BaseRLAlgorithmTest(BaseUnitTest):
             return "%s:%s" % ("finish", iteration_count)
 
 
+    class TestErrorCallback(BaseCallback):
+
+        def __init__(self):
+            self.error_log = []
+
+        def after_gpi_error(self, task, value_function):
+            try:
+                raise IOError("handled inside the hook")
+            except IOError:
+                pass
+            self.error_log.append((task, value_function))
+
+    class TestIntervalCallback(BaseCallback):
+
+        def __init__(self):
+            self.after_update_log = []
+
+        def define_callback_interval(self):
+            return 3
+
+        def after_update(self, iteration_count, _task, _value_function):
+            self.after_update_log.append(iteration_count)
+
     class TestImplementation(BaseRLAlgorithm):
 
         def __init__(self):
@@ -6,8 +6,9 @@ from nose.tools import raises
 from mock import patch, Mock
 
 from kyoka.callback import BaseCallback, BasePerformanceWatcher, EpsilonAnnealer,\
-        LearningRecorder, BaseFinishRule, ManualInterruption, WatchIterationCount
-from kyoka.policy import EpsilonGreedyPolicy
+        TemperatureAnnealer, LearningRecorder, ComponentProfiler, LatencyStats, BaseFinishRule,\
+        ManualInterruption, WatchIterationCount, build_hook_dispatch_list
+from kyoka.policy import EpsilonGreedyPolicy, BoltzmannPolicy
 from tests.base_unittest import BaseUnitTest
 from tests.utils import generate_tmp_dir_path, setup_tmp_dir, teardown_tmp_dir, remove_leaf_dir
 
@@ -38,6 +39,32 @@ class BaseCallbackTest(BaseUnitTest):
         self.callback.log("hoge")
         self.eq("[BaseCallback] hoge\n", self.capture.getvalue())
 
+    def test_define_implemented_hooks(self):
+        self.eq([], self.callback.define_implemented_hooks())
+        self.eq(["after_update"], EpsilonAnnealer("dummy").define_implemented_hooks())
+        self.eq(["interrupt_gpi"], ManualInterruption("dummy").define_implemented_hooks())
+        all_hooks = ["before_update", "after_update", "interrupt_gpi"]
+        self.eq(all_hooks, WatchIterationCount(1).define_implemented_hooks())
+        self.eq(["interrupt_gpi"], WatchIterationCount(1, verbose=0).define_implemented_hooks())
+
+    def test_build_hook_dispatch_list(self):
+        annealer, rule, unknown = EpsilonAnnealer("dummy"), ManualInterruption("dummy"), Mock()
+        dispatch_list = build_hook_dispatch_list([annealer, rule, unknown], "after_update")
+        self.eq([(annealer, annealer.after_update, 1), (unknown, unknown.after_update, 1)], dispatch_list)
+
+    def test_build_hook_dispatch_list_of_error_hook(self):
+        profiler, annealer, unknown = ComponentProfiler("dummy"), EpsilonAnnealer("dummy"), Mock()
+        dispatch_list = build_hook_dispatch_list([profiler, annealer, unknown], "after_gpi_error")
+        self.eq([(profiler, profiler.after_gpi_error, 1), (unknown, unknown.after_gpi_error, 1)], dispatch_list)
+
+    def test_build_hook_dispatch_list_with_invalid_interval(self):
+        for interval in [0, -1, None, 1.5, True]:
+            annealer = EpsilonAnnealer("dummy")
+            annealer.define_callback_interval = lambda: interval
+            with self.assertRaises(ValueError) as e:
+                build_hook_dispatch_list([annealer], "after_update")
+            self.include("EpsilonAnnealer", e.exception.message)
+
 class BasePerformanceWatcherTest(BaseUnitTest):
 
     def setUp(self):
@@ -87,6 +114,11 @@ class BasePerformanceWatcherTest(BaseUnitTest):
         self.eq('[Test] test:1\n[Test] test:4\n', self.capture.getvalue())
         self.eq([1, 4], watcher.performance_log)
 
+    def test_callback_interval(self):
+        watcher = self.TestCompleteImplementation()
+        watcher.before_gpi_start("dummy", "dummy")
+        self.eq(2, watcher.define_callback_interval())
+
     class TestCompleteImplementation(BasePerformanceWatcher):
 
         def __init__(self):
@@ -152,6 +184,34 @@ class EpsilonAnnealerTest(BaseUnitTest):
         self.annealer.after_update(101, "dummy", "dummy")
         self.not_include("finish", capture.getvalue())
 
+class TemperatureAnnealerTest(BaseUnitTest):
+
+    def setUp(self):
+        self.policy = BoltzmannPolicy()
+        self.policy.set_temperature_annealing(10, 1, 3)
+        self.annealer = TemperatureAnnealer(self.policy)
+        capture_log(self)
+
+    def tearDown(self):
+        release_capture()
+
+    def test_define_log_tag(self):
+        self.eq("BoltzmannAnnealing", self.annealer.define_log_tag())
+
+    def test_start_log(self):
+        self.annealer.before_gpi_start("dummy", "dummy")
+        self.include("from 10 to 1", self.capture.getvalue())
+
+    def test_finish_log(self):
+        [self.annealer.after_update(_, "dummy", "dummy") for _ in range(2)]
+        self.almosteq(4, self.policy.temperature, 0.0001)
+        self.not_include("finish", self.capture.getvalue())
+        self.annealer.after_update(3, "dummy", "dummy")
+        self.include("finish", self.capture.getvalue())
+        self.annealer.after_update(4, "dummy", "dummy")
+        self.eq(1, self.capture.getvalue().count("finish"))
+        self.eq(1, self.policy.temperature)
+
 class LearningRecorderTest(BaseUnitTest):
 
     def setUp(self):
@@ -204,6 +264,249 @@ class LearningRecorderTest(BaseUnitTest):
         self.true(os.path.exists(gen_dpath("gpi_finished")))
         self.algo.save.assert_called_with(gen_dpath("gpi_finished"))
 
+class IncrementalLearningRecorderTest(BaseUnitTest):
+
+    def setUp(self):
+        self.algo = Mock()
+        self.recorder = LearningRecorder(self.algo, generate_tmp_dir_path(__file__), 2, full_save_interval=4)
+        self.gen_dpath = lambda fname: os.path.join(generate_tmp_dir_path(__file__), fname)
+        capture_log(self)
+
+    def tearDown(self):
+        release_capture()
+        for dname in ["after_0_iteration", "after_2_iteration_delta", "after_4_iteration",
+                "after_6_iteration_delta", "gpi_finished"]:
+            remove_leaf_dir(self.gen_dpath(dname), [])
+        teardown_tmp_dir(__file__, [])
+
+    @raises(ValueError)
+    def test_full_save_interval_must_be_multiple_of_save_interval(self):
+        LearningRecorder(self.algo, "dummy", 2, full_save_interval=3)
+
+    def test_checkpoints(self):
+        setup_tmp_dir(__file__)
+        self.recorder.before_gpi_start("dummy", "dummy")
+        self.algo.save.assert_called_with(self.gen_dpath("after_0_iteration"))
+        self.algo.clear_delta.assert_called_with()
+        for iteration_count in range(1, 7):
+            self.recorder.after_update(iteration_count, "dummy", "dummy")
+        self.recorder.after_gpi_finish("dummy", "dummy")
+        expected = [
+                ("save", self.gen_dpath("after_0_iteration")), ("clear_delta",),
+                ("save_delta", self.gen_dpath("after_2_iteration_delta")), ("clear_delta",),
+                ("save", self.gen_dpath("after_4_iteration")), ("clear_delta",),
+                ("save_delta", self.gen_dpath("after_6_iteration_delta")), ("clear_delta",),
+                ("save", self.gen_dpath("gpi_finished")), ("clear_delta",)
+        ]
+        self.eq(expected, [(name,) + args for name, args, _ in self.algo.method_calls])
+        self.include(self.gen_dpath("after_6_iteration_delta"), self.capture.getvalue())
+
+    def test_load_checkpoint(self):
+        setup_tmp_dir(__file__)
+        self.recorder.before_gpi_start("dummy", "dummy")
+        for iteration_count in range(1, 7):
+            self.recorder.after_update(iteration_count, "dummy", "dummy")
+        self.algo.reset_mock()
+        self.recorder.load_checkpoint(6)
+        expected = [
+                ("load", self.gen_dpath("after_4_iteration")),
+                ("load_delta", self.gen_dpath("after_6_iteration_delta"))
+        ]
+        self.eq(expected, [(name,) + args for name, args, _ in self.algo.method_calls])
+        self.algo.reset_mock()
+        self.recorder.load_checkpoint(2)
+        expected = [
+                ("load", self.gen_dpath("after_0_iteration")),
+                ("load_delta", self.gen_dpath("after_2_iteration_delta"))
+        ]
+        self.eq(expected, [(name,) + args for name, args, _ in self.algo.method_calls])
+
+    @raises(IOError)
+    def test_load_checkpoint_without_full_checkpoint(self):
+        self.recorder.load_checkpoint(2)
+
+class BackgroundLearningRecorderTest(BaseUnitTest):
+
+    def setUp(self):
+        self.algo = self.FileSavingAlgorithm()
+        self.recorder = LearningRecorder(self.algo, generate_tmp_dir_path(__file__), 1,
+                full_save_interval=2, background=True)
+        self.gen_dpath = lambda fname: os.path.join(generate_tmp_dir_path(__file__), fname)
+        capture_log(self)
+        setup_tmp_dir(__file__)
+
+    def tearDown(self):
+        release_capture()
+        for dname in ["after_0_iteration", "after_1_iteration_delta", "after_2_iteration", "gpi_finished"]:
+            remove_leaf_dir(self.gen_dpath(dname), ["data.txt"])
+        teardown_tmp_dir(__file__, [])
+
+    def test_save_in_background(self):
+        self.recorder.before_gpi_start("dummy", "dummy")
+        self.algo.value = 1
+        self.recorder.after_update(1, "dummy", "dummy")
+        self.algo.value = 2
+        self.recorder.after_update(2, "dummy", "dummy")
+        self.algo.value = 3
+        self.recorder.after_gpi_finish("dummy", "dummy")
+        self.eq([], self.recorder.in_flight_saves)
+        read = lambda dname: open(os.path.join(self.gen_dpath(dname), "data.txt")).read()
+        self.eq("full 0", read("after_0_iteration"))
+        self.eq("delta 1", read("after_1_iteration_delta"))
+        self.eq("full 2", read("after_2_iteration"))
+        self.eq("full 3", read("gpi_finished"))
+        self.eq(4, self.algo.clear_count)
+        self.include("Started to save", self.capture.getvalue())
+
+    def test_bounded_in_flight_saves(self):
+        self.recorder.before_gpi_start("dummy", "dummy")
+        self.recorder.after_update(1, "dummy", "dummy")
+        self.true(len(self.recorder.in_flight_saves) <= 1)
+
+    def test_report_error_in_background(self):
+        self.algo.fail = True
+        self.recorder.before_gpi_start("dummy", "dummy")
+        with self.assertRaises(Exception) as e:
+            self.recorder.after_gpi_finish("dummy", "dummy")
+        self.include("after_0_iteration", e.exception.message)
+        self.include("disk full", e.exception.message)
+
+    def test_wait_background_saves_on_gpi_error(self):
+        self.recorder.before_gpi_start("dummy", "dummy")
+        self.algo.fail = True
+        self.recorder.after_update(1, "dummy", "dummy")
+        self.recorder.after_gpi_error("dummy", "dummy")
+        self.eq([], self.recorder.in_flight_saves)
+        self.eq("full 0", open(os.path.join(self.gen_dpath("after_0_iteration"), "data.txt")).read())
+        self.include("after_1_iteration_delta", self.capture.getvalue())
+        self.include("disk full", self.capture.getvalue())
+
+    class FileSavingAlgorithm(object):
+
+        def __init__(self):
+            self.value = 0
+            self.clear_count = 0
+            self.fail = False
+
+        def save(self, save_dir_path):
+            self._write(save_dir_path, "full %d" % self.value)
+
+        def save_delta(self, save_dir_path):
+            self._write(save_dir_path, "delta %d" % self.value)
+
+        def clear_delta(self):
+            self.clear_count += 1
+
+        def _write(self, save_dir_path, content):
+            if self.fail: raise IOError("disk full")
+            with open(os.path.join(save_dir_path, "data.txt"), "w") as f: f.write(content)
+
+class ComponentProfilerTest(BaseUnitTest):
+
+    def setUp(self):
+        self.algo = Mock()
+        self.algo.task = self.StubTask()
+        self.algo.policy = self.StubPolicy()
+        self.algo.value_function = self.StubValueFunction()
+        self.profiler = ComponentProfiler(self.algo, report_interval=2)
+        capture_log(self)
+
+    def tearDown(self):
+        release_capture()
+
+    def test_define_implemented_hooks(self):
+        self.include("after_update", self.profiler.define_implemented_hooks())
+        self.eq(2, self.profiler.define_callback_interval())
+        self.eq([], ComponentProfiler(self.algo).define_implemented_hooks())
+
+    def test_record_calls(self):
+        self.profiler.before_gpi_start("dummy", "dummy")
+        task, policy, value_function = self.algo.task, self.algo.policy, self.algo.value_function
+        self.eq(1, task.transit_state(0, 1))
+        task.transit_state(1, 1)
+        self.eq("a", policy.choose_action(task, value_function, 0))
+        value_function.backup(0, "a", 1, 0.1)
+        stats = self.profiler.stats
+        self.eq(2, stats["task.transit_state"].call_count)
+        self.eq(1, stats["policy.choose_action"].call_count)
+        self.eq(1, stats["value_function.backup"].call_count)
+        self.eq(1, stats["value_function.predict_value"].call_count)
+        self.eq(0, stats["task.is_terminal_state"].call_count)
+        self.not_include("task.calculate_reward", stats)
+
+    def test_report(self):
+        self.profiler.before_gpi_start("dummy", "dummy")
+        self.algo.task.transit_state(0, 1)
+        self.profiler.after_update(2, "dummy", "dummy")
+        self.include("after 2 iterations", self.capture.getvalue())
+        self.include("task.transit_state", self.capture.getvalue())
+        self.not_include("task.is_terminal_state", self.capture.getvalue())
+        self.profiler.after_gpi_finish("dummy", "dummy")
+        self.include("GPI finished", self.capture.getvalue())
+
+    def test_restore_methods_after_gpi_finish(self):
+        original_predict = self.algo.value_function.predict_value
+        self.profiler.before_gpi_start("dummy", "dummy")
+        self.include("transit_state", self.algo.task.__dict__)
+        self.profiler.after_gpi_finish("dummy", "dummy")
+        self.not_include("transit_state", self.algo.task.__dict__)
+        self.eq(original_predict, self.algo.value_function.predict_value)
+        self.eq(1, self.algo.task.transit_state(0, 1))
+
+    def test_restore_methods_after_gpi_error(self):
+        original_predict = self.algo.value_function.predict_value
+        self.profiler.before_gpi_start("dummy", "dummy")
+        self.profiler.after_gpi_error("dummy", "dummy")
+        self.not_include("transit_state", self.algo.task.__dict__)
+        self.eq(original_predict, self.algo.value_function.predict_value)
+        self.profiler.restore_methods()
+        self.eq(original_predict, self.algo.value_function.predict_value)
+
+    class StubTask(object):
+
+        def is_terminal_state(self, state):
+            return state == 2
+
+        def transit_state(self, state, action):
+            return state + action
+
+        def generate_possible_actions(self, state):
+            return [1]
+
+    class StubPolicy(object):
+
+        def choose_action(self, task, value_function, state):
+            return "a"
+
+    class StubValueFunction(object):
+
+        def __init__(self):
+            self.predict_value = lambda state, action: 0
+
+        def backup(self, state, action, backup_target, alpha):
+            self.predict_value(state, action)
+
+class LatencyStatsTest(BaseUnitTest):
+
+    def test_record(self):
+        stats = LatencyStats()
+        self.eq(0, stats.mean)
+        for elapsed in [0.3, 0.3, 0.3, 3.0]:
+            stats.record(elapsed)
+        self.eq(4, stats.call_count)
+        self.almosteq(3.9, stats.total_time, 0.0001)
+        self.almosteq(0.975, stats.mean, 0.0001)
+        self.eq(0.5, stats.percentile(50))
+        self.eq(4.0, stats.percentile(99))
+
+    def test_record_zero_latency(self):
+        stats = LatencyStats()
+        for elapsed in [0.0, 0.0, 1e-12, 2e-6]:
+            stats.record(elapsed)
+        self.eq(2 ** LatencyStats.MIN_BUCKET, stats.percentile(75))
+        self.true(stats.percentile(50) < 1e-6)
+        self.eq(2 ** -18, stats.percentile(99))
+
 class BaseFinishRuleTest(BaseUnitTest):
 
     def setUp(self):
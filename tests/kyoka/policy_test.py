@@ -1,7 +1,12 @@
+import math
+
 from nose.tools import raises
-from mock import Mock
+from nose.plugins.skip import SkipTest
+from mock import Mock, patch
 
-from kyoka.policy import BasePolicy, GreedyPolicy, EpsilonGreedyPolicy
+from kyoka.policy import BasePolicy, GreedyPolicy, RandomPolicy, EpsilonGreedyPolicy,\
+        BoltzmannPolicy
+from kyoka.value_function import DenseTabularActionValueFunction
 from tests.base_unittest import BaseUnitTest
 
 
@@ -23,6 +28,13 @@ class GreedyPolicyTest(BaseUnitTest):
         greedy_action = policy.choose_action(task, value_func, state="dummy")
         self.eq(3, greedy_action)
 
+    def test_choose_action_by_batch_prediction(self):
+        task = setup_task_stub([1,2,3])
+        value_func = setup_value_function_stub([100, 50, 150])
+        GreedyPolicy().choose_action(task, value_func, state="dummy")
+        value_func.predict_value_on_batch.assert_called_once_with([("dummy", 1), ("dummy", 2), ("dummy", 3)])
+        value_func.predict_value.assert_not_called()
+
     def test_choose_action_when_best_action_is_multiple(self):
         task = setup_task_stub([1,2,3])
         value_func = setup_value_function_stub([100, 50, 100])
@@ -31,21 +43,57 @@ class GreedyPolicyTest(BaseUnitTest):
         greedy_action = policy.choose_action(task, value_func, state="dummy")
         self.eq(3, greedy_action)
 
+    def test_choose_action_by_argmax_of_dense_table(self):
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest("numpy is not installed")
+        task = setup_task_stub([0, 1, 3])
+        value_func = DenseTabularActionValueFunction((2,), 4)
+        value_func.setup()
+        value_func.table[1] = [100, 50, 200, 100]
+        random = self.setup_random()
+        with patch.object(value_func, "predict_value_on_batch") as predict_value_on_batch:
+            self.eq(3, GreedyPolicy(rand=random).choose_action(task, value_func, state=1))
+        predict_value_on_batch.assert_not_called()
+        self.eq([0, 2], random.choice.call_args[0][0].tolist())
+
     def setup_random(self):
         random = Mock()
         random.choice.side_effect = lambda ary: ary[1]
         return random
 
+class RandomPolicyTest(BaseUnitTest):
+
+    def test_choose_action_without_value_function(self):
+        task = setup_task_stub([1,2,3])
+        value_func = Mock()
+        random = Mock()
+        random.choice.side_effect = lambda ary: ary[2]
+        policy = RandomPolicy(rand=random)
+        self.eq(3, policy.choose_action(task, value_func, state="dummy"))
+        random.choice.assert_called_once_with([1,2,3])
+        self.eq([], value_func.method_calls)
+
 class EpsilonGreedyPolicyTest(BaseUnitTest):
 
     def test_choose_action_boundary_test(self):
         eps = 0.0001
+        # explore (rand.choice picks first action) if dart < eps(=0.3) else best action
         self.eq(1, self.choose_action_with_rand_value(0))
-        self.eq(1, self.choose_action_with_rand_value(0.1 - eps))
-        self.eq(2, self.choose_action_with_rand_value(0.1))
-        self.eq(2, self.choose_action_with_rand_value(0.2 + (1-0.3) - eps))
-        self.eq(3, self.choose_action_with_rand_value(0.2 + (1-0.3)))
-        self.eq(3, self.choose_action_with_rand_value(1-eps))
+        self.eq(1, self.choose_action_with_rand_value(0.3 - eps))
+        self.eq(2, self.choose_action_with_rand_value(0.3))
+        self.eq(2, self.choose_action_with_rand_value(1-eps))
+
+    def test_explore_without_value_function(self):
+        task = setup_task_stub([1,2,3])
+        value_func = setup_value_function_stub([100, 150, 50])
+        random = self.setup_random(0.1)
+        random.choice.side_effect = lambda ary: ary[2]
+        policy = EpsilonGreedyPolicy(eps=0.3, rand=random)
+        self.eq(3, policy.choose_action(task, value_func, state="dummy"))
+        random.choice.assert_called_once_with([1,2,3])
+        value_func.predict_value_on_batch.assert_not_called()
 
     def test_epsilon_annealing(self):
         policy = EpsilonGreedyPolicy(eps=0.5)
@@ -81,6 +129,58 @@ class EpsilonGreedyPolicyTest(BaseUnitTest):
         return random
 
 
+class BoltzmannPolicyTest(BaseUnitTest):
+
+    def test_choose_action_boundary_test(self):
+        # probs of values [0, ln2, ln3] are [1/6, 2/6, 3/6]
+        eps = 0.0001
+        self.eq(1, self.choose_action_with_rand_value(0))
+        self.eq(1, self.choose_action_with_rand_value(1.0/6 - eps))
+        self.eq(2, self.choose_action_with_rand_value(1.0/6 + eps))
+        self.eq(2, self.choose_action_with_rand_value(3.0/6 - eps))
+        self.eq(3, self.choose_action_with_rand_value(3.0/6 + eps))
+        self.eq(3, self.choose_action_with_rand_value(1 - eps))
+
+    def test_choose_action_without_numpy(self):
+        with patch('kyoka.policy.np', None):
+            self.test_choose_action_boundary_test()
+
+    def test_choose_action_by_batch_prediction(self):
+        task = setup_task_stub([1,2,3])
+        value_func = setup_value_function_stub([1, 2, 3])
+        BoltzmannPolicy(rand=self.setup_random(0.5)).choose_action(task, value_func, state="dummy")
+        value_func.predict_value_on_batch.assert_called_once_with([("dummy", 1), ("dummy", 2), ("dummy", 3)])
+
+    def test_temperature(self):
+        task = setup_task_stub([1,2])
+        # high temperature is close to uniform and low temperature is close to greedy
+        self.eq(1, self.choose_action_with_rand_value(0.49, task, [0, 1], temperature=1000))
+        self.eq(2, self.choose_action_with_rand_value(0.01, task, [0, 1], temperature=0.01))
+        # large values do not overflow
+        self.eq(2, self.choose_action_with_rand_value(0.5, task, [1000, 2000], temperature=0.1))
+
+    def test_temperature_annealing(self):
+        policy = BoltzmannPolicy(temperature=5)
+        self.false(policy.do_annealing)
+        policy.set_temperature_annealing(initial_temperature=10, final_temperature=1, anneal_duration=9)
+        self.true(policy.do_annealing)
+        self.eq(10, policy.temperature)
+        for expected in range(9, 0, -1) + [1, 1]:
+            policy.anneal_temperature()
+            self.almosteq(expected, policy.temperature, 0.000001)
+
+    def choose_action_with_rand_value(self, rand_val, task=None, values=None, temperature=1.0):
+        task = task if task else setup_task_stub([1,2,3])
+        values = values if values else [0, math.log(2), math.log(3)]
+        value_func = setup_value_function_stub(values)
+        policy = BoltzmannPolicy(temperature=temperature, rand=self.setup_random(rand_val))
+        return policy.choose_action(task, value_func, state="dummy")
+
+    def setup_random(self, rand_val):
+        random = Mock()
+        random.random.return_value = rand_val
+        return random
+
 
 def setup_task_stub(possible_actions):
     mock_task = Mock()
@@ -89,6 +189,7 @@ def setup_task_stub(possible_actions):
 
 def setup_value_function_stub(mock_return):
     mock_value_func = Mock()
-    mock_value_func.predict_value.side_effect = mock_return
+    values = iter(mock_return)
+    mock_value_func.predict_value_on_batch.side_effect = lambda pairs: [next(values) for _ in pairs]
     return mock_value_func
 
@@ -1,6 +1,7 @@
 from nose.tools import raises
+from mock import Mock
 
-from kyoka.task import BaseTask
+from kyoka.task import BaseTask, CachedTask, LRUCache
 from tests.base_unittest import BaseUnitTest
 
 
@@ -29,3 +30,73 @@ class BaseTaskTest(BaseUnitTest):
     def test_calculate_reward(self):
         self.task.calculate_reward("dummy")
 
+
+
+class CachedTaskTest(BaseUnitTest):
+
+    def setUp(self):
+        self.original = Mock()
+        self.original.is_terminal_state.side_effect = lambda state: state == 3
+        self.original.transit_state.side_effect = lambda state, action: state + action
+        self.original.generate_possible_actions.side_effect = lambda state: [1, 2]
+        self.original.calculate_reward.side_effect = lambda state: state * 10
+        self.task = CachedTask(self.original, max_size=2)
+
+    def test_memoize_task_methods(self):
+        for _ in range(3):
+            self.eq([1, 2], self.task.generate_possible_actions(0))
+            self.false(self.task.is_terminal_state(0))
+            self.eq(2, self.task.transit_state(0, 2))
+        self.eq(1, self.original.generate_possible_actions.call_count)
+        self.eq(1, self.original.is_terminal_state.call_count)
+        self.eq(1, self.original.transit_state.call_count)
+        self.eq(6, self.task.hit_count)
+        self.eq(3, self.task.miss_count)
+        self.eq((2, 1, 1), self.task.cache_info()["transit_state"])
+
+    def test_not_memoize_reward(self):
+        self.eq(10, self.task.calculate_reward(1))
+        self.eq(10, self.task.calculate_reward(1))
+        self.eq(2, self.original.calculate_reward.call_count)
+
+    def test_clear_cache(self):
+        self.task.is_terminal_state(3)
+        self.task.clear_cache()
+        self.true(self.task.is_terminal_state(3))
+        self.eq(2, self.original.is_terminal_state.call_count)
+
+    def test_unhashable_state(self):
+        self.eq([1, 2], self.task.generate_possible_actions([0]))
+        self.eq([1, 2], self.task.generate_possible_actions([0]))
+        self.eq(2, self.original.generate_possible_actions.call_count)
+
+    def test_delegate_other_attributes(self):
+        self.original.get_maze_shape.return_value = (3, 4)
+        self.eq((3, 4), self.task.get_maze_shape())
+
+class LRUCacheTest(BaseUnitTest):
+
+    def test_discard_least_recently_used_item(self):
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.eq(1, cache.get("a"))
+        cache.put("c", 3)
+        self.eq(2, len(cache))
+        with self.assertRaises(KeyError):
+            cache.get("b")
+        self.eq(1, cache.get("a"))
+        self.eq(3, cache.get("c"))
+        self.eq(3, cache.hit_count)
+        self.eq(1, cache.miss_count)
+
+    def test_zero_size_caches_nothing(self):
+        cache = LRUCache(max_size=0)
+        cache.put("a", 1)
+        self.eq(0, len(cache))
+        with self.assertRaises(KeyError):
+            cache.get("a")
+
+    def test_negative_size(self):
+        with self.assertRaises(ValueError):
+            LRUCache(max_size=-1)
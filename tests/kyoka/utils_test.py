@@ -1,3 +1,7 @@
+import os
+import time
+import random
+
 import kyoka.utils as U
 from tests.base_unittest import BaseUnitTest
 
@@ -15,3 +19,54 @@ class UtilsTest(BaseUnitTest):
         self.include("hoge", e.exception.message)
         self.include("BaseUnitTest or UtilsTest", e.exception.message)
 
+
+    def test_map_on_forked_workers(self):
+        context = { "base": 10 }
+        add_base = lambda ctx, arg: ctx["base"] + arg
+        self.eq([11, 12, 13], U.map_on_forked_workers(add_base, context, [1, 2, 3], nb_worker=2))
+        self.eq([11, 12, 13], U.map_on_forked_workers(add_base, context, [1, 2, 3], nb_worker=1))
+
+    def test_seed_random_generators(self):
+        U.seed_random_generators(2**40 + 1)
+        values = [random.random()] + ([U.np.random.rand()] if U.np is not None else [])
+        U.seed_random_generators(2**40 + 1)
+        self.eq(values, [random.random()] + ([U.np.random.rand()] if U.np is not None else []))
+
+    def test_forked_worker_pool(self):
+        context = { "base": 10 }
+        add_base = lambda ctx, arg: ctx["base"] + arg
+        with U.ForkedWorkerPool(add_base, context, nb_worker=2) as pool:
+            for arg in [1, 2, 3]:
+                pool.submit("key%d" % arg, arg)
+            results = sorted([pool.wait_result() for _ in range(3)])
+        self.eq([("key1", 11), ("key2", 12), ("key3", 13)], results)
+
+    def test_forked_worker_pool_raises_error_of_worker(self):
+        with U.ForkedWorkerPool(lambda ctx, arg: 1 / arg, None, nb_worker=1) as pool:
+            pool.submit("zero", 0)
+            with self.assertRaises(Exception) as e:
+                pool.wait_result()
+        self.include("ZeroDivisionError", e.exception.message)
+        self.include("zero", e.exception.message)
+
+    def test_forked_worker_pool_detects_dead_worker(self):
+        with U.ForkedWorkerPool(lambda ctx, arg: os._exit(1), None, nb_worker=1) as pool:
+            pool.submit("key", 0)
+            with self.assertRaises(RuntimeError):
+                pool.wait_result()
+
+    def test_forked_worker_pool_timeout(self):
+        with U.ForkedWorkerPool(lambda ctx, arg: time.sleep(arg), None, nb_worker=1, timeout=0.2) as pool:
+            pool.submit("key", 1)
+            with self.assertRaises(RuntimeError):
+                pool.wait_result()
+
+    def test_forked_worker_pools_hold_own_context(self):
+        add_base = lambda ctx, arg: ctx["base"] + arg
+        with U.ForkedWorkerPool(add_base, { "base": 10 }, nb_worker=1) as pool1:
+            with U.ForkedWorkerPool(add_base, { "base": 20 }, nb_worker=1) as pool2:
+                self.eq([11, 21], U.map_on_forked_workers(add_base, { "base": 10 }, [1, 11], nb_worker=2))
+                pool2.submit("key", 1)
+                self.eq(("key", 21), pool2.wait_result())
+            pool1.submit("key", 1)
+            self.eq(("key", 11), pool1.wait_result())
@@ -1,12 +1,44 @@
 import os
 
 from nose.tools import raises
+from nose.plugins.skip import SkipTest
+from mock import Mock
 
-from kyoka.value_function import BaseTabularActionValueFunction, BaseApproxActionValueFunction
+from kyoka.value_function import BaseActionValueFunction, BaseTabularActionValueFunction,\
+        DenseTabularActionValueFunction, SparseTabularActionValueFunction, SparseActionValueTable,\
+        BaseApproxActionValueFunction, ActionValueCache
+from kyoka.algorithm.montecarlo import MonteCarloTabularActionValueFunction
+from kyoka.algorithm.q_learning import QLearningTabularActionValueFunction
+from kyoka.utils import unpickle_data
 from tests.base_unittest import BaseUnitTest
 from tests.utils import generate_tmp_dir_path, setup_tmp_dir, teardown_tmp_dir
 
 
+class BaseActionValueFunctionTest(BaseUnitTest):
+
+    def test_predict_value_on_batch(self):
+        func = BaseActionValueFunction()
+        func.predict_value = lambda state, action: state * action
+        self.eq([2, 6, 0], func.predict_value_on_batch([(1, 2), (2, 3), (3, 0)]))
+
+class ActionValueCacheTest(BaseUnitTest):
+
+    def setUp(self):
+        self.value_func = BaseActionValueFunction()
+        self.value_func.predict_value = lambda state, action: state * action
+        self.state = (1,)
+        self.cache = ActionValueCache(self.value_func, self.state, [1, 2], [10, 20])
+
+    def test_predict_value(self):
+        self.eq(20, self.cache.predict_value(self.state, 2))
+        self.eq((1, 1, 1), self.cache.predict_value(self.state, 3))
+        self.eq((2, 2), self.cache.predict_value((2,), 2))
+
+    def test_predict_value_on_batch(self):
+        self.eq([10, 20], self.cache.predict_value_on_batch([(self.state, 1), (self.state, 2)]))
+        self.eq([20, 10], self.cache.predict_value_on_batch([(self.state, 2), (self.state, 1)]))
+        self.eq([(1, 1, 1)], self.cache.predict_value_on_batch([(self.state, 3)]))
+
 class BaseTabularActionValueFunctionTest(BaseUnitTest):
 
     def setUp(self):
@@ -14,8 +46,9 @@ class BaseTabularActionValueFunctionTest(BaseUnitTest):
         self.func.setup()
 
     def tearDown(self):
-        tmp_file_name = "hoge_table_action_value_function_data.pickle"
-        teardown_tmp_dir(__file__, [tmp_file_name])
+        tmp_file_names = ["hoge_table_action_value_function_data.pickle",
+                "hoge_table_action_value_function_delta.pickle"]
+        teardown_tmp_dir(__file__, tmp_file_names)
 
     @raises(NotImplementedError)
     def test_backup(self):
@@ -38,6 +71,10 @@ class BaseTabularActionValueFunctionTest(BaseUnitTest):
         self.func.table[state][action]= 1
         self.eq(1, self.func.predict_value(state, action))
 
+    def test_predict_value_on_batch(self):
+        self.func.table[0][1]= 1
+        self.eq([0, 1], self.func.predict_value_on_batch([(0, 0), (0, 1)]))
+
     def test_insert_value_into_table(self):
         state, action = 0, 1
         self.eq(0, self.func.predict_value(state, action))
@@ -58,6 +95,41 @@ class BaseTabularActionValueFunctionTest(BaseUnitTest):
         self.func.load(dir_path)
         self.eq(1, self.func.predict_value(state, action))
 
+    def test_mark_dirty(self):
+        self.func.mark_dirty(0, 1)
+        self.eq(None, self.func.dirty_pairs)
+        self.func.clear_delta()
+        self.func.mark_dirty(0, 1)
+        self.func.mark_dirty(0, 1)
+        self.eq(set([(0, 1)]), self.func.dirty_pairs)
+        self.func.clear_delta()
+        self.eq(set(), self.func.dirty_pairs)
+
+    @raises(Exception)
+    def test_save_delta_without_clear_delta(self):
+        self.func.save_delta("hoge")
+
+    def test_store_and_restore_delta(self):
+        setup_tmp_dir(__file__)
+        dir_path = generate_tmp_dir_path(__file__)
+        file_path = os.path.join(dir_path, "hoge_table_action_value_function_delta.pickle")
+        self.func.clear_delta()
+        self.func.insert_value_into_table(self.func.table, 0, 0, 2)
+        self.func.insert_value_into_table(self.func.table, 0, 1, 3)
+        self.func.mark_dirty(0, 1)
+        self.func.save_delta(dir_path)
+        self.true(os.path.exists(file_path))
+        self.eq([(0, 1, 3)], unpickle_data(file_path))
+        self.func = self.TestImpl()
+        self.func.setup()
+        self.func.load_delta(dir_path)
+        self.eq(0, self.func.predict_value(0, 0))
+        self.eq(3, self.func.predict_value(0, 1))
+
+    @raises(IOError)
+    def test_raise_error_if_delta_not_found(self):
+        self.func.load_delta("hoge")
+
     class TestImpl(BaseTabularActionValueFunction):
 
         def generate_initial_table(self):
@@ -73,6 +145,234 @@ class BaseTabularActionValueFunctionTest(BaseUnitTest):
             return "hoge"
 
 
+class DenseTabularActionValueFunctionTest(BaseUnitTest):
+
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest("numpy is not installed")
+        encode_action = lambda action: "udrl".index(action)
+        self.func = self.MazeTable(state_shape=(2, 3), nb_action=4, action_encoder=encode_action)
+        self.func.setup()
+
+    def tearDown(self):
+        file_names = ["montecarlo_table_action_value_function_data.npy", "montecarlo_update_counter.pickle",
+                "montecarlo_table_action_value_function_delta.npz", "montecarlo_update_counter_delta.pickle"]
+        teardown_tmp_dir(__file__, file_names)
+
+    def test_generate_initial_table(self):
+        self.eq((2, 3, 4), self.func.table.shape)
+        self.eq(0, self.func.table.sum())
+        func = DenseTabularActionValueFunction((5,), 2, initial_value=1.5)
+        self.eq([1.5, 1.5], func.generate_initial_table()[4].tolist())
+
+    def test_insert_and_fetch(self):
+        self.func.insert_value_into_table(self.func.table, (1, 2), "r", 3)
+        self.eq(3, self.func.predict_value((1, 2), "r"))
+        self.true(isinstance(self.func.predict_value((1, 2), "r"), float))
+        self.eq(3, self.func.table[1, 2, 2])
+        self.eq(0, self.func.predict_value((1, 2), "l"))
+
+    def test_int_state_index(self):
+        func = DenseTabularActionValueFunction((3,), 2, state_encoder=lambda state: state - 1)
+        func.setup()
+        func.insert_value_into_table(func.table, 3, 1, 2)
+        self.eq(2, func.table[2, 1])
+        self.eq(2, func.predict_value(3, 1))
+
+    def test_predict_value_on_batch(self):
+        self.func.insert_value_into_table(self.func.table, (0, 1), "d", 1)
+        self.func.insert_value_into_table(self.func.table, (1, 0), "l", 2)
+        pairs = [((0, 1), "u"), ((0, 1), "d"), ((1, 0), "l")]
+        self.eq([0, 1, 2], self.func.predict_value_on_batch(pairs))
+        self.eq([], self.func.predict_value_on_batch([]))
+
+    def test_fetch_values_of_state(self):
+        self.func.insert_value_into_table(self.func.table, (0, 1), "d", 1)
+        self.func.insert_value_into_table(self.func.table, (0, 1), "r", 2)
+        self.eq([0, 1, 2, 0], self.func.fetch_values_of_state((0, 1)).tolist())
+
+    def test_choose_greedy_action(self):
+        self.func.insert_value_into_table(self.func.table, (0, 1), "d", 1)
+        self.func.insert_value_into_table(self.func.table, (0, 1), "r", 2)
+        self.eq("r", self.func.choose_greedy_action((0, 1), ["u", "d", "r", "l"]))
+        self.eq("d", self.func.choose_greedy_action((0, 1), ["u", "d", "l"]))
+        rand = Mock()
+        rand.choice.side_effect = lambda ary: ary[-1]
+        self.eq("l", self.func.choose_greedy_action((0, 0), ["u", "d", "l"], rand))
+        self.eq([0, 1, 2], rand.choice.call_args[0][0].tolist())
+
+    def test_backup_of_combined_algorithm_table(self):
+        self.func.backup((0, 0), "u", 1, "dummy")
+        self.func.backup((0, 0), "u", 3, "dummy")
+        self.eq(2, self.func.predict_value((0, 0), "u"))
+        self.eq(2, self.func.fetch_value_from_table(self.func.update_counter, (0, 0), "u"))
+
+    def test_update_counter_ignores_initial_value(self):
+        func = self.MazeTable((2, 3), 4, action_encoder=self.func.action_encoder, initial_value=10)
+        func.setup()
+        self.eq(10, func.predict_value((0, 0), "u"))
+        self.eq(0, func.update_counter.sum())
+        func.backup((0, 0), "u", 2.0, "dummy")
+        self.eq(2.0, func.predict_value((0, 0), "u"))
+        self.eq(1, func.fetch_value_from_table(func.update_counter, (0, 0), "u"))
+
+    def test_store_and_restore_table(self):
+        setup_tmp_dir(__file__)
+        dir_path = generate_tmp_dir_path(__file__)
+        file_path = os.path.join(dir_path, "montecarlo_table_action_value_function_data.npy")
+        self.func.backup((1, 1), "l", 1, "dummy")
+        self.func.save(dir_path)
+        self.true(os.path.exists(file_path))
+        func = self.MazeTable(state_shape=(2, 3), nb_action=4, action_encoder=self.func.action_encoder)
+        func.load(dir_path)
+        self.eq(1, func.predict_value((1, 1), "l"))
+        self.eq(1, func.fetch_value_from_table(func.update_counter, (1, 1), "l"))
+
+    @raises(IOError)
+    def test_raise_error_if_load_file_not_found(self):
+        self.func.load("hoge")
+
+    def test_store_and_restore_delta(self):
+        setup_tmp_dir(__file__)
+        dir_path = generate_tmp_dir_path(__file__)
+        file_path = os.path.join(dir_path, "montecarlo_table_action_value_function_delta.npz")
+        self.func.clear_delta()
+        self.func.save_delta(dir_path)
+        self.func.backup((1, 1), "l", 1, "dummy")
+        self.func.backup((0, 2), "u", 3, "dummy")
+        self.func.save_delta(dir_path)
+        self.true(os.path.exists(file_path))
+        func = self.MazeTable((2, 3), 4, action_encoder=self.func.action_encoder)
+        func.setup()
+        func.load_delta(dir_path)
+        self.eq(1, func.predict_value((1, 1), "l"))
+        self.eq(3, func.predict_value((0, 2), "u"))
+        self.eq(0, func.predict_value((0, 2), "d"))
+        self.eq(1, func.fetch_value_from_table(func.update_counter, (0, 2), "u"))
+
+    def test_load_with_writable_mmap(self):
+        import numpy as np
+        setup_tmp_dir(__file__)
+        dir_path = generate_tmp_dir_path(__file__)
+        self.func.backup((1, 1), "l", 1, "dummy")
+        self.func.save(dir_path)
+        func = self.MazeTable((2, 3), 4, action_encoder=self.func.action_encoder, mmap_mode="r+")
+        func.load(dir_path)
+        self.true(isinstance(func.table, np.memmap))
+        func.backup((1, 1), "l", 3, "dummy")
+        func.save(dir_path)
+        self.true(isinstance(func.table, np.memmap))
+        self.func.load(dir_path)
+        self.eq(2, self.func.predict_value((1, 1), "l"))
+
+    @raises(ValueError)
+    def test_load_with_readonly_mmap(self):
+        setup_tmp_dir(__file__)
+        dir_path = generate_tmp_dir_path(__file__)
+        self.func.save(dir_path)
+        func = self.MazeTable((2, 3), 4, action_encoder=self.func.action_encoder, mmap_mode="r")
+        func.load(dir_path)
+        self.eq(0, func.predict_value((1, 1), "l"))
+        func.insert_value_into_table(func.table, (1, 1), "l", 1)
+
+    def test_save_copy_on_write_mmap_into_loaded_file(self):
+        setup_tmp_dir(__file__)
+        dir_path = generate_tmp_dir_path(__file__)
+        self.func.save(dir_path)
+        func = self.MazeTable((2, 3), 4, action_encoder=self.func.action_encoder, mmap_mode="c")
+        func.load(dir_path)
+        func.insert_value_into_table(func.table, (1, 1), "l", 1)
+        self.func.load(dir_path)
+        self.eq(0, self.func.predict_value((1, 1), "l"))
+        func.save(dir_path)
+        self.eq(1, func.predict_value((1, 1), "l"))
+        self.func.load(dir_path)
+        self.eq(1, self.func.predict_value((1, 1), "l"))
+
+    class MazeTable(MonteCarloTabularActionValueFunction, DenseTabularActionValueFunction):
+        pass
+
+class SparseTabularActionValueFunctionTest(BaseUnitTest):
+
+    def setUp(self):
+        self.func = self.BoardTable(default_value=0.5)
+        self.func.setup()
+
+    def tearDown(self):
+        teardown_tmp_dir(__file__, ["q_learning_table_action_value_function_data.pickle"])
+
+    def test_fetch_default_value_without_materializing(self):
+        self.eq(0.5, self.func.predict_value((1, 2), 4))
+        self.eq([0.5, 0.5], self.func.predict_value_on_batch([((1, 2), 4), ((1, 3), 4)]))
+        self.eq(0, len(self.func.table))
+
+    def test_insert_and_fetch(self):
+        self.func.insert_value_into_table(self.func.table, (1, 2), 4, 3)
+        self.func.insert_value_into_table(self.func.table, (1, 2), 8, 2)
+        self.func.insert_value_into_table(self.func.table, (0, 0), 8, 1)
+        self.eq(3, self.func.predict_value((1, 2), 4))
+        self.eq(2, self.func.predict_value((1, 2), 8))
+        self.eq(0.5, self.func.predict_value((0, 0), 4))
+        self.eq(1, self.func.predict_value((0, 0), 8))
+        self.eq(0.5, self.func.predict_value((0, 0), 16))
+        self.eq(2, len(self.func.table))
+
+    def test_predict_value_on_batch(self):
+        state = (1, 2)
+        self.func.insert_value_into_table(self.func.table, state, 4, 3)
+        self.func.insert_value_into_table(self.func.table, (0, 0), 8, 1)
+        pairs = [(state, 2), (state, 4), ((0, 0), 8), ((0, 0), 4), ((5, 5), 4)]
+        self.eq([0.5, 3, 1, 0.5, 0.5], self.func.predict_value_on_batch(pairs))
+
+    def test_backup_of_combined_algorithm_table(self):
+        self.func.backup((0, 0), 1, 1.5, 0.5)
+        self.eq(1, self.func.predict_value((0, 0), 1))
+
+    def test_backup_tracks_dirty_pairs(self):
+        self.func.clear_delta()
+        self.func.backup((0, 0), 1, 1.5, 0.5)
+        self.eq(set([((0, 0), 1)]), self.func.dirty_pairs)
+
+    def test_store_and_restore_table(self):
+        setup_tmp_dir(__file__)
+        dir_path = generate_tmp_dir_path(__file__)
+        self.func.insert_value_into_table(self.func.table, (1, 2), 4, 3)
+        self.func.save(dir_path)
+        func = self.BoardTable(default_value=0.5)
+        func.load(dir_path)
+        self.eq(3, func.predict_value((1, 2), 4))
+        self.eq(0.5, func.predict_value((1, 2), 8))
+
+    def test_update_counter_ignores_default_value(self):
+        func = self.MonteCarloBoardTable(default_value=10)
+        func.setup()
+        self.eq(10, func.predict_value((0, 0), 1))
+        self.eq(0, func.fetch_value_from_table(func.update_counter, (0, 0), 1))
+        func.backup((0, 0), 1, 2.0, "dummy")
+        self.eq(2.0, func.predict_value((0, 0), 1))
+        self.eq(1, func.fetch_value_from_table(func.update_counter, (0, 0), 1))
+
+    class BoardTable(QLearningTabularActionValueFunction, SparseTabularActionValueFunction):
+        pass
+
+    class MonteCarloBoardTable(MonteCarloTabularActionValueFunction, SparseTabularActionValueFunction):
+        pass
+
+class SparseActionValueTableTest(BaseUnitTest):
+
+    def test_rows_are_compact_array(self):
+        table = SparseActionValueTable(default_value=0, typecode="f")
+        table.insert("s1", "a", 1)
+        table.insert("s2", "c", 3)
+        table.insert("s1", "b", 2)
+        self.eq({"s1": 0, "s2": 1}, table.state_ids)
+        self.eq({"a": 0, "c": 1, "b": 2}, table.action_ids)
+        self.eq("f", table.rows[0].typecode)
+        self.eq([1, 0, 2], table.rows[0].tolist())
+        self.eq([0, 3], table.rows[1].tolist())
+
 class BaseApproxActionValueFunctionTest(BaseUnitTest):
 
     def setUp(self):
@@ -82,6 +382,11 @@ class BaseApproxActionValueFunctionTest(BaseUnitTest):
         func = self.TestImpl()
         self.eq("predict:hogefuga", func.predict_value("hoge", "fuga"))
 
+    def test_predict_value_on_batch(self):
+        func = self.TestImpl()
+        expected = ["predict:hogefuga", "predict:hogepiyo"]
+        self.eq(expected, func.predict_value_on_batch([("hoge", "fuga"), ("hoge", "piyo")]))
+
     def test_backup(self):
         func = self.TestImpl()
         func.backup("hoge", "fuga", "dummy", "dummy")